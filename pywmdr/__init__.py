@@ -15,6 +15,9 @@ from pywmdr.ats import ats
 from pywmdr.kpi import kpi
 from pywmdr.harvest import harvest
 from pywmdr.metrics import metrics
+from pywmdr.pipeline import pipeline
+from pywmdr.oai import oai
+from pywmdr.serve import serve
 
 __version__ = '0.1.dev0'
 
@@ -28,4 +31,7 @@ def cli():
 cli.add_command(ats)
 cli.add_command(kpi)
 cli.add_command(harvest)
-cli.add_command(metrics)
\ No newline at end of file
+cli.add_command(metrics)
+cli.add_command(pipeline)
+cli.add_command(oai)
+cli.add_command(serve)
\ No newline at end of file
@@ -22,7 +22,7 @@ import click
 from pywmdr.util import (get_cli_common_options, get_codelists_from_rdf,
                          get_string_or_anchor_value, NAMESPACES,
                          nspath_eval, parse_wmdr, setup_logger,
-                         urlopen_, validate_wmdr_xml)
+                         urlopen_, validate_wmdr_xml, detect_wmdr_root)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -69,23 +69,7 @@ class WMDRTestSuite:
         """
 
         self.test_id = None
-        rtag = exml.getroot().tag
-        if rtag != "{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord":
-            wigosmetadatarecord = exml.getroot().find('.//{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord')
-            if wigosmetadatarecord is None:
-                if rtag != '{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord':
-                    wigosmetadatarecord = exml.getroot().find('{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord')
-                    if wigosmetadatarecord is None:
-                        raise RuntimeError('Does not look like a WMDR document!')
-                    else:
-                        exml._setroot(wigosmetadatarecord)
-                LOGGER.debug("Warning: document is wmdr/2017 (1.0RC9)!")
-                self.version = "1.0RC9"
-            else:
-                exml._setroot(wigosmetadatarecord)
-                self.version = "1.0"
-        else:
-            self.version = "1.0"
+        self.version = detect_wmdr_root(exml)
         self.exml = exml
         self.namespaces = self.exml.getroot().nsmap
 
@@ -1,10 +1,16 @@
 import requests
 from lxml import etree
+import copy
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 import json
 import os
 import shutil
 import click
 import glob
+from pywmdr.store import RecordStore
+from pywmdr.util import get_wmdr_parser
 
 def getMetadataFormats(output,endpoint="https://oscar.wmo.int:443/oai/provider"):
     response = requests.get(endpoint, params = { "verb": "ListMetadataFormats"})
@@ -12,49 +18,212 @@ def getMetadataFormats(output,endpoint="https://oscar.wmo.int:443/oai/provider")
     f = open(output,"w")
     f.write(response.text)
     f.close()
-    tree = etree.parse(output)
+    tree = etree.parse(output,get_wmdr_parser())
     return tree.getroot()
 
+def parseHeader(header):
+    """
+    Read identifier, datestamp, setSpec and deleted status from an OAI record header
+    """
+    set_spec = header.find("{http://www.openarchives.org/OAI/2.0/}setSpec")
+    return {
+        "identifier": header.find("{http://www.openarchives.org/OAI/2.0/}identifier").text,
+        "datestamp" : header.find("{http://www.openarchives.org/OAI/2.0/}datestamp").text,
+        "setSpec" : set_spec.text if set_spec is not None else None,
+        "deleted": header.get("status") == "deleted"
+    }
+
+def readTombstones(filename):
+    """
+    Read tombstones file (identifier -> datestamp of deletion). Returns empty dict if file doesn't exist
+    """
+    if filename is None or not os.path.exists(filename):
+        return {}
+    f = open(filename)
+    tombstones = json.load(f)
+    f.close()
+    return tombstones
+
+def writeTombstones(tombstones,output_dir):
+    filename = "%s/tombstones.json" % output_dir
+    f = open(filename,"w")
+    json.dump(tombstones,f,indent=2)
+    f.close()
+
+def addTombstones(deleted_headers,output_dir,store=None):
+    """
+    Turn deleted OAI headers into tombstones: the record file is removed from output_dir and the identifier is added to output_dir/tombstones.json, so that downstream metrics can drop the station.
+    If a record store is given, the tombstones are appended to the store instead
+
+    :returns: number of tombstones added (headers already tombstoned or older than the stored version are skipped)
+    """
+    if not len(deleted_headers):
+        return 0
+    added = 0
+    if store is not None:
+        for header in deleted_headers:
+            # skipped if already tombstoned or older than the stored version
+            if store.put_if_newer(header["identifier"],header["datestamp"]):
+                added += 1
+        print("%i deleted records tombstoned" % added)
+        return added
+    if output_dir is None:
+        return 0
+    tombstones = readTombstones("%s/tombstones.json" % output_dir)
+    changed = False
+    for header in deleted_headers:
+        record_filename = "%s/%s.xml" % (output_dir,header["identifier"])
+        if os.path.exists(record_filename):
+            os.remove(record_filename)
+        if header["identifier"] in tombstones:
+            # already tombstoned, only keep the latest datestamp of deletion
+            if isOutdated({"datestamp": header["datestamp"]},tombstones[header["identifier"]]):
+                tombstones[header["identifier"]] = header["datestamp"]
+                changed = True
+            continue
+        tombstones[header["identifier"]] = header["datestamp"]
+        added += 1
+        changed = True
+    if changed:
+        writeTombstones(tombstones,output_dir)
+    print("%i deleted records tombstoned" % added)
+    return added
+
+def clearTombstones(headers,output_dir):
+    """
+    Remove from output_dir/tombstones.json the records harvested again after their deletion, so that metrics no longer drop the station.
+    A tombstone newer than the harvested version is kept
+
+    :returns: number of tombstones removed
+    """
+    filename = "%s/tombstones.json" % output_dir
+    if not len(headers) or not os.path.exists(filename):
+        return 0
+    tombstones = readTombstones(filename)
+    cleared = 0
+    for header in headers:
+        if header["identifier"] not in tombstones:
+            continue
+        if isOutdated({"datestamp": tombstones[header["identifier"]]},header["datestamp"]):
+            continue
+        del tombstones[header["identifier"]]
+        cleared += 1
+    if cleared:
+        writeTombstones(tombstones,output_dir)
+    return cleared
+
+def isOutdated(latest,datestamp):
+    """
+    Checks whether a harvested version is older than the latest version in the record store (OAI datestamps of the same granularity compare as strings)
+    """
+    return latest is not None and latest["datestamp"] is not None and datestamp is not None and latest["datestamp"] > datestamp
+
+def writeRecord(metadata,identifier,output_dir,store=None,datestamp=None,pretty_print=True):
+    """
+    Save a WIGOSMetadataRecord element either to output_dir/<identifier>.xml or, if given, to the record store.
+    The element is serialised once (re-indented only if pretty_print is set) and nothing is written if the stored content is identical.
+
+    :returns: True if the record was written, False if it was unchanged
+    """
+    content = etree.tostring(metadata, pretty_print=pretty_print)
+    return writeRecordContent(content,identifier,output_dir,store,datestamp)
+
+def writeRecordContent(content,identifier,output_dir,store=None,datestamp=None):
+    """
+    Save an already serialised record, unless the stored content is identical
+
+    :returns: True if the record was written, False if it was unchanged
+    """
+    if store is not None:
+        # unchanged, or a newer version was merged already (partitioned harvests)
+        return store.put_if_newer(identifier,datestamp,content)
+    record_filename = "%s/%s.xml" % (output_dir,identifier)
+    if os.path.exists(record_filename) and os.path.getsize(record_filename) == len(content):
+        f = open(record_filename,"rb")
+        unchanged = f.read() == content
+        f.close()
+        if unchanged:
+            return False
+    f = open(record_filename,"wb")
+    f.write(content)
+    f.close()
+    return True
+
+
+def getWithRetry(session,endpoint,params,retries=3,max_wait=10):
+    """
+    GET an OAI request, retrying on connection errors and on 5xx responses (honouring Retry-After)
+
+    :param session: requests.Session (or the requests module)
+    """
+    attempt = 0
+    while True:
+        try:
+            response = session.get(endpoint,params=params)
+            if response.status_code < 500 or attempt >= retries:
+                return response
+            wait = response.headers.get("Retry-After")
+            wait = min(float(wait),max_wait) if wait is not None and wait.isdigit() else 2 ** attempt
+        except requests.ConnectionError:
+            if attempt >= retries:
+                raise
+            wait = 2 ** attempt
+        attempt += 1
+        print("Warning: request failed, retrying in %i s (%i/%i)" % (wait, attempt, retries))
+        time.sleep(wait)
+
+def fetchRecord(identifier,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",session=None):
+    """
+    GetRecord in memory
+
+    :returns: header (dict, see parseHeader) and WIGOSMetadataRecord element (None if deleted or not found)
+    """
+    response = getWithRetry(session if session is not None else requests,endpoint,{"verb":"GetRecord","metadataPrefix":metadata_prefix,"identifier":identifier})
+    root = etree.fromstring(response.content,get_wmdr_parser(huge_tree=True,preserve=True))
+    record = root.find("{http://www.openarchives.org/OAI/2.0/}GetRecord/{http://www.openarchives.org/OAI/2.0/}record")
+    if record is None:
+        print("Warning: record %s not found" % identifier)
+        return None, None
+    header = parseHeader(record.find("{http://www.openarchives.org/OAI/2.0/}header"))
+    if header["deleted"]:
+        return header, None
+    el = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord")
+    if el is not None:
+        el.attrib["{http://www.w3.org/2001/XMLSchema-instance}schemaLocation"] = "http://def.wmo.int/wmdr/2017 http://schemas.wmo.int/wmdr/1.0RC9/wmdr.xsd"
+    else:
+        el = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord")
+    return header, el
 
 # %%
-def getRecord(identifier,output_dir,metadata_prefix = "wmdr",endpoint="https://oscar.wmo.int:443/oai/provider"):
+def getRecord(identifier,output_dir,metadata_prefix = "wmdr",endpoint="https://oscar.wmo.int:443/oai/provider",store=None,pretty_print=True):
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
-    record_file = "%s/%s.xml" % (output_dir,identifier)
-    response = requests.get(endpoint,params={"verb":"GetRecord","metadataPrefix":metadata_prefix,"identifier":identifier})
-    f = open(record_file,"w")
-    f.write(response.text)
-    f.close()
-    tree = etree.parse(record_file)
-    root = tree.getroot()
-    el = root.find("{http://www.openarchives.org/OAI/2.0/}GetRecord/{http://www.openarchives.org/OAI/2.0/}record/{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord")
+    # parse the response in memory, only the record itself is written
+    header, el = fetchRecord(identifier,endpoint=endpoint,metadata_prefix=metadata_prefix)
+    if header is not None and header["deleted"]:
+        addTombstones([header],output_dir,store)
+        return None
     if el is None:
         print("Warning: WIGOSMetadataRecord tag not found in document")
         return None
-    el.attrib["{http://www.w3.org/2001/XMLSchema-instance}schemaLocation"] = "http://def.wmo.int/wmdr/2017 http://schemas.wmo.int/wmdr/1.0RC9/wmdr.xsd"
-    et = etree.ElementTree(el)
-    filename = "%s/%s.xml" % (output_dir, identifier)
-    et.write(filename, pretty_print=True)
+    writeRecord(el,identifier,output_dir,store,header["datestamp"],pretty_print)
+    if store is None and header is not None:
+        clearTombstones([header],output_dir)
     return el
 
 # %%
 
-def getIdentifiersFirstPage(output,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None):
-    response = requests.get(endpoint, params = { "verb": "ListIdentifiers", "metadataPrefix": metadata_prefix, "set": set_spec})
+def getIdentifiersFirstPage(output,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,from_date=None):
+    response = requests.get(endpoint, params = { "verb": "ListIdentifiers", "metadataPrefix": metadata_prefix, "set": set_spec, "from": from_date})
     f = open(output,"w")
     f.write(response.text)
     f.close()
-    tree = etree.parse(output)
+    tree = etree.parse(output,get_wmdr_parser())
     root = tree.getroot()
     list_identifiers = root.find("{http://www.openarchives.org/OAI/2.0/}ListIdentifiers")
     identifiers = []
     for header in list_identifiers.iter("{http://www.openarchives.org/OAI/2.0/}header"):
-        identifiers.append({
-            "identifier": header.find("{http://www.openarchives.org/OAI/2.0/}identifier").text,
-            "datestamp" : header.find("{http://www.openarchives.org/OAI/2.0/}datestamp").text,
-            "setSpec" : header.find("{http://www.openarchives.org/OAI/2.0/}setSpec").text if header.find("{http://www.openarchives.org/OAI/2.0/}setSpec") is not None else None
-        })
-    # [x.find("{http://www.openarchives.org/OAI/2.0/}identifier").text for x in identifiers if "status" not in x.attrib]
+        identifiers.append(parseHeader(header))
     resumptionToken = list_identifiers.find("{http://www.openarchives.org/OAI/2.0/}resumptionToken")
     return identifiers, resumptionToken.text, int(resumptionToken.attrib["completeListSize"]), int(resumptionToken.attrib["cursor"])
 
@@ -63,21 +232,17 @@ def resumeGetIdentifiers(resumption_token,output,endpoint="https://oscar.wmo.int
     f = open(output,"w")
     f.write(response.text)
     f.close()
-    tree = etree.parse(output)
+    tree = etree.parse(output,get_wmdr_parser())
     root = tree.getroot()
     list_identifiers = root.find("{http://www.openarchives.org/OAI/2.0/}ListIdentifiers")
     identifiers = []
     for header in list_identifiers.iter("{http://www.openarchives.org/OAI/2.0/}header"):
-        identifiers.append({
-            "identifier": header.find("{http://www.openarchives.org/OAI/2.0/}identifier").text,
-            "datestamp" : header.find("{http://www.openarchives.org/OAI/2.0/}datestamp").text,
-            "setSpec" : header.find("{http://www.openarchives.org/OAI/2.0/}setSpec").text if header.find("{http://www.openarchives.org/OAI/2.0/}setSpec") is not None else None
-        })
+        identifiers.append(parseHeader(header))
     resumption_token = list_identifiers.find("{http://www.openarchives.org/OAI/2.0/}resumptionToken")
     return identifiers, int(resumption_token.attrib["cursor"]), resumption_token.text
 
-def getIdentifiers(output,output_all,output_dir=None,endpoint="https://oscar.wmo.int:443/oai/provider",max_pages=500,metadata_prefix="wmdr",set_spec=None):
-    identifiers, resumption_token, completeListSize, cursor = getIdentifiersFirstPage(output=output,endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec)
+def getIdentifiers(output,output_all,output_dir=None,endpoint="https://oscar.wmo.int:443/oai/provider",max_pages=500,metadata_prefix="wmdr",set_spec=None,from_date=None):
+    identifiers, resumption_token, completeListSize, cursor = getIdentifiersFirstPage(output=output,endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,from_date=from_date)
     page = 0
     if output_dir is not None:
         new_file = "%s/identifiers_%i.xml" % (output_dir,page)
@@ -95,34 +260,32 @@ def getIdentifiers(output,output_all,output_dir=None,endpoint="https://oscar.wmo
     f.close()
     return identifiers
 
-def getRecordsFromIdentifiers(identifiers,output_dir,metadata_prefix="wmdr",endpoint="https://oscar.wmo.int:443/oai/provider"):
-    for identifier in identifiers:
-        getRecord(identifier["identifier"],output_dir=output_dir,metadata_prefix=metadata_prefix,endpoint=endpoint)
+def getRecordsFromIdentifiers(identifiers,output_dir,metadata_prefix="wmdr",endpoint="https://oscar.wmo.int:443/oai/provider",store=None,pretty_print=True):
+    addTombstones([x for x in identifiers if x["deleted"]],output_dir,store)
+    for identifier in [x for x in identifiers if not x["deleted"]]:
+        getRecord(identifier["identifier"],output_dir=output_dir,metadata_prefix=metadata_prefix,endpoint=endpoint,store=store,pretty_print=pretty_print)
+    if store is not None:
+        store.commit()
 
-def getRecordsFirstPage(output,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,output_dir=None):
+def getRecordsFirstPage(output,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,output_dir=None,from_date=None,store=None,pretty_print=True,until_date=None):
     params={"verb":"ListRecords","metadataPrefix":metadata_prefix}
     if set_spec is not None:
         params["set"] = set_spec
+    if from_date is not None:
+        params["from"] = from_date
+    if until_date is not None:
+        params["until"] = until_date
     response = requests.get(endpoint,params=params)
-    f = open(output,"w")
-    f.write(response.text)
+    f = open(output,"wb")
+    f.write(response.content)
     f.close()
-    tree = etree.parse(output)
-    root = tree.getroot()
-    root.tag
+    root = etree.fromstring(response.content,get_wmdr_parser(huge_tree=True,preserve=True))
     list_records = root.find("{http://www.openarchives.org/OAI/2.0/}ListRecords")
-    records = []
-    for record in list_records.iter("{http://www.openarchives.org/OAI/2.0/}record"):
-        identifier = record.find("{http://www.openarchives.org/OAI/2.0/}header/{http://www.openarchives.org/OAI/2.0/}identifier").text
-        metadata = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord")
-        records.append({
-            "identifier": identifier,
-            "metadata" : metadata
-        })
-        if output_dir is not None and metadata is not None:
-            record_filename = "%s/%s.xml" % (output_dir,identifier)
-            et = etree.ElementTree(metadata)
-            et.write(record_filename, pretty_print=True)
+    if list_records is None:
+        # noRecordsMatch is a regular outcome of an incremental harvest
+        print("Element ListRecords not found")
+        return [], None, None, None
+    records = parseListRecords(list_records,output_dir,store,pretty_print)
     resumptionToken = list_records.find("{http://www.openarchives.org/OAI/2.0/}resumptionToken")
     if resumptionToken is not None:
         resumption_token = resumptionToken.text
@@ -132,14 +295,12 @@ def getRecordsFirstPage(output,endpoint="https://oscar.wmo.int:443/oai/provider"
     else:
         return records, None, None, None
 
-def getRecordsNextPage(output,resumption_token,endpoint="https://oscar.wmo.int:443/oai/provider",output_dir=None):
+def getRecordsNextPage(output,resumption_token,endpoint="https://oscar.wmo.int:443/oai/provider",output_dir=None,store=None,pretty_print=True):
     response = requests.get(endpoint,params={"verb":"ListRecords","resumptionToken":resumption_token})
-    f = open(output,"w")
-    f.write(response.text)
+    f = open(output,"wb")
+    f.write(response.content)
     f.close()
-    tree = etree.parse(output)
-    root = tree.getroot()
-    root.tag
+    root = etree.fromstring(response.content,get_wmdr_parser(huge_tree=True,preserve=True))
     list_records = root.find("{http://www.openarchives.org/OAI/2.0/}ListRecords")
     if list_records is None:
         print("Element ListRecords not found")
@@ -150,35 +311,151 @@ def getRecordsNextPage(output,resumption_token,endpoint="https://oscar.wmo.int:4
         if not os.path.exists(output_dir):
             os.mkdir(output_dir)
         shutil.copyfile(output,filename)
-    records = parseListRecords(list_records,output_dir) # []
+    records = parseListRecords(list_records,output_dir,store,pretty_print) # []
     new_token = list_records.find("{http://www.openarchives.org/OAI/2.0/}resumptionToken").text
     return records, cursor, new_token
 
-def parseListRecords(list_records,output_dir):
+def parseListRecords(list_records,output_dir,store=None,pretty_print=True):
     records = []
+    deleted = []
+    live = []
+    unchanged = 0
     for record in list_records.iter("{http://www.openarchives.org/OAI/2.0/}record"):
-        identifier = record.find("{http://www.openarchives.org/OAI/2.0/}header/{http://www.openarchives.org/OAI/2.0/}identifier").text
+        header = parseHeader(record.find("{http://www.openarchives.org/OAI/2.0/}header"))
+        identifier = header["identifier"]
+        if header["deleted"]:
+            # deleted records come without metadata
+            deleted.append(header)
+            records.append({
+                "identifier": identifier,
+                "datestamp": header["datestamp"],
+                "metadata": None,
+                "deleted": True
+            })
+            continue
         metadata = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord")
         if metadata is None:
             metadata = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord")
         records.append({
             "identifier": identifier,
-            "metadata" : metadata
+            "datestamp": header["datestamp"],
+            "metadata" : metadata,
+            "deleted": False
         })
-        if output_dir is not None and metadata is not None:
-            record_filename = "%s/%s.xml" % (output_dir,identifier)
-            et = etree.ElementTree(metadata)
-            et.write(record_filename, pretty_print=True)
+        if (output_dir is not None or store is not None) and metadata is not None:
+            live.append(header)
+            if not writeRecord(metadata,identifier,output_dir,store,header["datestamp"],pretty_print):
+                unchanged += 1
+    if unchanged:
+        print("%i unchanged records not rewritten" % unchanged)
+    addTombstones(deleted,output_dir,store)
+    if store is None and output_dir is not None:
+        clearTombstones(live,output_dir)
+    if store is not None:
+        store.commit()
     return records
 
-def parseRecordsFiles(file_pattern:str,output_dir):
+def splitRecordsFile(file,pretty_print=True):
+    """
+    Serialise the records of a saved ListRecords page using iterparse, clearing each record once serialised so that memory stays constant per page.
+    Runs in a worker process of parseRecordsFiles: the records and deletions are handed back to the parent process, which writes them (see parseRecordsFilesParallel)
+
+    :returns: dict with file, count, records ((header, content) tuples in document order, content None for a deleted record), size and elapsed (seconds)
+    """
+    start = time.time()
+    count = 0
+    records = []
+    for event, record in etree.iterparse(file, events=("end",), tag="{http://www.openarchives.org/OAI/2.0/}record"):
+        header = parseHeader(record.find("{http://www.openarchives.org/OAI/2.0/}header"))
+        if header["deleted"]:
+            records.append((header,None))
+        else:
+            metadata = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord")
+            if metadata is None:
+                metadata = record.find("{http://www.openarchives.org/OAI/2.0/}metadata/{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord")
+            if metadata is not None:
+                count += 1
+                records.append((header,etree.tostring(metadata, pretty_print=pretty_print)))
+        # free the record and the already processed siblings
+        record.clear()
+        while record.getprevious() is not None:
+            del record.getparent()[0]
+    return {
+        "file": file,
+        "count": count,
+        "records": records,
+        "size": os.path.getsize(file),
+        "elapsed": time.time() - start
+    }
+
+def isLatestVersion(versions,header,key):
+    """
+    Checks whether a version of a record (or its deletion) is newer than the versions of the record seen so far, and keeps it as the latest if so
+
+    :param versions: dict of the key of the latest version of each identifier
+    :param key: (page, position) of the version in the pages. Versions are ordered by datestamp, then by key (the later in the pages wins), so that the latest does not depend on the order in which the pages are processed
+    """
+    version = (header["datestamp"] or "",) + key
+    if header["identifier"] in versions and versions[header["identifier"]] > version:
+        return False
+    versions[header["identifier"]] = version
+    return True
+
+def parseRecordsFilesParallel(files,output_dir,store=None,pretty_print=True,processes=None):
+    """
+    Split saved ListRecords pages across a pool of processes, reporting the throughput of each page.
+    The pages are parsed and serialised by the workers, and the records, tombstones and store rows written by this (parent) process only, as the pages complete. A record found in more than one page is written (or tombstoned) from its latest version only (see isLatestVersion), whatever the order in which the pages complete
+    """
+    total = 0
+    start = time.time()
+    versions = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(splitRecordsFile,file,pretty_print): (index,file) for index, file in enumerate(files)}
+        for future in as_completed(futures):
+            index, file = futures[future]
+            try:
+                page = future.result()
+            except Exception as e:
+                print("Error: %s: %s" % (file,str(e)))
+                continue
+            unchanged = 0
+            outdated = 0
+            live = []
+            deleted = []
+            for position, (header, content) in enumerate(page["records"]):
+                if not isLatestVersion(versions,header,(index,position)):
+                    outdated += 1
+                    continue
+                if content is None:
+                    deleted.append((header,position))
+                    continue
+                live.append(header)
+                if not writeRecordContent(content,header["identifier"],output_dir,store,header["datestamp"]):
+                    unchanged += 1
+            # a deletion followed by a later version in the same page is not applied
+            addTombstones([header for header, position in deleted if versions[header["identifier"]][1:] == (index,position)],output_dir,store)
+            if store is not None:
+                store.commit()
+            else:
+                clearTombstones(live,output_dir)
+            if outdated:
+                print("%s: %i records older than their version in another page skipped" % (page["file"],outdated))
+            total += page["count"]
+            elapsed = max(page["elapsed"],1e-6)
+            print("%s: %i records (%i unchanged) in %.2f s, %.0f records/s, %.1f MB/s" % (page["file"], page["count"], unchanged, page["elapsed"], page["count"] / elapsed, page["size"] / elapsed / 1e6))
+    elapsed = time.time() - start
+    print("%i records from %i files in %.1f s (%.0f records/s)" % (total, len(files), elapsed, total / max(elapsed,1e-6)))
+
+def parseRecordsFiles(file_pattern:str,output_dir,store=None,pretty_print=True,processes=None):
     files = glob.glob(file_pattern)
     if not len(files):
         print("Error: no files matched the pattern")
         return
+    if processes is not None:
+        return parseRecordsFilesParallel(files,output_dir,store,pretty_print,processes)
     for file in files:
         try:
-            tree = etree.parse(file)
+            tree = etree.parse(file,get_wmdr_parser(huge_tree=True,preserve=True))
         except Exception as e:
             print("Error: %s" % (str(e)))
             continue
@@ -188,19 +465,19 @@ def parseRecordsFiles(file_pattern:str,output_dir):
             print("Element ListRecords not found")
             continue
         try:
-            records = parseListRecords(list_records,output_dir)
+            records = parseListRecords(list_records,output_dir,store,pretty_print)
         except Exception as e:
             print("Error: %s" % (str(e)))
             continue
 
-def getRecords(output,output_dir,endpoint="https://oscar.wmo.int:443/oai/provider",max_pages=10000,metadata_prefix="wmdr",set_spec=None,return_records=False):
-    records, resumption_token, completeListSize, cursor = getRecordsFirstPage(output,endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,output_dir=output_dir)
+def getRecords(output,output_dir,endpoint="https://oscar.wmo.int:443/oai/provider",max_pages=10000,metadata_prefix="wmdr",set_spec=None,return_records=False,from_date=None,store=None,pretty_print=True,until_date=None):
+    records, resumption_token, completeListSize, cursor = getRecordsFirstPage(output,endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,output_dir=output_dir,from_date=from_date,store=store,pretty_print=pretty_print,until_date=until_date)
     page = 0
     if resumption_token is None:
         return records
-    while cursor < completeListSize and page < max_pages:
+    while resumption_token and cursor < completeListSize and page < max_pages:
         page = page + 1
-        more_records, cursor, resumption_token = getRecordsNextPage(output,resumption_token,endpoint=endpoint,output_dir=output_dir)
+        more_records, cursor, resumption_token = getRecordsNextPage(output,resumption_token,endpoint=endpoint,output_dir=output_dir,store=store,pretty_print=pretty_print)
         if cursor is None:
             break
         print("cursor: %i, page: %i, completeListSize: %i" % (cursor, page, completeListSize))
@@ -211,6 +488,228 @@ def getRecords(output,output_dir,endpoint="https://oscar.wmo.int:443/oai/provide
     else:
         return
 
+def iterOAIList(verb,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,from_date=None,max_pages=10000,session=None,until_date=None,resumption_token=None):
+    """
+    Generator of the list elements (ListRecords, ListIdentifiers or ListSets) of all the pages of an OAI list request, parsed in memory
+
+    :param session: requests.Session to reuse connections across pages. Defaults to a new session
+    :param resumption_token: resume the list from this token (e.g. read from a checkpoint) instead of requesting its first page
+    """
+    params = {"verb":verb}
+    if metadata_prefix is not None:
+        params["metadataPrefix"] = metadata_prefix
+    if set_spec is not None:
+        params["set"] = set_spec
+    if from_date is not None:
+        params["from"] = from_date
+    if until_date is not None:
+        params["until"] = until_date
+    if resumption_token is not None:
+        params = {"verb":verb,"resumptionToken":resumption_token}
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    page = 0
+    try:
+        while page < max_pages:
+            response = getWithRetry(session,endpoint,params)
+            root = etree.fromstring(response.content,get_wmdr_parser(huge_tree=True,preserve=True))
+            list_element = root.find("{http://www.openarchives.org/OAI/2.0/}%s" % verb)
+            if list_element is None:
+                print("Element %s not found" % verb)
+                return
+            yield list_element
+            resumptionToken = list_element.find("{http://www.openarchives.org/OAI/2.0/}resumptionToken")
+            if resumptionToken is None or not resumptionToken.text:
+                return
+            page = page + 1
+            if "completeListSize" in resumptionToken.attrib:
+                print("cursor: %s, page: %i, completeListSize: %s" % (resumptionToken.get("cursor"), page, resumptionToken.get("completeListSize")))
+            params = {"verb":verb,"resumptionToken":resumptionToken.text}
+    finally:
+        if own_session:
+            session.close()
+
+def iterListRecords(endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,from_date=None,max_pages=10000,session=None):
+    """
+    Generator of harvested records, page by page and in memory (nothing is written to disk)
+
+    Each record is yielded as a dict with identifier, datestamp, metadata and deleted. The metadata element is detached from the OAI page so that the page can be freed while the record is being processed.
+    """
+    for list_records in iterOAIList("ListRecords",endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,from_date=from_date,max_pages=max_pages,session=session):
+        for record in parseListRecords(list_records,None):
+            if record["metadata"] is not None:
+                record["metadata"] = copy.deepcopy(record["metadata"])
+            yield record
+
+def iterListIdentifiers(endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,from_date=None,max_pages=10000,session=None):
+    """
+    Generator of harvested record headers (see parseHeader), page by page and in memory
+    """
+    for list_identifiers in iterOAIList("ListIdentifiers",endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,from_date=from_date,max_pages=max_pages,session=session):
+        for header in list_identifiers.iter("{http://www.openarchives.org/OAI/2.0/}header"):
+            yield parseHeader(header)
+
+def identify(endpoint="https://oscar.wmo.int:443/oai/provider",session=None):
+    """
+    Identify request
+
+    :returns: dict with earliestDatestamp and granularity
+    """
+    response = getWithRetry(session if session is not None else requests,endpoint,{"verb":"Identify"})
+    root = etree.fromstring(response.content,get_wmdr_parser())
+    return {
+        "earliestDatestamp": root.findtext("{http://www.openarchives.org/OAI/2.0/}Identify/{http://www.openarchives.org/OAI/2.0/}earliestDatestamp"),
+        "granularity": root.findtext("{http://www.openarchives.org/OAI/2.0/}Identify/{http://www.openarchives.org/OAI/2.0/}granularity")
+    }
+
+def listSets(endpoint="https://oscar.wmo.int:443/oai/provider",session=None):
+    """
+    :returns: list of the setSpec values of the provider
+    """
+    set_specs = []
+    for list_sets in iterOAIList("ListSets",endpoint=endpoint,metadata_prefix=None,session=session):
+        set_specs.extend([x.text for x in list_sets.iter("{http://www.openarchives.org/OAI/2.0/}setSpec")])
+    return set_specs
+
+def parseDatestamp(datestamp):
+    if len(datestamp) == 10:
+        return datetime.strptime(datestamp,"%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return datetime.strptime(datestamp,"%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+def datePartitions(from_date,until_date,partitions,granularity="YYYY-MM-DDThh:mm:ssZ"):
+    """
+    Split the datestamp range [from_date, until_date] into disjoint windows (OAI from and until are inclusive)
+
+    :returns: list of partitions (dicts with from_date and until_date)
+    """
+    day_granularity = granularity == "YYYY-MM-DD"
+    unit = timedelta(days=1) if day_granularity else timedelta(seconds=1)
+    datestamp_format = "%Y-%m-%d" if day_granularity else "%Y-%m-%dT%H:%M:%SZ"
+    start = parseDatestamp(from_date)
+    end = parseDatestamp(until_date)
+    steps = int((end - start) / unit) + 1
+    bounds = sorted(set([start + unit * (steps * i // partitions) for i in range(partitions)]))
+    windows = []
+    for i, bound in enumerate(bounds):
+        window_end = bounds[i+1] - unit if i + 1 < len(bounds) else end
+        windows.append({
+            "from_date": bound.strftime(datestamp_format),
+            "until_date": window_end.strftime(datestamp_format)
+        })
+    return windows
+
+def readCheckpoint(filename,partition):
+    """
+    Read the checkpoint of a partition. A checkpoint left by a different partitioning is ignored
+    """
+    if os.path.exists(filename):
+        f = open(filename)
+        checkpoint = json.load(f)
+        f.close()
+        if checkpoint["partition"] == partition:
+            return checkpoint
+    return {"partition": partition, "resumption_token": None, "pages": 0, "records": 0, "done": False}
+
+def readPartitionPlan(filename,request):
+    """
+    Read the partitions planned by an interrupted harvest of the same request, so that it resumes with the same windows (and the until date resolved by its first run) and its checkpoints match. A plan of a different request is ignored
+
+    :returns: list of partitions, or None
+    """
+    if os.path.exists(filename):
+        f = open(filename)
+        plan = json.load(f)
+        f.close()
+        if plan["request"] == request:
+            return plan["partitions"]
+    return None
+
+def writeCheckpoint(checkpoint,filename):
+    """
+    Write a checkpoint atomically (a harvest interrupted while writing leaves the previous checkpoint)
+    """
+    f = open("%s.tmp" % filename,"w")
+    json.dump(checkpoint,f,indent=2)
+    f.close()
+    os.replace("%s.tmp" % filename,filename)
+
+def harvestPartition(partition,checkpoint_file,store,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",pretty_print=True,max_pages=10000):
+    """
+    Run the resumption chain of one partition (a date window or a setSpec) into the record store, checkpointing the resumption token after each page so that an interrupted harvest resumes where it stopped
+    """
+    checkpoint = readCheckpoint(checkpoint_file,partition)
+    if checkpoint["done"]:
+        print("partition %s already harvested" % json.dumps(partition))
+        return checkpoint
+    session = requests.Session()
+    try:
+        for list_records in iterOAIList("ListRecords",endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=partition.get("set_spec"),from_date=partition.get("from_date"),until_date=partition.get("until_date"),max_pages=max_pages,session=session,resumption_token=checkpoint["resumption_token"]):
+            records = parseListRecords(list_records,None,store,pretty_print)
+            resumptionToken = list_records.find("{http://www.openarchives.org/OAI/2.0/}resumptionToken")
+            checkpoint["resumption_token"] = resumptionToken.text if resumptionToken is not None else None
+            checkpoint["pages"] += 1
+            checkpoint["records"] += len(records)
+            writeCheckpoint(checkpoint,checkpoint_file)
+    finally:
+        session.close()
+    # the chain is complete once a page comes without resumption token
+    checkpoint["done"] = checkpoint["resumption_token"] is None
+    writeCheckpoint(checkpoint,checkpoint_file)
+    print("partition %s: %i records in %i pages" % (json.dumps(partition),checkpoint["records"],checkpoint["pages"]))
+    return checkpoint
+
+def getRecordsPartitioned(output_dir,store,endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",partitions=4,partition_by="date",set_spec=None,from_date=None,until_date=None,pretty_print=True,max_pages=10000):
+    """
+    Harvest N disjoint partitions of the records in parallel, each with its own resumption chain and checkpoint (output_dir/checkpoint_<i>.json), merging them into the record store. Records are deduplicated by identifier: an unchanged or older version of a record already in the store is not appended. The partitions are planned once and kept in output_dir/partitions.json until all are complete, so that a harvest run again resumes the same partitions (with the until date of its first run) from their checkpoints.
+
+    :param partition_by: "date" to split the datestamp range [from_date, until_date] (defaults to the earliest datestamp of the provider and now) into windows, or "set" to harvest each setSpec of the provider as a partition
+    """
+    plan_file = "%s/partitions.json" % output_dir
+    request = {"endpoint": endpoint, "metadata_prefix": metadata_prefix, "partitions": partitions, "partition_by": partition_by, "set_spec": set_spec, "from_date": from_date, "until_date": until_date}
+    windows = readPartitionPlan(plan_file,request)
+    if windows is not None:
+        print("resuming the %i partitions planned in %s" % (len(windows),plan_file))
+    elif partition_by == "set":
+        windows = [{"set_spec": x} for x in listSets(endpoint=endpoint)]
+    else:
+        info = identify(endpoint=endpoint)
+        granularity = info["granularity"] or "YYYY-MM-DDThh:mm:ssZ"
+        if from_date is None:
+            from_date = info["earliestDatestamp"] or "1970-01-01T00:00:00Z"
+        if until_date is None:
+            until_date = datetime.now(timezone.utc).strftime("%Y-%m-%d" if granularity == "YYYY-MM-DD" else "%Y-%m-%dT%H:%M:%SZ")
+        windows = datePartitions(from_date,until_date,partitions,granularity)
+        if set_spec is not None:
+            for window in windows:
+                window["set_spec"] = set_spec
+    if not len(windows):
+        print("Error: no partitions to harvest")
+        return
+    writeCheckpoint({"request": request, "partitions": windows},plan_file)
+    checkpoint_files = ["%s/checkpoint_%i.json" % (output_dir,i) for i in range(len(windows))]
+    start = time.time()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=partitions) as executor:
+        futures = {executor.submit(harvestPartition,window,checkpoint_file,store,endpoint,metadata_prefix,pretty_print,max_pages): window for window, checkpoint_file in zip(windows,checkpoint_files)}
+        total = 0
+        for future in as_completed(futures):
+            try:
+                checkpoint = future.result()
+                total += checkpoint["records"]
+                if not checkpoint["done"]:
+                    failed += 1
+            except Exception as e:
+                failed += 1
+                print("Error: partition %s failed: %s" % (json.dumps(futures[future]),str(e)))
+    print("%i records from %i partitions in %.1f s, %i records in store" % (total, len(windows), time.time() - start, len(store)))
+    if failed:
+        print("Warning: %i partitions incomplete, run the harvest again to resume them from their checkpoints" % failed)
+        return
+    for checkpoint_file in checkpoint_files:
+        os.remove(checkpoint_file)
+    os.remove(plan_file)
+
 @click.group()
 def kpi():
     """key performance indicators"""
@@ -229,7 +728,14 @@ def kpi():
 @click.option('--identifier', '-i', type=str, help='Record identifier. Valid only for action=record')
 @click.option('--metadata_prefix', '-p', default="wmdr", help='Metadata prefix. Defaults to wmdr')
 @click.option('--file_pattern', '-f', help='File pattern corresponding to the record files')
-def harvest(self,action,output,set_spec,endpoint,identifier,metadata_prefix,file_pattern):
+@click.option('--from_date', '-d', type=str, help='Retrieve only records created, modified or deleted since this date (incremental harvest). Deleted records are removed from OUTPUT and listed in OUTPUT/tombstones.json')
+@click.option('--store', '-r', type=click.Path(dir_okay=False), help='Append records to this packed record store (SQLite file) instead of writing one XML file per record')
+@click.option('--compact', '-c', is_flag=True, default=False, help='Write records as parsed, without re-indenting them (single non-pretty serialisation)')
+@click.option('--processes', '-n', type=int, help='Split the record lists across this many processes. Valid only for action=parse_files')
+@click.option('--until_date', '-u', type=str, help='Retrieve only records created, modified or deleted until this date')
+@click.option('--partitions', '-w', type=int, help='Harvest this many disjoint partitions in parallel, each with its own resumption chain and checkpoint. Requires --store. Valid only for action=records')
+@click.option('--partition_by', '-b', type=click.Choice(["date","set"]), default="date", show_default=True, help='Partition the records by datestamp windows or by setSpec')
+def harvest(self,action,output,set_spec,endpoint,identifier,metadata_prefix,file_pattern,from_date,store,compact,processes,until_date,partitions,partition_by):
     """
     Bulk download WMDR records from OAI web service
 
@@ -248,24 +754,31 @@ def harvest(self,action,output,set_spec,endpoint,identifier,metadata_prefix,file
     if not os.path.isdir(output):
         print("Error: specified output directory not found")
         exit(1)
+    if store is not None:
+        store = RecordStore(store)
     if action == "identifiers":
         filename = "%s/identifiers.xml" % output
         filename_json = "%s/identifiers.json" % output
         if set_spec is not None:
-            getIdentifiers(filename,filename_json,output,endpoint=endpoint,set_spec=set_spec,metadata_prefix=metadata_prefix)
+            getIdentifiers(filename,filename_json,output,endpoint=endpoint,set_spec=set_spec,metadata_prefix=metadata_prefix,from_date=from_date)
         else:
-            getIdentifiers(filename,filename_json,output,endpoint=endpoint)
+            getIdentifiers(filename,filename_json,output,endpoint=endpoint,from_date=from_date)
+    elif action == "records" and partitions is not None:
+        if store is None:
+            print("ERROR: partitioned harvests require -r, --store")
+            exit(1)
+        getRecordsPartitioned(output,store,endpoint=endpoint,metadata_prefix=metadata_prefix,partitions=partitions,partition_by=partition_by,set_spec=set_spec,from_date=from_date,until_date=until_date,pretty_print=not compact)
     elif action == "records":
         filename = "%s/records.xml" % output
         if set_spec is not None:
-            getRecords(filename,output,endpoint=endpoint,set_spec=set_spec,metadata_prefix=metadata_prefix)
+            getRecords(filename,output,endpoint=endpoint,set_spec=set_spec,metadata_prefix=metadata_prefix,from_date=from_date,until_date=until_date,store=store,pretty_print=not compact)
         else:
-            getRecords(filename,output,endpoint=endpoint,metadata_prefix=metadata_prefix)
+            getRecords(filename,output,endpoint=endpoint,metadata_prefix=metadata_prefix,from_date=from_date,until_date=until_date,store=store,pretty_print=not compact)
     elif action == "record":
         if identifier is None:
             print("ERROR: missing -i, --identifier")
             exit(1)
-        getRecord(identifier,output_dir=output, endpoint=endpoint,metadata_prefix=metadata_prefix)
+        getRecord(identifier,output_dir=output, endpoint=endpoint,metadata_prefix=metadata_prefix,store=store,pretty_print=not compact)
     elif action == "parse_files":
         if file_pattern is None:
             print("ERROR: missing -f, --file_pattern")
@@ -273,9 +786,11 @@ def harvest(self,action,output,set_spec,endpoint,identifier,metadata_prefix,file
         if output is None:
             print("ERROR: missing OUTPUT")
             exit(1)
-        parseRecordsFiles(file_pattern,output)
+        parseRecordsFiles(file_pattern,output,store,pretty_print=not compact,processes=processes)
     else:
         print("ERROR: invalid action")
         exit(1)
+    if store is not None:
+        store.close()
 
 kpi.add_command(harvest)
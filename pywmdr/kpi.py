@@ -51,6 +51,9 @@ from io import BytesIO
 import json
 import os
 import logging
+import sys
+from lxml import etree
+import numpy
 # import re
 # import pytz
 # import datetime
@@ -65,7 +68,8 @@ from pywmdr.util import (get_cli_common_options, get_keyword_info,
                          setup_logger, urlopen_, check_url, get_codelists_from_rdf,
                          get_region, get_coordinates, is_within_timezone,
                          validate_url, get_href_and_validate, get_text_and_validate, 
-                         validate_text) # get_codelists, 
+                         validate_text, iter_wmdr_records, detect_wmdr_root,
+                         WMDR_RECORD_TAGS, get_codelist_index) # get_codelists, 
 
 logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger(__name__)
@@ -73,9 +77,64 @@ LOGGER = logging.getLogger(__name__)
 # round percentages to x decimal places
 ROUND = 3
 
+# lower bounds (percentage) of the grades E, D, C, B and A. Below: F
+GRADE_THRESHOLDS = [20, 35, 50, 65, 80]
+GRADES = ['F', 'E', 'D', 'C', 'B', 'A']
+
 THISDIR = os.path.dirname(os.path.realpath(__file__))
 
 
+# rules 2-0-12-a to e, scored for each log entry: child of the EventReport
+# (validPeriod: its gml:TimePeriod/gml:beginPosition), name, type and
+# options of the validation (codelist: name of the codelist index)
+LOG_ENTRY_RULES = [
+    # Rule 2-0-12-a: A date is added (range or single day).
+    ('validPeriod', 'valid period of reported event', 'datetime', {}),
+    # Rule 2-0-12-b: The event is specified and not "unknown".
+    ('typeOfEvent', 'type of event', 'href', {'codelist': 'EventAtFacility'}),
+    # Rule 2-0-12-c: A description is provided.
+    ('description', 'event description', 'string', {'min_length': 100}),
+    # 2-0-12-d: The author is named.
+    ('author', 'author of log entry', 'string', {}),
+    # 2-0-12-e: The event has an online reference.
+    ('documentationURL', 'documentation URL of log entry', 'url', {})
+]
+
+
+KNOWN_KPIS = [
+    'kpi_10',
+    'kpi_20',
+    'kpi_21',
+    'kpi_30',
+    'kpi_31',
+    'kpi_32',
+    'kpi_33',
+    'kpi_34',
+    'kpi_40',
+    'kpi_41',
+    'kpi_50',
+    'kpi_60'
+]
+
+
+def check_kpi_number(kpi: int) -> str:
+    """
+    Checks the number of a KPI
+
+    :param kpi: number of the KPI (e.g. 21)
+
+    :returns: `str` of the name of the KPI (e.g. kpi_21). Raises ValueError
+              if it is not in `KNOWN_KPIS`
+    """
+
+    selected_kpi = f'kpi_{kpi:02}'
+    if selected_kpi not in KNOWN_KPIS:
+        msg = f'Invalid KPI number: {selected_kpi} is not in {KNOWN_KPIS}'
+        LOGGER.error(msg)
+        raise ValueError(msg)
+    return selected_kpi
+
+
 class WMDRKeyPerformanceIndicators:
     """Key Performance Indicators for WMDR"""
 
@@ -88,27 +147,7 @@ class WMDRKeyPerformanceIndicators:
         :returns: `pywmdr.kpi.WMDRKeyPerformanceIndicators`
         """
         # serialized already
-        rtag = exml.getroot().tag
-        if rtag != "{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord":
-            LOGGER.debug("0.rtag: %s" % rtag)
-            wigosmetadatarecord = exml.getroot().find('.//{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord')
-            if wigosmetadatarecord is None:
-                LOGGER.debug("http://def.wmo.int/wmdr/1.0 tag not found")
-                if rtag != '{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord':
-                    LOGGER.debug("root tag not http://def.wmo.int/wmdr/2017")
-                    wigosmetadatarecord = exml.getroot().find('{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord')
-                    if wigosmetadatarecord is None:
-                        LOGGER.debug("tag http://def.wmo.int/wmdr/2017 not found")
-                        raise RuntimeError('Does not look like a WMDR document!')
-                    else:
-                        exml._setroot(wigosmetadatarecord)
-                LOGGER.debug("Warning: document is wmdr/2017 (1.0RC9)!")
-                self.version = "1.0RC9"
-            else:
-                exml._setroot(wigosmetadatarecord)
-                self.version = "1.0"
-        else:
-            self.version = "1.0"
+        self.version = detect_wmdr_root(exml)
         self.exml = exml
         self.namespaces = self.exml.getroot().nsmap
         # remove empty (default) namespace to avoid exceptions in exml.xpath
@@ -135,6 +174,120 @@ class WMDRKeyPerformanceIndicators:
         # generate dict of codelists
         self.codelists = get_codelists_from_rdf()
 
+        # scores of the instances of the per-instance KPIs (deployments,
+        # data_generations, log_entries) computed while the document was
+        # streamed (see evaluate_streaming), used instead of the tree
+        self.instance_scores = {}
+
+        # observations and deployments of the facility, found once (see
+        # observations, om_observations and deployments)
+        self._observations = None
+        self._om_observations = None
+        self._deployments = None
+
+        # values extracted and validated once per document and shared by
+        # the KPIs and the summary fields (see _memoize)
+        self._memo = {}
+
+    def _memoize(self, key, function, *args, **kwargs):
+        """
+        Helper function to extract and validate a value of the document
+        once: the result of function(*args, **kwargs) is kept under key and
+        returned to every caller, which must not modify it
+
+        :returns: result of function
+        """
+
+        if key not in self._memo:
+            self._memo[key] = function(*args, **kwargs)
+        return self._memo[key]
+
+    def get_facility_coordinates(self) -> tuple:
+        """
+        Helper function to get the coordinates of the facility, once per
+        document (see `pywmdr.util.get_coordinates`)
+
+        :returns: `tuple` of longitude and latitude. Raises ValueError if
+                  they are missing or invalid
+        """
+
+        def coordinates():
+            try:
+                return get_coordinates(self), None
+            except ValueError as err:
+                return None, str(err)
+
+        lon_lat, error = self._memoize('coordinates', coordinates)
+        if error is not None:
+            raise ValueError(error)
+        return lon_lat
+
+    def _validate_wmo_region(self) -> tuple:
+        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:wmoRegion'
+        return self._memoize('wmo_region', get_href_and_validate, self.exml,xpath,self.namespaces,self.codelists["WMORegion"],"wmo region")
+
+    def _validate_territory(self) -> tuple:
+        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:territory/wmdr:Territory/wmdr:territoryName'
+        return self._memoize('territory', get_href_and_validate, self.exml,xpath,self.namespaces,self.codelists["TerritoryName"],"territory name")
+
+    def _validate_organisation(self) -> tuple:
+        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:responsibleParty/wmdr:ResponsibleParty/wmdr:responsibleParty/gmd:CI_ResponsibleParty/gmd:organisationName/gco:CharacterString'
+        return self._memoize('organisation', get_text_and_validate, self.exml, xpath, self.namespaces, type="string", element_name="supervising organization")
+
+    def _purpose_of_frequency_use(self, instance, deployment_number):
+        # shared by kpi_3125 and kpi_3126, which score the same deployment
+        # one after the other: only the value of the last one is kept
+        previous = self._memo.get('purpose_of_frequency_use')
+        if previous is None or previous[0] is not instance:
+            xpath = './om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment/wmdr:deployedEquipment/wmdr:Equipment/wmdr:frequency/wmdr:Frequencies/wmdr:purposeOfFrequencyUse'
+            value = get_href_and_validate(instance,xpath,self.namespaces,self.codelists["PurposeOfFrequencyUse"],"deployment number %s purpose of frequency use" % deployment_number)[2]
+            previous = (instance, value)
+            self._memo['purpose_of_frequency_use'] = previous
+        return previous[1]
+
+    @property
+    def observations(self) -> list:
+        """
+        wmdr:observation elements of the observing capabilities of the
+        facility, in document order
+
+        :returns: `list` of `etree.Element`
+        """
+
+        if self._observations is None:
+            xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:observation/wmdr:ObservingCapability/wmdr:observation'
+            self._observations = self.exml.xpath(xpath, namespaces=self.namespaces)
+        return self._observations
+
+    @property
+    def om_observations(self) -> list:
+        """
+        om:OM_Observation elements of the facility, in document order
+
+        :returns: `list` of `etree.Element`
+        """
+
+        if self._om_observations is None:
+            self._om_observations = []
+            for observation in self.observations:
+                self._om_observations += observation.xpath('./om:OM_Observation', namespaces=self.namespaces)
+        return self._om_observations
+
+    @property
+    def deployments(self) -> list:
+        """
+        wmdr:Deployment elements of the OM_Observations of the facility, in
+        document order
+
+        :returns: `list` of `etree.Element`
+        """
+
+        if self._deployments is None:
+            self._deployments = []
+            for instance in self.om_observations:
+                self._deployments += instance.xpath('./om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment', namespaces=self.namespaces)
+        return self._deployments
+
     @property
     def identifier(self):
         """
@@ -158,8 +311,7 @@ class WMDRKeyPerformanceIndicators:
 
         :returns: metadata record organisation
         """
-        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:responsibleParty/wmdr:ResponsibleParty/wmdr:responsibleParty/gmd:CI_ResponsibleParty/gmd:organisationName/gco:CharacterString'
-        sscore, scomments, value = get_text_and_validate(self.exml, xpath, self.namespaces, type="string", element_name="supervising organization")
+        sscore, scomments, value = self._validate_organisation()
         if len(value):
             return value
         else:
@@ -172,8 +324,7 @@ class WMDRKeyPerformanceIndicators:
 
         :returns: metadata record country
         """
-        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:territory/wmdr:Territory/wmdr:territoryName'
-        sscore, scomments, value = get_href_and_validate(self.exml,xpath,self.namespaces,self.codelists["TerritoryName"],"territory name")
+        sscore, scomments, value = self._validate_territory()
         if value is not None:
             return value
         else:
@@ -186,8 +337,7 @@ class WMDRKeyPerformanceIndicators:
 
         :returns: metadata record region
         """
-        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:wmoRegion'
-        sscore, scomments, wmoregion = get_href_and_validate(self.exml,xpath,self.namespaces,self.codelists["WMORegion"],"wmo region")
+        sscore, scomments, wmoregion = self._validate_wmo_region()
         if wmoregion is not None:
             return wmoregion
         else:
@@ -407,7 +557,7 @@ class WMDRKeyPerformanceIndicators:
 
         xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:wmoRegion'
 
-        sscore, scomments, wmoregion = get_href_and_validate(self.exml,xpath,self.namespaces,self.codelists["WMORegion"],"wmo region")
+        sscore, scomments, wmoregion = self._validate_wmo_region()
 
         if not wmoregion:
             getNotation = True
@@ -419,7 +569,7 @@ class WMDRKeyPerformanceIndicators:
         ## get the coordinates
         lon, lat = (None, None)
         try:
-            lon, lat = get_coordinates(self)
+            lon, lat = self.get_facility_coordinates()
         except ValueError as e:
             LOGGER.debug(str(e))
             comments.append(str(e))
@@ -454,7 +604,7 @@ class WMDRKeyPerformanceIndicators:
             ## get the coordinates
             lon, lat = (None, None)
             try:
-                lon, lat = get_coordinates(self)
+                lon, lat = self.get_facility_coordinates()
             except ValueError as e:
                 LOGGER.debug(str(e))
                 comments.append(str(e))
@@ -485,9 +635,7 @@ class WMDRKeyPerformanceIndicators:
         comments = []
         
         # Rule 2-0-03-a: A supervising organization is specified and not "unknown".
-        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:responsibleParty/wmdr:ResponsibleParty/wmdr:responsibleParty/gmd:CI_ResponsibleParty/gmd:organisationName/gco:CharacterString'
-        
-        sscore, scomments, value = get_text_and_validate(self.exml, xpath, self.namespaces, type="string", element_name="supervising organization")
+        sscore, scomments, value = self._validate_organisation()
         score += sscore
         comments = comments + scomments
         
@@ -731,93 +879,70 @@ class WMDRKeyPerformanceIndicators:
         score = 0
         comments = []
 
-        xpath = "./wmdr:facility/wmdr:ObservingFacility/wmdr:facilityLog/wmdr:FacilityLog/wmdr:logEntry"
-        matches = self.exml.xpath(xpath,namespaces=self.namespaces)
-        if not len(matches):
+        log_entries = self.instance_scores.get('log_entries')
+        if log_entries is None:
+            xpath = "./wmdr:facility/wmdr:ObservingFacility/wmdr:facilityLog/wmdr:FacilityLog/wmdr:logEntry"
+            matches = self.exml.xpath(xpath,namespaces=self.namespaces)
+            log_entries = [self.score_log_entry(logEntry,i) for i, logEntry in enumerate(matches,1)]
+        if not len(log_entries):
             LOGGER.debug("logEntry not found")
             comments.append("logEntry not found")
         else:
             sum = 0
             count = 0
-            value = []
-            for logEntry in matches:
-                count = count + 5
-                
-                # Rule 2-0-12-a: A date is added (range or single day).
-                element_name = "valid period of reported event"
-                # xpath = './wmdr:EventReport/wmdr:datetime'
-                xpath = './wmdr:EventReport/wmdr:validPeriod/gml:TimePeriod/gml:beginPosition'
-                matches = logEntry.xpath(xpath,namespaces=self.namespaces)
-                if not len(matches):
-                    LOGGER.debug("%s not found" % element_name)
-                    comments.append("%s not found" % element_name)
-                else:
-                    text = matches[0].text
-                    sscore, scomments, svalue = validate_text(text,"datetime",element_name) 
-                    sum += sscore
-                    comments = comments + scomments
-                    value.append(svalue)
-
-                # Rule 2-0-12-b: The event is specified and not "unknown".
-                xpath = './wmdr:EventReport/wmdr:typeOfEvent'
-                element_name = "type of event"
-                matches = logEntry.xpath(xpath,namespaces=self.namespaces)
-                if not len(matches):
-                    LOGGER.debug("%s not found" % element_name)
-                    comments.append("%s not found" % element_name)
-                else:
-                    text = matches[0].get('{http://www.w3.org/1999/xlink}href')
-                    sscore, scomments, svalue = validate_text(text,"href",element_name,codelist=self.codelists["EventAtFacility"])
-                    sum += sscore
-                    comments = comments + scomments
-                    value.append(svalue)
-
-                # Rule 2-0-12-c: A description is provided.
-                xpath = './wmdr:EventReport/wmdr:description'
-                element_name = "event description"
-                matches = logEntry.xpath(xpath,namespaces=self.namespaces)
-                if not len(matches):
-                    LOGGER.debug("%s not found" % element_name)
-                    comments.append("%s not found" % element_name)
-                else:
-                    text = matches[0].text
-                    sscore, scomments, svalue = validate_text(text,"string",element_name,min_length=100)
-                    sum += sscore
-                    comments = comments + scomments
-                    value.append(svalue)
-
-                # 2-0-12-d: The author is named.
-                xpath = './wmdr:EventReport/wmdr:author'
-                element_name = "author of log entry"
-                matches = logEntry.xpath(xpath,namespaces=self.namespaces)
-                if not len(matches):
-                    LOGGER.debug("%s not found" % element_name)
-                    comments.append("%s not found" % element_name)
-                else:
-                    text = matches[0].text
-                    sscore, scomments, svalue = validate_text(text,"string",element_name)
-                    sum += sscore
-                    comments = comments + scomments
-                    value.append(svalue)
-
-                # 2-0-12-e: The event has an online reference.
-                xpath = './wmdr:EventReport/wmdr:documentationURL'
-                element_name = "documentation URL of log entry"
-                matches = logEntry.xpath(xpath,namespaces=self.namespaces)
-                if not len(matches):
-                    LOGGER.debug("%s not found" % element_name)
-                    comments.append("%s not found" % element_name)
-                else:
-                    text = matches[0].text
-                    sscore, scomments, svalue = validate_text(text,"url",element_name)
-                    sum += sscore
-                    comments = comments + scomments
-                    value.append(svalue)
-
+            for el_total, el_score, el_comments in log_entries:
+                count = count + el_total
+                sum += el_score
+                comments.extend(el_comments)
             score = sum / count * total
             # print("sum: %d, count: %s, score: %03f" % (sum, count, score))
         return total, score, comments
 
+    def score_log_entry(self, logEntry, log_entry_number) -> tuple:
+        """
+        Scores a logEntry instance against the rules of 2-0-12, in one pass
+        over the children of its EventReport
+
+        :returns: `tuple` of total score, achieved score and comments
+        """
+        sum = 0
+        comments = []
+        wmdr = self.namespaces['wmdr']
+        gml = self.namespaces.get('gml')
+        tags = {f'{{{wmdr}}}{rule[0]}': rule[0] for rule in LOG_ENTRY_RULES}
+
+        # first element of each rule, in document order
+        elements = {}
+        for report in logEntry.iterchildren(f'{{{wmdr}}}EventReport'):
+            for child in report.iterchildren(*tags):
+                local_name = tags[child.tag]
+                if local_name in elements:
+                    continue
+                if local_name == 'validPeriod':
+                    child = next(child.iterfind(f'{{{gml}}}TimePeriod/{{{gml}}}beginPosition'), None)
+                    if child is None:
+                        continue
+                elements[local_name] = child
+
+        for rule in LOG_ENTRY_RULES:
+            local_name, element_name, type_, kwargs = rule
+            element = elements.get(local_name)
+            if element is None:
+                LOGGER.debug("%s not found" % element_name)
+                comments.append("%s not found" % element_name)
+                continue
+            if type_ == "href":
+                text = element.get('{http://www.w3.org/1999/xlink}href')
+                kwargs = {"codelist": get_codelist_index(kwargs["codelist"])}
+            else:
+                text = element.text
+            sscore, scomments, svalue = validate_text(text,type_,element_name,**kwargs)
+            sum += sscore
+            comments = comments + scomments
+
+        LOGGER.debug("log entry number %s, score: %s" % (log_entry_number, sum))
+        return len(LOG_ENTRY_RULES), sum, comments
+
     def kpi_2013(self):
         # Rule 2-0-13 Territory/Country wmdr:territory
         total = 2
@@ -825,9 +950,7 @@ class WMDRKeyPerformanceIndicators:
         comments = []
 
         # rule 2-0-13-a: A territory or country is specified and not "unknown".
-        xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:territory/wmdr:Territory/wmdr:territoryName'
-        
-        sscore, scomments, value = get_href_and_validate(self.exml,xpath,self.namespaces,self.codelists["TerritoryName"],"territory name")
+        sscore, scomments, value = self._validate_territory()
         score += sscore
         comments = comments + scomments
         
@@ -882,7 +1005,7 @@ class WMDRKeyPerformanceIndicators:
         LOGGER.info(f'Running {name}')
         
         # get OM_Observations
-        OM_Observations = self.exml.xpath('./wmdr:facility/wmdr:ObservingFacility/wmdr:observation/wmdr:ObservingCapability/wmdr:observation/om:OM_Observation',namespaces=self.namespaces)
+        OM_Observations = self.om_observations
         if not len(OM_Observations):
             comments.append("OM_Observation not found")
         else:
@@ -923,195 +1046,206 @@ class WMDRKeyPerformanceIndicators:
         name = 'KPI-3-1: Deployment'
         LOGGER.info(f'Running {name}')
         
-        # get OM_Observations
-        OM_Observations = self.exml.xpath('./wmdr:facility/wmdr:ObservingFacility/wmdr:observation/wmdr:ObservingCapability/wmdr:observation/om:OM_Observation',namespaces=self.namespaces)
-        if not len(OM_Observations):
+        deployments = self.instance_scores.get('deployments')
+        if deployments is None:
+            # get OM_Observations
+            OM_Observations = self.om_observations
+            deployments = [self.score_deployment(instance,i) for i, instance in enumerate(OM_Observations,1)]
+        if not len(deployments):
             comments.append("OM_Observation not found")
             total = 33
         else:
         # compute kpi for each OM_Observation instance
-            number_of_deployments = len(OM_Observations)
-            i = 0
-            for instance in OM_Observations:
-                i += 1
-                # LOGGER.debug(instance)
-                el_total = 0
-                el_score = 0
-                # Rule 3-1-00: Source of observation
-                stotal, sscore, scomments = self.kpi_3100(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+            number_of_deployments = len(deployments)
+            for el_total, el_score, el_comments in deployments:
+                total += el_total
+                score += el_score
+                comments = comments + el_comments
 
-                # Rule 3-1-01: Distance from reference surface 
-                stotal, sscore, scomments = self.kpi_3101(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+            total = total / len(deployments)
+            score = score / len(deployments)
+        return name, total, score, comments, number_of_deployments
 
-                # Rule 3-1-02: Type of reference surface 
-                stotal, sscore, scomments = self.kpi_3102(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+    def score_deployment(self, instance, deployment_number) -> tuple:
+        """
+        Scores an OM_Observation instance against the rules of KPI-3-1
 
-                # Rule 3-1-03: Application area(s)
-                stotal, sscore, scomments = self.kpi_3103(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        :returns: `tuple` of total score, achieved score and comments
+        """
+        comments = []
+        # LOGGER.debug(instance)
+        el_total = 0
+        el_score = 0
+        # Rule 3-1-00: Source of observation
+        stotal, sscore, scomments = self.kpi_3100(instance,deployment_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-1-04: Exposure of instrument
-                stotal, sscore, scomments = self.kpi_3104(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        # Rule 3-1-01: Distance from reference surface 
+        stotal, sscore, scomments = self.kpi_3101(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-1-05: Configuration of instrument 
-                stotal, sscore, scomments = self.kpi_3105(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-02: Type of reference surface 
+        stotal, sscore, scomments = self.kpi_3102(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-1-06: Representativeness of observation
-                stotal, sscore, scomments = self.kpi_3106(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-03: Application area(s)
+        stotal, sscore, scomments = self.kpi_3103(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-1-07: Measurement leader / principal investigator
-                stotal, sscore, scomments = self.kpi_3107(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-04: Exposure of instrument
+        stotal, sscore, scomments = self.kpi_3104(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-1-08: Organization
-                stotal, sscore, scomments = self.kpi_3108(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-05: Configuration of instrument 
+        stotal, sscore, scomments = self.kpi_3105(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-1-09: Near Real Time 
-                stotal, sscore, scomments = self.kpi_3109(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-06: Representativeness of observation
+        stotal, sscore, scomments = self.kpi_3106(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-1-10: (not defined)
-                # stotal, sscore, scomments = self.kpi_3110(instance,i)
-                # el_total  += stotal
-                # el_score  += sscore
-                # comments = comments + scomments
+        # Rule 3-1-07: Measurement leader / principal investigator
+        stotal, sscore, scomments = self.kpi_3107(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-1-11: Data URL (same as 3-1-09.2)
-                # stotal, sscore, scomments = self.kpi_3111(instance,i)
-                # el_total  += stotal
-                # el_score  += sscore
-                # comments = comments + scomments
+        # Rule 3-1-08: Organization
+        stotal, sscore, scomments = self.kpi_3108(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-1-12: Data communication method
-                stotal, sscore, scomments = self.kpi_3112(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-09: Near Real Time 
+        stotal, sscore, scomments = self.kpi_3109(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-1-13: Instrument QA/QC schedule
-                stotal, sscore, scomments = self.kpi_3113(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-10: (not defined)
+        # stotal, sscore, scomments = self.kpi_3110(instance,deployment_number)
+        # el_total  += stotal
+        # el_score  += sscore
+        # comments = comments + scomments
+
+        # Rule 3-1-11: Data URL (same as 3-1-09.2)
+        # stotal, sscore, scomments = self.kpi_3111(instance,deployment_number)
+        # el_total  += stotal
+        # el_score  += sscore
+        # comments = comments + scomments
+
+        # Rule 3-1-12: Data communication method
+        stotal, sscore, scomments = self.kpi_3112(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
+
+        # Rule 3-1-13: Instrument QA/QC schedule
+        stotal, sscore, scomments = self.kpi_3113(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-14: Maintenance schedule 
-                stotal, sscore, scomments = self.kpi_3114(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-14: Maintenance schedule 
+        stotal, sscore, scomments = self.kpi_3114(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-15: Instrument details
-                stotal, sscore, scomments = self.kpi_3115(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-15: Instrument details
+        stotal, sscore, scomments = self.kpi_3115(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-16: 
-                stotal, sscore, scomments = self.kpi_3116(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-16: 
+        stotal, sscore, scomments = self.kpi_3116(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-17: Coordinates
-                stotal, sscore, scomments = self.kpi_3117(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-17: Coordinates
+        stotal, sscore, scomments = self.kpi_3117(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-18: Instrument operating status
-                stotal, sscore, scomments = self.kpi_3118(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-18: Instrument operating status
+        stotal, sscore, scomments = self.kpi_3118(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-19: Firmware version
-                stotal, sscore, scomments = self.kpi_3119(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-19: Firmware version
+        stotal, sscore, scomments = self.kpi_3119(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-20: Observable range
-                stotal, sscore, scomments = self.kpi_3120(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-20: Observable range
+        stotal, sscore, scomments = self.kpi_3120(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-21: Uncertainty
-                stotal, sscore, scomments = self.kpi_3121(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-21: Uncertainty
+        stotal, sscore, scomments = self.kpi_3121(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-22: Drift per unit time
-                stotal, sscore, scomments = self.kpi_3122(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-22: Drift per unit time
+        stotal, sscore, scomments = self.kpi_3122(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-23: Specification URL 
-                stotal, sscore, scomments = self.kpi_3123(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-23: Specification URL 
+        stotal, sscore, scomments = self.kpi_3123(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-24: Uncertainty evaluation procedure 
-                stotal, sscore, scomments = self.kpi_3124(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-24: Uncertainty evaluation procedure 
+        stotal, sscore, scomments = self.kpi_3124(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-25: Observation frequency and polarization 
-                stotal, sscore, scomments = self.kpi_3125(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-25: Observation frequency and polarization 
+        stotal, sscore, scomments = self.kpi_3125(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-26: Telecommunication frequency 
-                stotal, sscore, scomments = self.kpi_3126(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-1-26: Telecommunication frequency 
+        stotal, sscore, scomments = self.kpi_3126(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
                 
-                # Rule 3-1-27: Data generation
-                stotal, sscore, scomments = self.kpi_3127(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
-
-                LOGGER.debug("deployment number %s, total: %s, score: %s" % (i, el_total, el_score))
-                total += el_total
-                score += el_score
+        # Rule 3-1-27: Data generation
+        stotal, sscore, scomments = self.kpi_3127(instance,deployment_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-            total = total / len(OM_Observations)
-            score = score / len(OM_Observations)
-        return name, total, score, comments, number_of_deployments
+        LOGGER.debug("deployment number %s, total: %s, score: %s" % (deployment_number, el_total, el_score))
+        return el_total, el_score, comments
 
     def kpi_3100(self,instance,deployment_number):
         total = 1
@@ -1337,8 +1471,7 @@ class WMDRKeyPerformanceIndicators:
         score = 0
         comments = []
         # check observation only
-        xpath = './om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment/wmdr:deployedEquipment/wmdr:Equipment/wmdr:frequency/wmdr:Frequencies/wmdr:purposeOfFrequencyUse'
-        value = get_href_and_validate(instance,xpath,self.namespaces,self.codelists["PurposeOfFrequencyUse"],"deployment number %s purpose of frequency use" % deployment_number)[2]
+        value = self._purpose_of_frequency_use(instance,deployment_number)
         if value == 'observation':
             xpath1 = './om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment/wmdr:deployedEquipment/wmdr:Equipment/wmdr:frequency/wmdr:Frequencies/wmdr:frequencyUse'
             score1, comments1, value1 = get_href_and_validate(instance,xpath1,self.namespaces,self.codelists["FrequencyUse"],"deployment number %s frequency use" % deployment_number)
@@ -1374,8 +1507,7 @@ class WMDRKeyPerformanceIndicators:
         score = 0
         comments = []
         # check telecomms only
-        xpath = './om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment/wmdr:deployedEquipment/wmdr:Equipment/wmdr:frequency/wmdr:Frequencies/wmdr:purposeOfFrequencyUse'
-        value = get_href_and_validate(instance,xpath,self.namespaces,self.codelists["PurposeOfFrequencyUse"],"deployment number %s purpose of frequency use" % deployment_number)[2]
+        value = self._purpose_of_frequency_use(instance,deployment_number)
         if value == 'telecomms':
             xpath1 = './om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment/wmdr:deployedEquipment/wmdr:Equipment/wmdr:frequency/wmdr:Frequencies/wmdr:frequencyUse'
             score1, comments1, value1 = get_href_and_validate(instance,xpath1,self.namespaces,self.codelists["FrequencyUse"],"deployment number %s frequency use" % deployment_number)
@@ -1448,197 +1580,210 @@ class WMDRKeyPerformanceIndicators:
         name = 'KPI-3-3: Data generation'
         LOGGER.info(f'Running {name}')
         
-        # get dataGenerations
-        dataGenerations = self.exml.xpath('./wmdr:facility/wmdr:ObservingFacility/wmdr:observation/wmdr:ObservingCapability/wmdr:observation/om:OM_Observation/om:procedure/wmdr:Process/wmdr:deployment/wmdr:Deployment/wmdr:dataGeneration/wmdr:DataGeneration',namespaces=self.namespaces)
-        if not len(dataGenerations):
+        data_generations = self.instance_scores.get('data_generations')
+        if data_generations is None:
+            # get dataGenerations
+            dataGenerations = []
+            for deployment in self.deployments:
+                dataGenerations += deployment.xpath('./wmdr:dataGeneration/wmdr:DataGeneration',namespaces=self.namespaces)
+            data_generations = [self.score_data_generation(instance,i) for i, instance in enumerate(dataGenerations,1)]
+        if not len(data_generations):
             comments.append("dataGeneration not found")
             total = 24
             return name, total, 0, comments, 0
         else:
         # compute kpi for each dataGeneration instance
-            number_of_data_generations = len(dataGenerations)
-            i = 0
-            for instance in dataGenerations:
-                i += 1
-                # LOGGER.debug(instance)
-                el_total = 0
-                el_score = 0
-                # Rule 3-3-00: Sampling strategy
-                stotal, sscore, scomments = self.kpi_3300(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+            number_of_data_generations = len(data_generations)
+            for el_total, el_score, el_comments in data_generations:
+                total += el_total
+                score += el_score
+                comments = comments + el_comments
+        total = total / len(data_generations)
+        score = score / len(data_generations)
+        return name, total, score, comments, number_of_data_generations
 
-                # Rule 3-3-01: Sampling interval 
-                stotal, sscore, scomments = self.kpi_3301(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+    def score_data_generation(self, instance, data_generation_number) -> tuple:
+        """
+        Scores a DataGeneration instance against the rules of KPI-3-3
+
+        :returns: `tuple` of total score, achieved score and comments
+        """
+        comments = []
+        # LOGGER.debug(instance)
+        el_total = 0
+        el_score = 0
+        # Rule 3-3-00: Sampling strategy
+        stotal, sscore, scomments = self.kpi_3300(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
+
+        # Rule 3-3-01: Sampling interval 
+        stotal, sscore, scomments = self.kpi_3301(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
                 
-                # Rule 3-3-02: Sampling period
-                stotal, sscore, scomments = self.kpi_3302(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-02: Sampling period
+        stotal, sscore, scomments = self.kpi_3302(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-03: Spatial sampling resolution 
-                stotal, sscore, scomments = self.kpi_3303(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        # Rule 3-3-03: Spatial sampling resolution 
+        stotal, sscore, scomments = self.kpi_3303(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-04: Sampling procedure
-                stotal, sscore, scomments = self.kpi_3304(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-04: Sampling procedure
+        stotal, sscore, scomments = self.kpi_3304(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-05: Sample treatment
-                stotal, sscore, scomments = self.kpi_3305(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-3-05: Sample treatment
+        stotal, sscore, scomments = self.kpi_3305(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-3-06: Aggregation period
-                stotal, sscore, scomments = self.kpi_3306(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-06: Aggregation period
+        stotal, sscore, scomments = self.kpi_3306(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-07: Data processing method 
-                stotal, sscore, scomments = self.kpi_3307(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        # Rule 3-3-07: Data processing method 
+        stotal, sscore, scomments = self.kpi_3307(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
                 
-                # Rule 3-3-08: Software/processor and version
-                stotal, sscore, scomments = self.kpi_3308(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-08: Software/processor and version
+        stotal, sscore, scomments = self.kpi_3308(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-09: Software/source code repository URL 
-                stotal, sscore, scomments = self.kpi_3309(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-3-09: Software/source code repository URL 
+        stotal, sscore, scomments = self.kpi_3309(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-3-10: Processing/analysis centre
-                stotal, sscore, scomments = self.kpi_3310(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-10: Processing/analysis centre
+        stotal, sscore, scomments = self.kpi_3310(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Reporting
+        # Reporting
 
-                # Rule 3-3-11: Diurnal base time 
-                stotal, sscore, scomments = self.kpi_3311(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-3-11: Diurnal base time 
+        stotal, sscore, scomments = self.kpi_3311(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-3-12: Number of observations in reporting period
-                stotal, sscore, scomments = self.kpi_3312(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-12: Number of observations in reporting period
+        stotal, sscore, scomments = self.kpi_3312(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-13: Measurement unit 
-                stotal, sscore, scomments = self.kpi_3313(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-3-13: Measurement unit 
+        stotal, sscore, scomments = self.kpi_3313(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-3-14: Data policy
-                stotal, sscore, scomments = self.kpi_3314(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-14: Data policy
+        stotal, sscore, scomments = self.kpi_3314(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-15: Spatial reporting interval 
-                stotal, sscore, scomments = self.kpi_3315(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        # Rule 3-3-15: Spatial reporting interval 
+        stotal, sscore, scomments = self.kpi_3315(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-16: Timeliness (Latency of reporting)
-                stotal, sscore, scomments = self.kpi_3316(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-16: Timeliness (Latency of reporting)
+        stotal, sscore, scomments = self.kpi_3316(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-17: Numerical resolution 
-                stotal, sscore, scomments = self.kpi_3317(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        # Rule 3-3-17: Numerical resolution 
+        stotal, sscore, scomments = self.kpi_3317(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-18: Level of data
-                stotal, sscore, scomments = self.kpi_3318(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-18: Level of data
+        stotal, sscore, scomments = self.kpi_3318(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-19: Data format 
-                stotal, sscore, scomments = self.kpi_3319(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments
+        # Rule 3-3-19: Data format 
+        stotal, sscore, scomments = self.kpi_3319(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments
 
-                # Rule 3-3-20: Data format version
-                stotal, sscore, scomments = self.kpi_3320(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-20: Data format version
+        stotal, sscore, scomments = self.kpi_3320(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-21: Reference datum 
-                stotal, sscore, scomments = self.kpi_3321(instance,i)
-                el_total  += stotal
-                el_score  += sscore
-                comments = comments + scomments 
+        # Rule 3-3-21: Reference datum 
+        stotal, sscore, scomments = self.kpi_3321(instance,data_generation_number)
+        el_total  += stotal
+        el_score  += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-22: Reference time source
-                stotal, sscore, scomments = self.kpi_3322(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
-
-                # Rule 3-3-23: 
-                # stotal, sscore, scomments = self.kpi_3323(instance,i)
-                # el_total  += stotal
-                # el_score  += sscore
-                # comments = comments + scomments 
-
-                # Rule 3-3-24: 
-                # stotal, sscore, scomments = self.kpi_3324(instance,i)
-                # el_total += stotal
-                # el_score += sscore
-                # comments = comments + scomments 
-
-                # Rule 3-3-25:  
-                # stotal, sscore, scomments = self.kpi_3325(instance,i)
-                # el_total  += stotal
-                # el_score  += sscore
-                # comments = comments + scomments 
-
-                # Rule 3-3-26: Meaning of timestamp in data reports
-                stotal, sscore, scomments = self.kpi_3326(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-22: Reference time source
+        stotal, sscore, scomments = self.kpi_3322(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
 
-                # Rule 3-3-27: Attribution
-                stotal, sscore, scomments = self.kpi_3327(instance,i)
-                el_total += stotal
-                el_score += sscore
-                comments = comments + scomments 
+        # Rule 3-3-23: 
+        # stotal, sscore, scomments = self.kpi_3323(instance,data_generation_number)
+        # el_total  += stotal
+        # el_score  += sscore
+        # comments = comments + scomments 
+
+        # Rule 3-3-24: 
+        # stotal, sscore, scomments = self.kpi_3324(instance,data_generation_number)
+        # el_total += stotal
+        # el_score += sscore
+        # comments = comments + scomments 
+
+        # Rule 3-3-25:  
+        # stotal, sscore, scomments = self.kpi_3325(instance,data_generation_number)
+        # el_total  += stotal
+        # el_score  += sscore
+        # comments = comments + scomments 
+
+        # Rule 3-3-26: Meaning of timestamp in data reports
+        stotal, sscore, scomments = self.kpi_3326(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
+
+        # Rule 3-3-27: Attribution
+        stotal, sscore, scomments = self.kpi_3327(instance,data_generation_number)
+        el_total += stotal
+        el_score += sscore
+        comments = comments + scomments 
                 
-                LOGGER.debug("data generation number %s, total: %s, score: %s" % (i, el_total, el_score))
-                total += el_total
-                score += el_score
-        total = total / len(dataGenerations)
-        score = score / len(dataGenerations)
-        return name, total, score, comments, number_of_data_generations
+        LOGGER.debug("data generation number %s, total: %s, score: %s" % (data_generation_number, el_total, el_score))
+        return el_total, el_score, comments
 
     def kpi_3300(self, instance, data_generation_number):
         total = 1
@@ -2125,9 +2270,8 @@ class WMDRKeyPerformanceIndicators:
         # 5 - 10 observations (score: 2)
         # More than 10 observations (score: 3)
 
-        xpath = '//wmdr:observation/wmdr:ObservingCapability/wmdr:observation'
         element_name = "observation"
-        matches = self.exml.xpath(xpath,namespaces=self.namespaces)
+        matches = self.observations
         if(not len(matches)):
             LOGGER.debug("%s not found" % element_name)
             comments.append("%s not found" % element_name)
@@ -2152,9 +2296,8 @@ class WMDRKeyPerformanceIndicators:
         # Rule 6-0-02 Application area(s). Deployment has more than one application area.
         # 1 (for each deployment)
         
-        xpath = '//wmdr:deployment/wmdr:Deployment'
         element_name = "deployment"
-        deployments = self.exml.xpath(xpath,namespaces=self.namespaces)
+        deployments = self.deployments
         if(not len(deployments)):
             LOGGER.debug("%s not found" % element_name)
             comments.append("%s not found" % element_name)
@@ -2192,9 +2335,10 @@ class WMDRKeyPerformanceIndicators:
         # NOTE missing criteria for what is considered near real time, using 24 hours
         time_interval = timedelta(days=1)
 
-        xpath = '//wmdr:deployment/wmdr:Deployment/wmdr:validPeriod/gml:TimePeriod/gml:endPosition'
         element_name = "end position of deployment valid period"
-        matches = self.exml.xpath(xpath,namespaces=self.namespaces)
+        matches = []
+        for deployment in self.deployments:
+            matches += deployment.xpath('./wmdr:validPeriod/gml:TimePeriod/gml:endPosition',namespaces=self.namespaces)
         if(not len(matches)):
             LOGGER.debug("%s not found" % element_name)
             comments.append("%s not found" % element_name)
@@ -2244,34 +2388,13 @@ class WMDRKeyPerformanceIndicators:
         :returns: `dict` of overall test report
         """
 
-        known_kpis = [
-            'kpi_10',
-            'kpi_20',
-            'kpi_21',
-            'kpi_30',
-            'kpi_31',
-            'kpi_32',
-            'kpi_33',
-            'kpi_34',
-            'kpi_40',
-            'kpi_41',
-            'kpi_50',
-            'kpi_60'
-        ]
-
-        kpis_to_run = known_kpis
+        kpis_to_run = list(KNOWN_KPIS)
 
         if skip_schema_eval:
             kpis_to_run.remove('kpi_10')
 
         if kpi != 0:
-            selected_kpi = f'kpi_{kpi:02}'
-            if selected_kpi not in known_kpis:
-                msg = f'Invalid KPI number: {selected_kpi} is not in {known_kpis}'
-                LOGGER.error(msg)
-                raise ValueError(msg)
-            else:
-                kpis_to_run = [selected_kpi]
+            kpis_to_run = [check_kpi_number(kpi)]
 
         LOGGER.info(f'Evaluating KPIs: {kpis_to_run}')
 
@@ -2343,6 +2466,115 @@ def generate_summary(results: dict) -> dict:
     return summary
 
 
+# per-instance KPIs which can be evaluated while the document is streamed:
+# path (below the WIGOSMetadataRecord) of the instances scored, name of their
+# scores (see WMDRKeyPerformanceIndicators.instance_scores) and paths of
+# instances not used by the KPI, which are released unscored
+OBSERVATION_PATH = ('wmdr:facility', 'wmdr:ObservingFacility', 'wmdr:observation',
+                    'wmdr:ObservingCapability', 'wmdr:observation', 'om:OM_Observation')
+DATA_GENERATION_PATH = OBSERVATION_PATH + ('om:procedure', 'wmdr:Process', 'wmdr:deployment',
+                                           'wmdr:Deployment', 'wmdr:dataGeneration',
+                                           'wmdr:DataGeneration')
+LOG_ENTRY_PATH = ('wmdr:facility', 'wmdr:ObservingFacility', 'wmdr:facilityLog',
+                  'wmdr:FacilityLog', 'wmdr:logEntry')
+STREAMING_KPIS = {
+    20: (LOG_ENTRY_PATH, 'log_entries', [OBSERVATION_PATH]),
+    31: (OBSERVATION_PATH, 'deployments', []),
+    33: (DATA_GENERATION_PATH, 'data_generations', [OBSERVATION_PATH])
+}
+
+
+def _clark_tags(path: tuple, namespaces: dict) -> tuple:
+    """
+    Helper function to expand the prefixed names of a path into tags
+    """
+
+    tags = []
+    for name in path:
+        prefix, local_name = name.split(':')
+        tags.append(f'{{{namespaces.get(prefix)}}}{local_name}')
+    return tuple(tags)
+
+
+def _is_at_path(element, record, tags: tuple) -> bool:
+    """
+    Helper function to check the path of an element below the record
+
+    :param tags: `tuple` of Clark notation tags from the record down
+    """
+
+    for tag in reversed(tags):
+        if element is None or element.tag != tag:
+            return False
+        element = element.getparent()
+    return element is record
+
+
+def evaluate_streaming(source, kpi: int, huge_tree: bool = False) -> dict:
+    """
+    Evaluates a per-instance KPI of a WMDR document with bounded memory:
+    KPI 20 (whose rule 2-0-12 scores each log entry), 31 (each deployment)
+    or 33 (each data generation). The document is parsed incrementally and
+    each instance is scored as soon as it is complete, then released, so
+    that peak memory is bounded by the largest instance plus the rest of
+    the record rather than by the whole record
+
+    :param source: filename or binary file-like object of a WMDR document
+    :param kpi: number of the KPI (see `STREAMING_KPIS`)
+    :param huge_tree: parse very large documents (see `get_wmdr_parser`)
+
+    :returns: `dict` of KPI results, as `WMDRKeyPerformanceIndicators.evaluate`
+    """
+
+    if kpi not in STREAMING_KPIS:
+        msg = f'Invalid KPI number: kpi_{kpi:02} is not in {list(STREAMING_KPIS)}'
+        LOGGER.error(msg)
+        raise ValueError(msg)
+    path, scores_name, released_paths = STREAMING_KPIS[kpi]
+    scorers = {
+        'deployments': 'score_deployment',
+        'data_generations': 'score_data_generation',
+        'log_entries': 'score_log_entry'
+    }
+
+    kpis = None
+    record = None
+    scores = []
+    # events only for the records and the instances (matched on their
+    # local names, as the namespaces are known from the record only)
+    local_names = {'WIGOSMetadataRecord'} | {p[-1].split(':')[1] for p in [path] + released_paths}
+    context = etree.iterparse(source, events=('start', 'end'),
+                              tag=[f'{{*}}{name}' for name in sorted(local_names)],
+                              remove_blank_text=True, remove_comments=True,
+                              no_network=True, resolve_entities=False,
+                              huge_tree=huge_tree, collect_ids=False)
+    for event, element in context:
+        if record is None:
+            if event == 'start' and element.tag in WMDR_RECORD_TAGS:
+                # the namespaces are known from the start tag
+                record = element
+                kpis = WMDRKeyPerformanceIndicators(etree.ElementTree(record))
+                score = getattr(kpis, scorers[scores_name])
+                tags = _clark_tags(path, kpis.namespaces)
+                released = [_clark_tags(p, kpis.namespaces) for p in released_paths]
+            continue
+        if event != 'end':
+            continue
+        if element is record:
+            break
+        if element.tag == tags[-1] and _is_at_path(element, record, tags):
+            scores.append(score(element, len(scores) + 1))
+            element.clear(keep_tail=True)
+        elif any(element.tag == r[-1] and _is_at_path(element, record, r)
+                 for r in released):
+            element.clear(keep_tail=True)
+
+    if kpis is None:
+        raise RuntimeError('Does not look like a WMDR document!')
+    kpis.instance_scores[scores_name] = scores
+    return kpis.evaluate(kpi)
+
+
 def calculate_grade(percentage: float) -> str:
     """
     Calculates letter grade from numerical score
@@ -2355,20 +2587,37 @@ def calculate_grade(percentage: float) -> str:
         grade = None
     elif percentage > 100 or percentage < 0:
         raise ValueError('Invalid percentage')
-    elif percentage >= 80:
-        grade = 'A'
-    elif percentage >= 65:
-        grade = 'B'
-    elif percentage >= 50:
-        grade = 'C'
-    elif percentage >= 35:
-        grade = 'D'
-    elif percentage >= 20:
-        grade = 'E'
+    else:
+        for threshold, threshold_grade in zip(GRADE_THRESHOLDS, GRADES[1:]):
+            if percentage >= threshold:
+                grade = threshold_grade
 
     return grade
 
 
+def calculate_grades(percentages) -> numpy.ndarray:
+    """
+    Calculates letter grades from numerical scores, vectorised
+    (same thresholds as calculate_grade)
+
+    :param percentages: sequence of floats between 0-100. Missing
+                        percentages (`None` or NaN) have no grade and are
+                        rejected, they must be mapped by the caller
+
+    :returns: `numpy.ndarray` of indices into GRADES
+    """
+
+    percentages = numpy.asarray(percentages, dtype=float)
+
+    if numpy.any(numpy.isnan(percentages)):
+        raise ValueError('Missing percentage')
+
+    if numpy.any((percentages > 100) | (percentages < 0)):
+        raise ValueError('Invalid percentage')
+
+    return numpy.digitize(percentages, GRADE_THRESHOLDS)
+
+
 def group_kpi_results(kpis_results: dict) -> dict:
     """
     Groups KPI results by category
@@ -2418,7 +2667,10 @@ def kpi():
               help='Group KPIs by into categories')
 @click.option('--url', '-u', help='URL of XML file')
 @click.option('--kpi', '-k', default=0, help='KPI to run, default is all')
-def validate(ctx, file_, summary, group, url, kpi, logfile, verbosity):
+@click.option('--streaming', is_flag=True, default=False,
+              help='Score the instances of KPI 20, 31 or 33 as the document '
+                   'is parsed, with bounded memory')
+def validate(ctx, file_, summary, group, url, kpi, streaming, logfile, verbosity):
     """run key performance indicators"""
 
     if file_ is None and url is None:
@@ -2434,6 +2686,16 @@ def validate(ctx, file_, summary, group, url, kpi, logfile, verbosity):
     elif url is not None:
         content = BytesIO(urlopen_(url).read())
 
+    if streaming:
+        try:
+            kpis_results = evaluate_streaming(content, kpi)
+        except ValueError as err:
+            raise click.UsageError(f'Invalid KPI {kpi}: {err}')
+        except Exception as err:
+            raise click.ClickException(err)
+        click.echo(json.dumps(kpis_results, indent=4))
+        return
+
     try:
         exml = parse_wmdr(content)
     except Exception as err:
@@ -2455,4 +2717,55 @@ def validate(ctx, file_, summary, group, url, kpi, logfile, verbosity):
         click.echo(json.dumps(kpis_results['summary'], indent=4))
 
 
+
+@click.command()
+@click.pass_context
+@get_cli_common_options
+@click.option('--kpi', '-k', default=0, help='KPI to run, default is all')
+@click.option('--skip_schema_eval', '-x', is_flag=True, default=False,
+              help='skip evaluation of schema (kpi 1-01)')
+def stream(ctx, kpi, skip_schema_eval, logfile, verbosity):
+    """
+    run key performance indicators on a stream of records
+
+    Reads WMDR documents from stdin (concatenated files, OAI-PMH
+    ListRecords responses, optionally separated by NUL bytes) and writes
+    one {"name": ..., "result": ...} JSON line per record to stdout as soon
+    as it is evaluated. Errors are reported on stderr
+    """
+
+    setup_logger(verbosity, logfile)
+
+    if kpi != 0:
+        try:
+            check_kpi_number(kpi)
+        except ValueError as err:
+            raise click.UsageError(f'Invalid KPI {kpi}: {err}')
+
+    count = 0
+    failed = 0
+    for identifier, record, error in iter_wmdr_records(sys.stdin.buffer):
+        if error is not None:
+            click.echo(f'Error: invalid document: {error}', err=True)
+            failed += 1
+            continue
+        count += 1
+        try:
+            kpis = WMDRKeyPerformanceIndicators(etree.ElementTree(record))
+            kpis_results = kpis.evaluate(kpi, skip_schema_eval)
+        except Exception as err:
+            # an invalid record does not stop the stream
+            LOGGER.debug(f'evaluation of record {identifier or count} failed', exc_info=True)
+            click.echo(f'Error: evaluation of record {identifier or count} failed: {err}', err=True)
+            failed += 1
+            continue
+        name = f'{identifier or kpis.identifier or "record_%i" % count}.xml'
+        sys.stdout.write(json.dumps({'name': name, 'result': kpis_results}, separators=(',', ':')))
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+    LOGGER.info(f'{count} records read, {failed} failed')
+
+
 kpi.add_command(validate)
+kpi.add_command(stream)
@@ -1,16 +1,28 @@
 from lxml import etree
+from io import BytesIO
 import os
-from pywmdr.kpi import WMDRKeyPerformanceIndicators
+from pywmdr.kpi import WMDRKeyPerformanceIndicators, ROUND, GRADES, calculate_grades
+from pywmdr.harvest import readTombstones
+from pywmdr.store import RecordStore, content_hash
+from pywmdr.results import RESULTS_FORMATS, openResultsWriter, isJsonLines, iterJsonLines, isColumnar, iterColumnarResults, isResultsDatabase, iterSQLiteResults, parseFilters, queryResults
 import pywmdr.util as util
 import glob
 import json
 import re
-import jsonschema
 import traceback
 import click
+import zlib
+import math
+import numpy
 
 def parseAndEvaluate(filename,output=None,selected_kpi : int=None,skip_schema_eval=False):
-    exml = etree.parse(filename)
+    exml = etree.parse(filename,util.get_wmdr_parser())
+    return evaluateTree(exml,output=output,selected_kpi=selected_kpi,skip_schema_eval=skip_schema_eval)
+
+def evaluateTree(exml,output=None,selected_kpi : int=None,skip_schema_eval=False):
+    """
+    Evaluates the KPIs of an already parsed WMDR document (etree.ElementTree)
+    """
     try:
         kpi = WMDRKeyPerformanceIndicators(exml)
     except Exception:
@@ -27,54 +39,317 @@ def parseAndEvaluate(filename,output=None,selected_kpi : int=None,skip_schema_ev
         f.close()
     return result
 
-def parseAndEvaluateFiles(file_pattern,output_dir=None,selected_kpi : int=None,skip_schema_eval=False,return_results=False):
-    files = glob.glob(file_pattern)
-    if not len(files):
-        print("Error: no files matched the pattern")
-        return
+def isTombstoned(file,result,tombstones):
+    """
+    Checks whether a record file (or its evaluation) belongs to a station deleted at the OAI provider
+
+    :param file: record file (<identifier>.xml) or evaluation file (<identifier>.xml_eval.json)
+    :param result: evaluation result or None
+    :param tombstones: dict of deleted identifiers as written by the harvester
+    """
+    if not tombstones:
+        return False
+    identifier = re.sub("(\.xml)?(_eval\.json)?$","",os.path.basename(file))
+    if identifier in tombstones:
+        return True
+    if result is not None and "summary" in result and result["summary"]["identifier"] in tombstones:
+        return True
+    return False
+
+def parseShard(shard):
+    """
+    Parses a shard specification i/N (1 <= i <= N)
+
+    :returns: (i, N) tuple
+    """
+    match = re.match(r"^(\d+)/(\d+)$",shard)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError("Invalid shard %s, expected i/N with 1 <= i <= N" % shard)
+    return int(match.group(1)), int(match.group(2))
+
+def inShard(identifier,shard):
+    """
+    Checks whether a record (or evaluation) belongs to a shard. Records are assigned to shards by a stable hash of their identifier, so that every machine splits a corpus the same way, whether it evaluates records or reads saved results
+
+    :param identifier: WIGOS identifier of the station (summary.identifier of the evaluation, see resultIdentifier, or read from the record by pywmdr.util.read_wmdr_identifier)
+    :param shard: (i, N) tuple or None (no sharding)
+    """
+    if shard is None:
+        return True
+    return zlib.crc32((identifier or "").encode()) % shard[1] == shard[0] - 1
+
+def resultIdentifier(result):
+    """
+    Shard key of an evaluation result
+    """
+    return result["summary"]["identifier"] if result is not None and "summary" in result else ""
+
+class EvaluationManifest:
+    """
+    Signatures of the records evaluated into an output directory (size and modification time of record files, optionally a sha256 of their content), along with the evaluation options, so that an incremental run evaluates only new or changed records. With use_hash, a file whose modification time changed but not its content is not evaluated again. Saved atomically as JSON
+    """
+
+    def __init__(self,filename,options,use_hash=False):
+        self.filename = filename
+        self.options = options
+        self.use_hash = use_hash
+        self.records = {}
+        self.skipped = 0
+        self.evaluated = 0
+        if os.path.exists(filename):
+            f = open(filename)
+            content = json.load(f)
+            f.close()
+            if content["options"] == options:
+                self.records = content["records"]
+            else:
+                print("evaluation options changed since the last run, all records are evaluated")
+
+    def signature(self,source):
+        """
+        :param source: record filename, file-like object (records of a store) or element (records of a ListRecords page). The records of stores and pages are always hashed
+        """
+        if isinstance(source,str):
+            stat = os.stat(source)
+            return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        content = self.content(source)
+        return {"size": len(content), "sha256": content_hash(content)}
+
+    def content(self,source):
+        if isinstance(source,str):
+            f = open(source,"rb")
+            content = f.read()
+            f.close()
+            return content
+        if isinstance(source,etree._Element):
+            return etree.tostring(source)
+        return source.getvalue()
+
+    def contentHash(self,source):
+        return content_hash(self.content(source))
+
+    def isUnchanged(self,name,source,signature):
+        previous = self.records.get(name)
+        if previous is None:
+            return False
+        if all(previous.get(key) == value for key, value in signature.items()):
+            return True
+        if self.use_hash and "sha256" in previous and "sha256" not in signature and previous["size"] == signature["size"]:
+            signature["sha256"] = self.contentHash(source)
+            if signature["sha256"] == previous["sha256"]:
+                # touched but not modified
+                self.records[name] = signature
+                return True
+        return False
+
+    def update(self,name,source,signature):
+        if self.use_hash and "sha256" not in signature:
+            signature["sha256"] = self.contentHash(source)
+        self.records[name] = signature
+
+    def save(self):
+        f = open("%s.tmp" % self.filename,"w")
+        json.dump({"options": self.options, "records": self.records},f)
+        f.close()
+        os.replace("%s.tmp" % self.filename,self.filename)
+        print("incremental evaluation: %i records evaluated, %i unchanged records skipped" % (self.evaluated,self.skipped))
+
+def readPreviousResult(name,output_dir=None,writer=None):
+    """
+    :returns: the result saved for the record name by a previous run (in the writer, or as <output_dir>/<name>_eval.json), None if missing
+    """
+    if writer is not None:
+        return writer.get(name) if hasattr(writer,"get") else None
+    filename = "%s/%s_eval.json" % (output_dir, name)
+    if output_dir is None or not os.path.exists(filename):
+        return None
+    f = open(filename)
+    result = json.load(f)
+    f.close()
+    return result
+
+def evaluateRecords(records,output_dir=None,selected_kpi : int=None,skip_schema_eval=False,return_results=False,tombstones=None,accumulator=None,shard=None,writer=None,manifest=None):
+    """
+    Evaluates a sequence of records and saves each result as <output_dir>/<name>_eval.json
+
+    :param records: iterable of (name, source) tuples, where source is a filename, a file-like object or a WIGOSMetadataRecord element
+    :param accumulator: MetricsAccumulator fed with each result
+    :param shard: evaluate only the records of this (i, N) shard (see inShard)
+    :param writer: results sink (see pywmdr.results) used instead of the per-record files
+    :param manifest: EvaluationManifest. Records unchanged since their saved result was evaluated are skipped, and the saved result is used instead
+    """
     results = []
-    for file in files:
+    for name, source in records:
+        if isTombstoned(name,None,tombstones):
+            continue
+        if manifest is not None:
+            signature = manifest.signature(source)
+            result = readPreviousResult(name,output_dir=output_dir,writer=writer) if manifest.isUnchanged(name,source,signature) else None
+            if result is not None:
+                if not inShard(resultIdentifier(result),shard):
+                    continue
+                manifest.skipped += 1
+                if accumulator is not None:
+                    accumulator.add(result)
+                if return_results:
+                    results.append(result)
+                continue
+        # the shard of a record is read from its first tags, so that each shard parses only its own records
+        if shard is not None and not inShard(util.read_wmdr_identifier(source),shard):
+            continue
         try:
-            result = parseAndEvaluate(file,selected_kpi=selected_kpi,skip_schema_eval=skip_schema_eval)
+            if isinstance(source,etree._Element):
+                exml = etree.ElementTree(source)
+            else:
+                exml = etree.parse(source,util.get_wmdr_parser())
+            result = evaluateTree(exml,selected_kpi=selected_kpi,skip_schema_eval=skip_schema_eval)
         except Exception:
             print("Error: kpi evaluation failed:")
             traceback.print_exc()
             continue
+        if isTombstoned(name,result,tombstones):
+            continue
+        if accumulator is not None and result is not None:
+            accumulator.add(result)
         if(return_results):
             results.append(result)
-        if output_dir is not None:
-            filename = "%s/%s_eval.json" % (output_dir, file.split("/")[-1])
+        if writer is not None:
+            writer.add(name,result)
+        elif output_dir is not None:
+            filename = "%s/%s_eval.json" % (output_dir, name)
             f = open(filename,"w")
             json.dump(result,f,indent=2)
             f.close()
+        if manifest is not None and result is not None:
+            manifest.evaluated += 1
+            manifest.update(name,source,signature)
     if return_results:
         return results
     else:
         return
 
-def getPercentiles(values : list,perc = [5,10,25,50,75,95]):
+def iterPageRecords(file):
+    """
+    Streams the records of a saved ListRecords page as (name, element) tuples for evaluateRecords, parsing the page once, incrementally (see pywmdr.util.iter_wmdr_records). The name of a record is <OAI identifier>.xml, as for the record files written by pywmdr harvest
+    """
+    count = 0
+    f = open(file,"rb")
+    try:
+        for identifier, record, error in util.iter_wmdr_records(f):
+            if error is not None:
+                print("Error: %s: %s" % (file,error))
+                continue
+            count += 1
+            yield "%s.xml" % (identifier or "%s_%i" % (re.sub(r"\.xml$","",os.path.basename(file)),count)), record
+    finally:
+        f.close()
+
+def iterFileRecords(files):
+    """
+    Streams record files and the records of saved ListRecords pages as (name, source) tuples for evaluateRecords. Files are routed from their first tags (see pywmdr.util.sniff_wmdr), and files that are not WMDR documents are rejected, without being evaluated. A record found in more than one file (e.g. both in a page and split to its own file by pywmdr harvest) is evaluated once
+    """
+    seen = set()
+    duplicates = 0
+    for file in files:
+        kind = util.sniff_wmdr(file)
+        if kind is None:
+            print("Error: %s does not look like a WMDR document" % file)
+            continue
+        records = iterPageRecords(file) if kind == "oai" else [(file.split("/")[-1], file)]
+        for name, source in records:
+            if name in seen:
+                duplicates += 1
+                continue
+            seen.add(name)
+            yield name, source
+    if duplicates:
+        print("%i records found in more than one file evaluated once" % duplicates)
+
+def parseAndEvaluateFiles(file_pattern,output_dir=None,selected_kpi : int=None,skip_schema_eval=False,return_results=False,tombstones=None,accumulator=None,shard=None,writer=None,manifest=None):
+    """
+    Evaluates the record files and saved ListRecords pages (evaluated in place, without splitting them) matching file_pattern
+    """
+    files = glob.glob(file_pattern)
+    if not len(files):
+        print("Error: no files matched the pattern")
+        return
+    records = iterFileRecords(files)
+    return evaluateRecords(records,output_dir=output_dir,selected_kpi=selected_kpi,skip_schema_eval=skip_schema_eval,return_results=return_results,tombstones=tombstones,accumulator=accumulator,shard=shard,writer=writer,manifest=manifest)
+
+def iterStoreRecords(store_file):
+    """
+    Streams the records of a packed record store (see pywmdr.store) as (name, source) tuples for evaluateRecords
+    """
+    store = RecordStore(store_file,read_only=True)
+    try:
+        for identifier, datestamp, content in store.iter_records():
+            yield "%s.xml" % identifier, BytesIO(content)
+    finally:
+        store.close()
+
+def parseAndEvaluateStore(store_file,output_dir=None,selected_kpi : int=None,skip_schema_eval=False,return_results=False,tombstones=None,accumulator=None,shard=None,writer=None,manifest=None):
+    return evaluateRecords(iterStoreRecords(store_file),output_dir=output_dir,selected_kpi=selected_kpi,skip_schema_eval=skip_schema_eval,return_results=return_results,tombstones=tombstones,accumulator=accumulator,shard=shard,writer=writer,manifest=manifest)
+
+def parseAndEvaluatePath(path,**kwargs):
+    """
+    Evaluates either a packed record store or all files matching a pattern
+    """
+    if os.path.isfile(path) and RecordStore.is_store(path):
+        return parseAndEvaluateStore(path,**kwargs)
+    return parseAndEvaluateFiles(path,**kwargs)
+
+PERCENTILE_METHODS = ["legacy","linear","lower","higher","nearest","midpoint"]
+
+GRADE_LETTERS = ["A","B","C","D","E","F","U"]
+
+# summary dimensions of the grouped metrics. The issuer is the WIGOS identifier issuer (e.g. 20000 of 0-20000-0-03672)
+GROUP_BY_FIELDS = ["region","country","organisation","issuer"]
+
+def getPercentiles(values : list,perc = [5,10,25,50,75,95],method="legacy"):
+    """
+    Percentiles of a list of percentages (None counts as 0)
+
+    :param method: "legacy" takes the value of rank int(p / 100 * count) of the sorted values (as given, int or float), the other methods are those of numpy.percentile (float)
+    """
     values_ = [0 if x is None else x for x in values]
-    values_.sort()
     count = len(values_)
     percentiles = {}
-    for p in perc:
-        percentiles[p] = None
-    for p in percentiles:
-        p_index = int(int(p) / 100 * count)
+    if not count:
+        return percentiles
+    array = numpy.array(values_,dtype=float)
+    ranks = (numpy.array(perc,dtype=float) / 100 * count).astype(int)
+    if method == "legacy":
+        order = numpy.argsort(array,kind="stable")
+        perc_values = [values_[i] for i in order[ranks]]
+    else:
+        perc_values = [float(x) for x in numpy.percentile(array,perc,method=method)]
+    for p, rank, value in zip(perc,ranks,perc_values):
         percentiles[p] = {
-            "count": p_index,
-            "value": values_[p_index]
+            "count": int(rank),
+            "value": value
         }
     return percentiles
 
-def getKPIStats(results):
+def getGradeCounts(grade_counts,letters,count):
+    return {letter: {"count": int(grade_count), "percentage": int(grade_count) / count * 100} for letter, grade_count in zip(letters,grade_counts)}
+
+def getPercentageGradeCounts(percentages,weights=None):
+    """
+    Counts of the grades A to F of an array of percentages (vectorised calculate_grade)
+    """
+    grade_counts = numpy.bincount(calculate_grades(percentages),weights=weights,minlength=len(GRADES))
+    count = numpy.sum(grade_counts)
+    # GRADES goes from F to A
+    return getGradeCounts(grade_counts[::-1],GRADES[::-1],count)
+
+def getKPIStats(results,method="legacy"):
     totals = [x["total"] for x in results]
     scores = [x["score"] for x in results]
     percentages = [0 if x["percentage"] is None else x["percentage"] for x in results]
-    percentiles = getPercentiles(percentages)
+    percentiles = getPercentiles(percentages,method=method)
     count = len(results)
-    average_score = sum(scores) / count
-    average_percentage = sum(percentages) / count
+    average_score = math.fsum(scores) / count
+    average_percentage = math.fsum(percentages) / count
     return {
         "name": results[0]["name"] if len(results) else None,
         "count": count,
@@ -83,11 +358,17 @@ def getKPIStats(results):
         "percentages": percentages,
         "percentiles": percentiles,
         "average_score": average_score,
-        "average_percentage": average_percentage
+        "average_percentage": average_percentage,
+        "grade_counts": getPercentageGradeCounts(percentages)
     }
 
 
-def getMetrics(results):
+def getMetrics(results,method="legacy",group_by=None):
+    """
+    :param group_by: one of GROUP_BY_FIELDS. If given, the metrics are computed per group in one pass, without the per-station lists (see GroupedMetricsAccumulator)
+    """
+    if group_by is not None:
+        return getMetricsStreaming(results,method=method,group_by=group_by)
     identifier = []
     organisation = []
     country = []
@@ -122,19 +403,16 @@ def getMetrics(results):
             else:
                 kpis[kpi].append(result[kpi])
     if len(totals):
-        grade_counts = {"A":None,"B":None,"C":None,"D":None,"E":None,"F":None,"U":None}
-        for id in grade_counts:
-            grade_count = len([x for x in grades if x == id])
-            grade_counts[id] = {
-                "count": grade_count,
-                "percentage": grade_count / count * 100
-            }
-        percentiles = getPercentiles(percentages)
-        average_percentage = sum(percentages) / count
-        average_score = sum(scores) / count
+        # unknown grades are counted apart, at index len(GRADE_LETTERS)
+        grade_index = {letter: i for i, letter in enumerate(GRADE_LETTERS)}
+        grade_bins = numpy.bincount(numpy.array([grade_index.get(x,len(GRADE_LETTERS)) for x in grades]),minlength=len(GRADE_LETTERS)+1)
+        grade_counts = getGradeCounts(grade_bins[:len(GRADE_LETTERS)],GRADE_LETTERS,count)
+        percentiles = getPercentiles(percentages,method=method)
+        average_percentage = math.fsum([0 if x is None else x for x in percentages]) / count
+        average_score = math.fsum(scores) / count
     kpi_stats = {}
     for kpi in kpis:
-        kpi_stats[kpi] = getKPIStats(kpis[kpi])
+        kpi_stats[kpi] = getKPIStats(kpis[kpi],method=method)
     if len(totals):
         return {
             "identifier": identifier,
@@ -159,22 +437,429 @@ def getMetrics(results):
             "kpi": kpi_stats 
         }
 
-def readResults(file_pattern):
-    results = []
+class ExactSum:
+    """
+    Sum of floats that does not depend on the order of the values (the partials of math.fsum), so that merged partial sums equal the sum of the whole corpus
+    """
+
+    def __init__(self,partials=None):
+        self.partials = list(partials or [])
+
+    def add(self,x):
+        partials = []
+        for y in self.partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials.append(lo)
+            x = hi
+        partials.append(x)
+        self.partials = partials
+
+    def merge(self,other):
+        for x in other.partials:
+            self.add(x)
+
+    def value(self):
+        return math.fsum(self.partials)
+
+class PercentageHistogram:
+    """
+    Mergeable quantile sketch of percentages: counts per distinct value, at the rounding of the KPI percentages (pywmdr.kpi.ROUND). Memory is bounded by the number of distinct values (at most 100 * 10 ** ROUND + 1) whatever the number of results, and the percentiles are the same as those of getPercentiles
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+
+    def add(self,value):
+        value = 0 if value is None else round(value,ROUND)
+        self.counts[value] = self.counts.get(value,0) + 1
+        self.count += 1
+
+    def merge(self,other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value,0) + count
+        self.count += other.count
+
+    def toDict(self):
+        return {"count": self.count, "counts": [[value, count] for value, count in sorted(self.counts.items())]}
+
+    @staticmethod
+    def fromDict(state):
+        histogram = PercentageHistogram()
+        histogram.count = state["count"]
+        histogram.counts = {value: count for value, count in state["counts"]}
+        return histogram
+
+    def arrays(self):
+        """
+        :returns: sorted distinct values and their counts as numpy arrays
+        """
+        values = numpy.array(sorted(self.counts),dtype=float)
+        return values, numpy.array([self.counts[x] for x in values],dtype=int)
+
+    def percentiles(self,perc = [5,10,25,50,75,95],method="legacy"):
+        """
+        Same percentiles as getPercentiles (with the same methods) of the values added to the histogram
+        """
+        percentiles = {}
+        if not self.count:
+            return percentiles
+        values, counts = self.arrays()
+        # the values as added (int or float), as getPercentiles returns them
+        keys = sorted(self.counts)
+        cumulative = numpy.cumsum(counts)
+        def valueAt(rank):
+            return keys[numpy.searchsorted(cumulative,rank,side="right")]
+        for p in perc:
+            rank = int(int(p) / 100 * self.count)
+            if method == "legacy":
+                value = valueAt(rank)
+            else:
+                # virtual index and interpolation of numpy.percentile
+                h = (self.count - 1) * (p / 100)
+                lower = valueAt(math.floor(h))
+                upper = valueAt(math.ceil(h))
+                t = h - math.floor(h)
+                if method == "linear":
+                    value = upper - (upper - lower) * (1 - t) if t >= 0.5 else lower + (upper - lower) * t
+                elif method == "lower":
+                    value = lower
+                elif method == "higher":
+                    value = upper
+                elif method == "nearest":
+                    value = valueAt(int(numpy.around(h)))
+                elif method == "midpoint":
+                    value = upper - (upper - lower) * 0.5
+                else:
+                    raise ValueError("Bad method. choices: %s" % ", ".join(PERCENTILE_METHODS))
+                value = float(value)
+            percentiles[p] = {
+                "count": rank,
+                "value": value
+            }
+        return percentiles
+
+    def gradeCounts(self):
+        values, counts = self.arrays()
+        return getPercentageGradeCounts(values,weights=counts)
+
+class KPIAccumulator:
+    """Online statistics of the results of one KPI"""
+
+    def __init__(self,name=None):
+        self.name = name
+        self.count = 0
+        self.sum_score = ExactSum()
+        self.sum_percentage = ExactSum()
+        self.histogram = PercentageHistogram()
+
+    def add(self,result):
+        if self.name is None:
+            self.name = result["name"]
+        self.count += 1
+        self.sum_score.add(result["score"])
+        self.sum_percentage.add(0 if result["percentage"] is None else result["percentage"])
+        self.histogram.add(result["percentage"])
+
+    def merge(self,other):
+        if self.name is None:
+            self.name = other.name
+        self.count += other.count
+        self.sum_score.merge(other.sum_score)
+        self.sum_percentage.merge(other.sum_percentage)
+        self.histogram.merge(other.histogram)
+
+    def toDict(self):
+        return {
+            "name": self.name,
+            "count": self.count,
+            "sum_score": self.sum_score.partials,
+            "sum_percentage": self.sum_percentage.partials,
+            "histogram": self.histogram.toDict()
+        }
+
+    @staticmethod
+    def fromDict(state):
+        accumulator = KPIAccumulator(state["name"])
+        accumulator.count = state["count"]
+        accumulator.sum_score = ExactSum(state["sum_score"])
+        accumulator.sum_percentage = ExactSum(state["sum_percentage"])
+        accumulator.histogram = PercentageHistogram.fromDict(state["histogram"])
+        return accumulator
+
+    def stats(self,method="legacy"):
+        return {
+            "name": self.name,
+            "count": self.count,
+            "percentiles": self.histogram.percentiles(method=method),
+            "average_score": self.sum_score.value() / self.count,
+            "average_percentage": self.sum_percentage.value() / self.count,
+            "grade_counts": self.histogram.gradeCounts()
+        }
+
+class MetricsAccumulator:
+    """
+    Constant-memory alternative to getMetrics: consumes evaluation results one at a time, keeping counts, sums, the grade histogram and percentage sketches (overall and per KPI). The metrics are those of getMetrics without the per-station lists (identifier, totals, scores, percentages, grades...)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.summaries = 0
+        self.sum_score = ExactSum()
+        self.sum_percentage = ExactSum()
+        self.grades = {"A":0,"B":0,"C":0,"D":0,"E":0,"F":0,"U":0}
+        self.histogram = PercentageHistogram()
+        self.kpis = {}
+
+    def add(self,result):
+        self.count += 1
+        if "summary" in result:
+            summary = result["summary"]
+            self.summaries += 1
+            self.sum_score.add(summary["score"])
+            self.sum_percentage.add(0 if summary["percentage"] is None else summary["percentage"])
+            self.histogram.add(summary["percentage"])
+            if summary["grade"] in self.grades:
+                self.grades[summary["grade"]] += 1
+        for kpi in [key for key in result if re.search("^kpi_",key) is not None]:
+            if kpi not in self.kpis:
+                self.kpis[kpi] = KPIAccumulator()
+            self.kpis[kpi].add(result[kpi])
+
+    def merge(self,other):
+        self.count += other.count
+        self.summaries += other.summaries
+        self.sum_score.merge(other.sum_score)
+        self.sum_percentage.merge(other.sum_percentage)
+        for grade in self.grades:
+            self.grades[grade] += other.grades[grade]
+        self.histogram.merge(other.histogram)
+        for kpi in other.kpis:
+            if kpi not in self.kpis:
+                self.kpis[kpi] = KPIAccumulator()
+            self.kpis[kpi].merge(other.kpis[kpi])
+
+    def toDict(self):
+        """Compact partial aggregate, see fromDict and merge"""
+        return {
+            "count": self.count,
+            "summaries": self.summaries,
+            "sum_score": self.sum_score.partials,
+            "sum_percentage": self.sum_percentage.partials,
+            "grades": self.grades,
+            "histogram": self.histogram.toDict(),
+            "kpi": {kpi: self.kpis[kpi].toDict() for kpi in sorted(self.kpis)}
+        }
+
+    @staticmethod
+    def fromDict(state):
+        accumulator = MetricsAccumulator()
+        accumulator.count = state["count"]
+        accumulator.summaries = state["summaries"]
+        accumulator.sum_score = ExactSum(state["sum_score"])
+        accumulator.sum_percentage = ExactSum(state["sum_percentage"])
+        accumulator.grades = dict(state["grades"])
+        accumulator.histogram = PercentageHistogram.fromDict(state["histogram"])
+        accumulator.kpis = {kpi: KPIAccumulator.fromDict(state["kpi"][kpi]) for kpi in state["kpi"]}
+        return accumulator
+
+    def getMetrics(self,method="legacy"):
+        if self.count == 0:
+            print("Error: no results to evaluate")
+            return
+        kpi_stats = {kpi: self.kpis[kpi].stats(method=method) for kpi in sorted(self.kpis)}
+        if not self.summaries:
+            return {
+                "count": self.count,
+                "kpi": kpi_stats
+            }
+        return {
+            "count": self.count,
+            "grade_counts": getGradeCounts([self.grades[x] for x in GRADE_LETTERS],GRADE_LETTERS,self.count),
+            "percentiles": self.histogram.percentiles(method=method),
+            "average_percentage": self.sum_percentage.value() / self.count,
+            "average_score": self.sum_score.value() / self.count,
+            "kpi": kpi_stats
+        }
+
+def getGroup(result,group_by):
+    """
+    :returns: the group (value of the group_by dimension) of a result, "" if unknown
+    """
+    if group_by not in GROUP_BY_FIELDS:
+        raise ValueError("Bad group_by. choices: %s" % ", ".join(GROUP_BY_FIELDS))
+    if "summary" not in result:
+        return ""
+    if group_by == "issuer":
+        identifier = (result["summary"]["identifier"] or "").split("/")[-1].split("-")
+        return identifier[1] if len(identifier) > 1 else ""
+    return result["summary"][group_by] or ""
+
+class GroupedMetricsAccumulator:
+    """
+    MetricsAccumulator per group of results (region, country, organisation or issuer), filled in a single pass
+    """
+
+    def __init__(self,group_by):
+        if group_by not in GROUP_BY_FIELDS:
+            raise ValueError("Bad group_by. choices: %s" % ", ".join(GROUP_BY_FIELDS))
+        self.group_by = group_by
+        self.count = 0
+        self.groups = {}
+
+    def add(self,result):
+        group = getGroup(result,self.group_by)
+        if group not in self.groups:
+            self.groups[group] = MetricsAccumulator()
+        self.groups[group].add(result)
+        self.count += 1
+
+    def merge(self,other):
+        if other.group_by != self.group_by:
+            raise ValueError("Can't merge metrics grouped by %s and by %s" % (self.group_by,other.group_by))
+        for group in other.groups:
+            if group not in self.groups:
+                self.groups[group] = MetricsAccumulator()
+            self.groups[group].merge(other.groups[group])
+        self.count += other.count
+
+    def toDict(self):
+        return {
+            "group_by": self.group_by,
+            "count": self.count,
+            "groups": {group: self.groups[group].toDict() for group in sorted(self.groups)}
+        }
+
+    @staticmethod
+    def fromDict(state):
+        accumulator = GroupedMetricsAccumulator(state["group_by"])
+        accumulator.count = state["count"]
+        accumulator.groups = {group: MetricsAccumulator.fromDict(state["groups"][group]) for group in state["groups"]}
+        return accumulator
+
+    def getMetrics(self,method="legacy"):
+        if self.count == 0:
+            print("Error: no results to evaluate")
+            return
+        return {
+            "group_by": self.group_by,
+            "count": self.count,
+            "groups": {group: self.groups[group].getMetrics(method=method) for group in sorted(self.groups)}
+        }
+
+def newAccumulator(group_by=None):
+    return MetricsAccumulator() if group_by is None else GroupedMetricsAccumulator(group_by)
+
+def getMetricsStreaming(results,method="legacy",group_by=None):
+    """
+    Computes the metrics of an iterable of results (e.g. iterResults) in constant memory, per group if group_by is given
+    """
+    accumulator = newAccumulator(group_by)
+    for result in results:
+        accumulator.add(result)
+    return accumulator.getMetrics(method=method)
+
+def iterResults(file_pattern,tombstones=None,shard=None):
+    """
+    Generator of the valid evaluation results matching file_pattern (evaluation files and JSON Lines files, or a columnar results table or results database, see pywmdr.results), read one at a time
+    """
+    count = 0
+    dropped = 0
+    if not isResultsDatabase(file_pattern) and os.path.isfile(file_pattern) and RecordStore.is_store(file_pattern):
+        print("Error: %s is an SQLite database without results (a record store? see metrics evaluate)" % file_pattern)
+        return
+    if isColumnar(file_pattern) or isResultsDatabase(file_pattern):
+        table = iterColumnarResults(file_pattern) if isColumnar(file_pattern) else iterSQLiteResults(file_pattern)
+        for content in table:
+            identifier = resultIdentifier(content)
+            if not inShard(identifier,shard):
+                continue
+            if isTombstoned(identifier or "",content,tombstones):
+                dropped += 1
+                continue
+            count += 1
+            yield content
+        print("readResults found %i results." % count)
+        if dropped:
+            print("readResults dropped %i deleted stations." % dropped)
+        return
+    def readFiles():
+        nonlocal dropped
+        for file in glob.glob(file_pattern):
+            if isJsonLines(file):
+                contents = iterJsonLines(file)
+            else:
+                f = open(file)
+                contents = [(file, json.load(f))]
+                f.close()
+            for name, content in contents:
+                if not inShard(resultIdentifier(content),shard):
+                    continue
+                if isTombstoned(name,content,tombstones):
+                    dropped += 1
+                    continue
+                yield content
+    for content, isValid in util.validate_kpi_evaluation_results(readFiles()):
+        if isValid:
+            count += 1
+            yield content
+    print("readResults found %i results." % count)
+    if dropped:
+        print("readResults dropped %i deleted stations." % dropped)
+
+def readResults(file_pattern,tombstones=None):
+    return list(iterResults(file_pattern,tombstones=tombstones))
+
+def writePartialMetrics(accumulator,filename,shard=None):
+    """
+    Saves the partial aggregate of a shard, to be combined by mergePartialMetrics
+    """
+    f = open(filename,"w")
+    json.dump({"shard": "%i/%i" % shard if shard is not None else None, "partial": accumulator.toDict()},f)
+    f.close()
+
+def mergePartialMetrics(file_pattern,method="legacy"):
+    """
+    Combines the partial aggregates matching file_pattern into the final metrics, the same as the streaming metrics of the whole corpus. These are the metrics of getMetrics without the per-station lists (identifier, organisation, country, region, totals, scores, percentages and grades, and the totals, scores and percentages of each KPI), which the partials do not keep so that they stay small
+    """
     files = glob.glob(file_pattern)
-    for file in files:
+    if not len(files):
+        print("Error: no files matched the pattern")
+        return
+    accumulator = None
+    shards = set()
+    for file in sorted(files):
         f = open(file)
         content = json.load(f)
-        isValid = util.validate_kpi_evaluation_result(content)
-        if isValid:
-            results.append(content)
         f.close()
-    print("readResults found %i files." % len(results))
-    return results
+        if content["shard"] is not None:
+            if content["shard"] in shards:
+                print("Warning: shard %s found more than once (%s)" % (content["shard"],file))
+            shards.add(content["shard"])
+        partial = GroupedMetricsAccumulator.fromDict(content["partial"]) if "group_by" in content["partial"] else MetricsAccumulator.fromDict(content["partial"])
+        if accumulator is None:
+            accumulator = partial
+        else:
+            try:
+                accumulator.merge(partial)
+            except (ValueError, AttributeError):
+                print("Error: %s was not computed with the same --group_by as the previous partials" % file)
+                return
+    if len(shards):
+        total = int(sorted(shards)[0].split("/")[1])
+        if len(shards) < total:
+            print("Warning: %i of %i shards merged" % (len(shards),total))
+    return accumulator.getMetrics(method=method)
 
-def readEvaluationsAndGetMetrics(file_pattern):
-    results = readResults(file_pattern)
-    return getMetrics(results)
+def readEvaluationsAndGetMetrics(file_pattern,tombstones=None,streaming=False,method="legacy",group_by=None):
+    if streaming or group_by is not None:
+        return getMetricsStreaming(iterResults(file_pattern,tombstones=tombstones),method=method,group_by=group_by)
+    results = readResults(file_pattern,tombstones=tombstones)
+    return getMetrics(results,method=method)
 
 @click.group()
 def kpi():
@@ -184,36 +869,145 @@ def kpi():
 @click.command()
 @click.pass_context
 @click.argument('action',
-            type=click.Choice(["evaluate","metrics"]))
+            type=click.Choice(["evaluate","metrics","merge","query"]))
 @click.argument('path',
               type=str)
 @click.option('--output_dir', '-o', type=click.Path(),
               help='Save the results onto this location')
-@click.option('--compute_metrics', '-m', type=click.Path(), default="https://oscar.wmo.int:443/oai/provider",
+@click.option('--compute_metrics', '-m', type=click.Path(),
               help='Compute metrics and save the results onto this file')
 @click.option('--kpi', '-k', type=int, help='Compute selected kpi only')
 @click.option('--skip_schema_eval', '-s', is_flag=True,show_default=True,default=False, help='skip evaluation of schema (kpi 1-01)')
-def metrics(self,action,path,output_dir,compute_metrics,kpi,skip_schema_eval):
+@click.option('--tombstones', '-t', type=click.Path(), help='Drop stations listed in this tombstones file (written by pywmdr harvest for deleted records)')
+@click.option('--streaming', '-S', is_flag=True, default=False, help='Aggregate the results one at a time in constant memory. The metrics then leave out the per-station lists')
+@click.option('--shard', type=str, help='Process only shard i of N (i/N) of the records and save its partial aggregate onto the --compute_metrics file, to be combined with action=merge')
+@click.option('--interpolation', '-i', type=click.Choice(PERCENTILE_METHODS), default="legacy", show_default=True, help='Percentile method: legacy (value of rank int(p/100*count)) or a numpy.percentile method')
+@click.option('--format', '-f', 'format_', type=click.Choice(["json"] + RESULTS_FORMATS), default="json", show_default=True, help='Save the results as one <record>_eval.json file per record, as one table (one row per record) <output_dir>/evaluations.<format>, as JSON Lines <output_dir>/evaluations.jsonl[.gz] or as an indexed SQLite database <output_dir>/evaluations.sqlite. parquet requires pyarrow')
+@click.option('--filter', '-F', 'filters', type=str, multiple=True, help='action=query: select the results with field=value, field being one of identifier, organisation, country, region, grade. May be repeated')
+@click.option('--group_by', '-g', type=click.Choice(GROUP_BY_FIELDS), help='Compute the metrics per region, country, organisation or WIGOS identifier issuer, in one pass. The metrics of each group leave out the per-station lists')
+@click.option('--incremental', '-I', is_flag=True, default=False, help='action=evaluate: evaluate only the records that are new or changed (size or modification time) since the results in --output_dir were saved, as recorded in <output_dir>/manifest.json. Valid only with --format json or sqlite')
+@click.option('--hash', 'use_hash', is_flag=True, default=False, help='With --incremental, also compare a sha256 of the record files')
+def metrics(self,action,path,output_dir,compute_metrics,kpi,skip_schema_eval,tombstones,streaming,shard,interpolation,format_,filters,group_by,incremental,use_hash):
+    """
+    ACTION is the action to perform. Options are
+
+      - evaluate: evaluate the records matching PATH (or the record store PATH)
+
+      - metrics: compute the metrics of the evaluations matching PATH (or of the results table PATH)
+
+      - merge: combine the partial aggregates (written with --shard) matching PATH into the metrics, without the per-station lists (as with --streaming)
+
+      - query: list the results of the results database PATH (written with --format sqlite) selected with --filter, with the scores of kpi --kpi if given, or compute their metrics with -m
+    """
+    tombstones = readTombstones(tombstones)
+    if shard is not None:
+        try:
+            shard = parseShard(shard)
+        except ValueError as e:
+            print("Error: %s" % str(e))
+            exit(1)
+    writer = None
+    if action == "evaluate" and format_ != "json":
+        if output_dir is None:
+            print("ERROR: --format %s requires -o, --output_dir" % format_)
+            exit(1)
+        filename = "%s/evaluations.%s" % (output_dir,format_) if shard is None else "%s/evaluations_%i-%i.%s" % (output_dir,shard[0],shard[1],format_)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        try:
+            writer = openResultsWriter(filename,format_)
+        except RuntimeError as e:
+            print("ERROR: %s" % str(e))
+            exit(1)
+    manifest = None
+    if action == "evaluate" and incremental:
+        if output_dir is None:
+            print("ERROR: --incremental requires -o, --output_dir")
+            exit(1)
+        if format_ not in ["json","sqlite"]:
+            print("ERROR: --incremental is not valid with --format %s (the results file is written anew on each run)" % format_)
+            exit(1)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        filename = "%s/manifest.json" % output_dir if shard is None else "%s/manifest_%i-%i.json" % (output_dir,shard[0],shard[1])
+        manifest = EvaluationManifest(filename,{"kpi": kpi, "skip_schema_eval": skip_schema_eval, "format": format_},use_hash=use_hash)
+    if shard is not None:
+        if not compute_metrics:
+            print("ERROR: --shard requires -m, --compute_metrics")
+            exit(1)
+        accumulator = newAccumulator(group_by)
+        if action == "evaluate":
+            parseAndEvaluatePath(path,output_dir=output_dir,writer=writer,manifest=manifest,selected_kpi=kpi,skip_schema_eval=skip_schema_eval,tombstones=tombstones,accumulator=accumulator,shard=shard)
+        elif action == "metrics":
+            for result in iterResults(path,tombstones=tombstones,shard=shard):
+                accumulator.add(result)
+        else:
+            print("ERROR: --shard is valid only for actions evaluate and metrics")
+            exit(1)
+        if writer is not None:
+            writer.close()
+        if manifest is not None:
+            manifest.save()
+        writePartialMetrics(accumulator,compute_metrics,shard)
+        return
     if action == "evaluate":
-        if compute_metrics:
-            results = parseAndEvaluateFiles(path,output_dir=output_dir,selected_kpi=kpi,skip_schema_eval=skip_schema_eval,return_results=True)
+        if compute_metrics and (streaming or group_by is not None):
+            accumulator = newAccumulator(group_by)
+            parseAndEvaluatePath(path,output_dir=output_dir,writer=writer,manifest=manifest,selected_kpi=kpi,skip_schema_eval=skip_schema_eval,tombstones=tombstones,accumulator=accumulator)
+            f = open(compute_metrics,"w")
+            json.dump(accumulator.getMetrics(method=interpolation),f,indent=2)
+            f.close()
+        elif compute_metrics:
+            results = parseAndEvaluatePath(path,output_dir=output_dir,writer=writer,manifest=manifest,selected_kpi=kpi,skip_schema_eval=skip_schema_eval,return_results=True,tombstones=tombstones)
             if results is not None:
-                metric_results = getMetrics(results)
+                metric_results = getMetrics(results,method=interpolation)
                 f = open(compute_metrics,"w")
                 json.dump(metric_results,f,indent=2)
                 f.close()
         else:
-            parseAndEvaluateFiles(path,output_dir=output_dir,selected_kpi=kpi,skip_schema_eval=skip_schema_eval)
+            parseAndEvaluatePath(path,output_dir=output_dir,writer=writer,manifest=manifest,selected_kpi=kpi,skip_schema_eval=skip_schema_eval,tombstones=tombstones)
+        if writer is not None:
+            writer.close()
+        if manifest is not None:
+            manifest.save()
     elif action == "metrics":
-            metric_results = readEvaluationsAndGetMetrics(path)
+            metric_results = readEvaluationsAndGetMetrics(path,tombstones=tombstones,streaming=streaming,method=interpolation,group_by=group_by)
             if compute_metrics:
                 f = open(compute_metrics,"w")
                 json.dump(metric_results,f,indent=2)
                 f.close()
             else:
                 print(json.dumps(metric_results,indent=2))
+    elif action == "merge":
+        metric_results = mergePartialMetrics(path,method=interpolation)
+        if compute_metrics:
+            f = open(compute_metrics,"w")
+            json.dump(metric_results,f,indent=2)
+            f.close()
+        else:
+            print(json.dumps(metric_results,indent=2))
+    elif action == "query":
+        if not isResultsDatabase(path):
+            print("ERROR: %s is not a results database (see --format sqlite)" % path)
+            exit(1)
+        try:
+            filters = parseFilters(filters)
+        except ValueError as e:
+            print("ERROR: %s" % str(e))
+            exit(1)
+        if compute_metrics:
+            if streaming or group_by is not None:
+                metric_results = getMetricsStreaming(iterSQLiteResults(path,filters),method=interpolation,group_by=group_by)
+            else:
+                metric_results = getMetrics(list(iterSQLiteResults(path,filters)),method=interpolation)
+            f = open(compute_metrics,"w")
+            json.dump(metric_results,f,indent=2)
+            f.close()
+        else:
+            for row in queryResults(path,filters,kpi=f'kpi_{kpi:02}' if kpi is not None else None):
+                print(json.dumps(row))
     else:
-        print("Bad action. choices: evaluate, metrics")
+        print("Bad action. choices: evaluate, metrics, merge, query")
         exit(1)
 
 kpi.add_command(metrics)
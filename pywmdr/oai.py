@@ -0,0 +1,308 @@
+from lxml import etree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs, urlencode
+from xml.sax.saxutils import escape
+import glob
+import os
+import random
+import threading
+import time
+import requests
+import click
+from pywmdr.harvest import iterListRecords, iterListIdentifiers, fetchRecord
+from pywmdr.util import WMDR_RECORD_TAGS
+
+# local stand-in for an OAI-PMH provider (such as oscar.wmo.int), serving the WMDR records of a directory
+
+OAI_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd">'
+OAI_FOOTER = b'</OAI-PMH>'
+
+BENCHMARK_MODES = ["sequential","pooled","concurrent"]
+
+def loadRecords(directory,copies=1,sets=0):
+    """
+    Read the WMDR records of a directory into memory: the first WIGOSMetadataRecord (WMDR 1.0 or 2017) of each file, the root or nested in another element. The identifier of a record is its file name (without .xml), the datestamp the modification time of the file
+
+    :param copies: serve each record this many times (with identifiers <identifier>-<n>, dated one hour apart), to get a larger corpus out of a few files
+    :param sets: distribute the records over this many sets (set0, set1, ...)
+
+    :returns: list of dicts with identifier, datestamp, sets and content (serialised WIGOSMetadataRecord), sorted by identifier
+    """
+    records = []
+    for file in sorted(glob.glob("%s/*.xml" % directory)):
+        try:
+            root = etree.parse(file).getroot()
+        except Exception as e:
+            print("Warning: %s: %s" % (file,str(e)))
+            continue
+        root = next(root.iter(*WMDR_RECORD_TAGS),None)
+        if root is None:
+            print("Warning: %s is not a WMDR record" % file)
+            continue
+        identifier = os.path.basename(file)[:-4]
+        mtime = datetime.fromtimestamp(int(os.path.getmtime(file)),timezone.utc)
+        content = etree.tostring(root)
+        for i in range(copies):
+            records.append({
+                "identifier": identifier if copies == 1 else "%s-%i" % (identifier,i),
+                "datestamp": (mtime - timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "sets": [],
+                "content": content
+            })
+    records.sort(key=lambda x: x["identifier"])
+    if sets:
+        for i, record in enumerate(records):
+            record["sets"].append("set%i" % (i % sets))
+    return records
+
+class OAIRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers Identify, ListMetadataFormats, ListSets, ListIdentifiers, ListRecords (with resumption tokens, from, until and set) and GetRecord requests from the records of the server
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.send_response(503)
+            self.send_header("Retry-After","1")
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        body = self.server.respond(params)
+        self.send_response(200)
+        self.send_header("Content-Type","text/xml; charset=utf-8")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class OAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,records,address=("127.0.0.1",0),page_size=100,latency=0,error_rate=0,verbose=False):
+        ThreadingHTTPServer.__init__(self,address,OAIRequestHandler)
+        self.records = records
+        self.sets = sorted(set([x for record in records for x in record["sets"]]))
+        self.index = {record["identifier"]: record for record in records}
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.verbose = verbose
+
+    @property
+    def endpoint(self):
+        return "http://%s:%i/oai" % self.server_address[:2]
+
+    def envelope(self,params,content):
+        request = " ".join(['%s="%s"' % (key,escape(value,{'"':"&quot;"})) for key, value in params.items() if key in ["verb","metadataPrefix","identifier","resumptionToken","from","until","set"]])
+        return b"".join([
+            OAI_HEADER,
+            ("<responseDate>%s</responseDate><request %s>%s</request>" % (datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),request,escape(self.endpoint))).encode(),
+            content,
+            OAI_FOOTER
+        ])
+
+    def error(self,params,code,message):
+        return self.envelope(params,('<error code="%s">%s</error>' % (code,escape(message))).encode())
+
+    def header(self,record):
+        set_specs = "".join(["<setSpec>%s</setSpec>" % escape(x) for x in record["sets"]])
+        return ("<header><identifier>%s</identifier><datestamp>%s</datestamp>%s</header>" % (escape(record["identifier"]),record["datestamp"],set_specs)).encode()
+
+    def respond(self,params):
+        verb = params.get("verb")
+        if verb == "Identify":
+            earliest = min([x["datestamp"] for x in self.records]) if len(self.records) else "1970-01-01T00:00:00Z"
+            return self.envelope(params,("<Identify><repositoryName>pywmdr OAI-PMH stand-in</repositoryName><baseURL>%s</baseURL><protocolVersion>2.0</protocolVersion><earliestDatestamp>%s</earliestDatestamp><deletedRecord>persistent</deletedRecord><granularity>YYYY-MM-DDThh:mm:ssZ</granularity></Identify>" % (escape(self.endpoint),earliest)).encode())
+        if verb == "ListMetadataFormats":
+            return self.envelope(params,b"<ListMetadataFormats><metadataFormat><metadataPrefix>wmdr</metadataPrefix><schema>http://schemas.wmo.int/wmdr/1.0/wmdr.xsd</schema><metadataNamespace>http://def.wmo.int/wmdr/1.0</metadataNamespace></metadataFormat></ListMetadataFormats>")
+        if verb == "GetRecord":
+            record = self.index.get(params.get("identifier"))
+            if record is None:
+                return self.error(params,"idDoesNotExist","No matching identifier")
+            return self.envelope(params,b"".join([b"<GetRecord><record>",self.header(record),b"<metadata>",record["content"],b"</metadata></record></GetRecord>"]))
+        if verb == "ListSets":
+            if not len(self.sets):
+                return self.error(params,"noSetHierarchy","This repository does not support sets")
+            return self.envelope(params,("<ListSets>%s</ListSets>" % "".join(["<set><setSpec>%s</setSpec><setName>%s</setName></set>" % (escape(x),escape(x)) for x in self.sets])).encode())
+        if verb in ["ListRecords","ListIdentifiers"]:
+            return self.list(verb,params)
+        return self.error(params,"badVerb","Illegal OAI verb")
+
+    def list(self,verb,params):
+        if "resumptionToken" in params:
+            try:
+                token = {key: values[0] for key, values in parse_qs(params["resumptionToken"]).items()}
+                cursor = int(token["cursor"])
+            except (KeyError, ValueError):
+                return self.error(params,"badResumptionToken","The value of the resumptionToken argument is invalid")
+        else:
+            if "metadataPrefix" not in params:
+                return self.error(params,"badArgument","Missing metadataPrefix")
+            token = {key: params[key] for key in ["metadataPrefix","from","until","set"] if key in params}
+            cursor = 0
+        records = self.records
+        # from and until are inclusive, at day or second granularity
+        if "from" in token:
+            records = [x for x in records if x["datestamp"][:len(token["from"])] >= token["from"]]
+        if "until" in token:
+            records = [x for x in records if x["datestamp"][:len(token["until"])] <= token["until"]]
+        if "set" in token:
+            records = [x for x in records if token["set"] in x["sets"]]
+        if not len(records):
+            return self.error(params,"noRecordsMatch","No records match the request")
+        page = records[cursor:cursor+self.page_size]
+        content = [("<%s>" % verb).encode()]
+        for record in page:
+            if verb == "ListIdentifiers":
+                content.append(self.header(record))
+            else:
+                content.extend([b"<record>",self.header(record),b"<metadata>",record["content"],b"</metadata></record>"])
+        if cursor + self.page_size < len(records):
+            token["cursor"] = str(cursor + self.page_size)
+            content.append(('<resumptionToken completeListSize="%i" cursor="%i">%s</resumptionToken>' % (len(records),cursor,escape(urlencode(token)))).encode())
+        elif cursor > 0:
+            # last page of an incomplete list
+            content.append(('<resumptionToken completeListSize="%i" cursor="%i"/>' % (len(records),cursor)).encode())
+        content.append(("</%s>" % verb).encode())
+        return self.envelope(params,b"".join(content))
+
+def startServer(directory,host="127.0.0.1",port=0,page_size=100,latency=0,error_rate=0,copies=1,sets=0,verbose=False):
+    """
+    Start an OAI-PMH stand-in server in a background thread
+
+    :returns: pywmdr.oai.OAIServer (see its endpoint property). Call shutdown() to stop it
+    """
+    records = loadRecords(directory,copies=copies,sets=sets)
+    server = OAIServer(records,address=(host,port),page_size=page_size,latency=latency,error_rate=error_rate,verbose=verbose)
+    thread = threading.Thread(target=server.serve_forever,daemon=True)
+    thread.start()
+    return server
+
+class ByteCounter:
+    """Response hook counting the received bytes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+    def __call__(self,response,*args,**kwargs):
+        with self.lock:
+            self.bytes += len(response.content)
+        return response
+
+def benchmarkSession(counter,pooled=True):
+    session = requests.Session()
+    if not pooled:
+        # a new connection for every request, as with requests.get
+        session.headers["Connection"] = "close"
+    session.hooks["response"].append(counter)
+    return session
+
+def benchmarkHarvest(endpoint,mode,metadata_prefix="wmdr",workers=8):
+    """
+    Harvest all the records of an endpoint in memory using one of the modes:
+
+      - sequential: ListRecords pages, a new connection per request
+
+      - pooled: ListRecords pages over a persistent connection
+
+      - concurrent: ListIdentifiers, then GetRecord requests from a pool of threads, each with a persistent connection
+
+    :returns: dict with mode, records, bytes, elapsed (seconds), records_per_second and mb_per_second
+    """
+    counter = ByteCounter()
+    count = 0
+    start = time.time()
+    if mode in ["sequential","pooled"]:
+        session = benchmarkSession(counter,pooled=mode == "pooled")
+        for record in iterListRecords(endpoint=endpoint,metadata_prefix=metadata_prefix,session=session):
+            if record["metadata"] is not None:
+                count += 1
+        session.close()
+    elif mode == "concurrent":
+        session = benchmarkSession(counter)
+        identifiers = [header["identifier"] for header in iterListIdentifiers(endpoint=endpoint,metadata_prefix=metadata_prefix,session=session) if not header["deleted"]]
+        session.close()
+        local = threading.local()
+        sessions = []
+        def getRecord(identifier):
+            if not hasattr(local,"session"):
+                local.session = benchmarkSession(counter)
+                sessions.append(local.session)
+            header, el = fetchRecord(identifier,endpoint=endpoint,metadata_prefix=metadata_prefix,session=local.session)
+            return el is not None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            count = len([x for x in executor.map(getRecord,identifiers) if x])
+        for session in sessions:
+            session.close()
+    else:
+        raise ValueError("Bad mode. choices: %s" % ", ".join(BENCHMARK_MODES))
+    elapsed = max(time.time() - start,1e-6)
+    return {
+        "mode": mode,
+        "records": count,
+        "bytes": counter.bytes,
+        "elapsed": elapsed,
+        "records_per_second": count / elapsed,
+        "mb_per_second": counter.bytes / elapsed / 1e6
+    }
+
+@click.command()
+@click.pass_context
+@click.argument('action',
+            type=click.Choice(["serve","benchmark"]))
+@click.argument('directory',
+              type=click.Path(exists=True,file_okay=False))
+@click.option('--host', '-H', type=str, default="127.0.0.1", show_default=True, help='Address to listen on')
+@click.option('--port', '-P', type=int, default=8000, show_default=True, help='Port to listen on. Valid only for action=serve')
+@click.option('--page_size', '-n', type=int, default=100, show_default=True, help='Number of records per ListRecords/ListIdentifiers page')
+@click.option('--latency', '-l', type=float, default=0, show_default=True, help='Delay each response by this many seconds')
+@click.option('--error_rate', '-r', type=float, default=0, show_default=True, help='Answer this fraction of the requests with 503 Service Unavailable')
+@click.option('--copies', '-c', type=int, default=1, show_default=True, help='Serve each record this many times (with suffixed identifiers, dated one hour apart)')
+@click.option('--sets', '-s', type=int, default=0, show_default=True, help='Distribute the records over this many sets')
+@click.option('--mode', '-m', 'modes', type=click.Choice(BENCHMARK_MODES), multiple=True, help='Harvest mode to benchmark (repeatable). Defaults to all. Valid only for action=benchmark')
+@click.option('--workers', '-w', type=int, default=8, show_default=True, help='Number of threads of the concurrent mode')
+@click.option('--endpoint', '-e', type=str, help='Benchmark this OAI endpoint instead of a local stand-in server. Valid only for action=benchmark')
+@click.option('--metadata_prefix', '-p', default="wmdr", help='Metadata prefix. Defaults to wmdr')
+def oai(self,action,directory,host,port,page_size,latency,error_rate,copies,sets,modes,workers,endpoint,metadata_prefix):
+    """
+    Local OAI-PMH stand-in server and harvest benchmark
+
+    ACTION is the action to perform. Options are
+
+      - serve: serve the WMDR records of DIRECTORY over OAI-PMH
+
+      - benchmark: report the throughput of the harvest modes against such a server
+    """
+    if action == "serve":
+        server = OAIServer(loadRecords(directory,copies=copies,sets=sets),address=(host,port),page_size=page_size,latency=latency,error_rate=error_rate,verbose=True)
+        print("serving %i records at %s" % (len(server.records),server.endpoint))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    elif action == "benchmark":
+        server = None
+        if endpoint is None:
+            server = startServer(directory,host=host,page_size=page_size,latency=latency,error_rate=error_rate,copies=copies,sets=sets)
+            endpoint = server.endpoint
+            print("serving %i records at %s" % (len(server.records),endpoint))
+        for mode in modes or BENCHMARK_MODES:
+            result = benchmarkHarvest(endpoint,mode,metadata_prefix=metadata_prefix,workers=workers)
+            print("%-10s %8i records %10.1f s %10.1f records/s %8.2f MB/s" % (result["mode"],result["records"],result["elapsed"],result["records_per_second"],result["mb_per_second"]))
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    else:
+        print("Bad action. choices: serve, benchmark")
+        exit(1)
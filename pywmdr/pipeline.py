@@ -0,0 +1,140 @@
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import queue
+import threading
+import traceback
+import json
+import os
+import time
+import click
+from pywmdr.harvest import iterListRecords
+from pywmdr.metrics import parseAndEvaluate, newAccumulator, GROUP_BY_FIELDS, PERCENTILE_METHODS
+
+# end-of-stream marker passed along the queues
+DONE = None
+
+def harvestRecords(records,record_queue,workers,errors):
+    """
+    Feeds harvested records into the bounded record queue. Blocks while the queue is full, so that the harvester never runs too far ahead of the KPI workers
+    """
+    try:
+        for record in records:
+            record_queue.put(record)
+    except Exception:
+        print("Error: harvest failed:")
+        traceback.print_exc()
+        errors.append("harvest")
+    finally:
+        for i in range(workers):
+            record_queue.put(DONE)
+
+def evaluateContent(content,selected_kpi : int=None,skip_schema_eval=False):
+    """
+    Evaluates a serialised record in a worker process of the pool
+    """
+    return parseAndEvaluate(BytesIO(content),selected_kpi=selected_kpi,skip_schema_eval=skip_schema_eval)
+
+def evaluateQueue(record_queue,result_queue,pool,selected_kpi : int=None,skip_schema_eval=False):
+    """
+    KPI worker: hands the records of the record queue, serialised, to a worker process of the pool and waits for their evaluation, until the end-of-stream marker
+    """
+    while True:
+        record = record_queue.get()
+        if record is DONE:
+            result_queue.put(DONE)
+            return
+        result = None
+        if not record["deleted"] and record["metadata"] is not None:
+            try:
+                content = etree.tostring(record["metadata"])
+                result = pool.submit(evaluateContent,content,selected_kpi,skip_schema_eval).result()
+            except Exception:
+                print("Error: kpi evaluation failed:")
+                traceback.print_exc()
+        # the element is not needed anymore
+        record["metadata"] = None
+        result_queue.put((record,result))
+
+def runPipeline(endpoint="https://oscar.wmo.int:443/oai/provider",metadata_prefix="wmdr",set_spec=None,from_date=None,output_dir=None,selected_kpi : int=None,skip_schema_eval=False,workers=4,queue_size=100,max_pages=10000,records=None,group_by=None):
+    """
+    Harvests, evaluates and aggregates in one pass: records flow from the harvester through a bounded queue into a pool of KPI worker processes and on to the aggregator (this thread), so that network, CPU and I/O overlap. The results are aggregated one at a time, in constant memory.
+
+    :param records: optional iterable of records (as yielded by pywmdr.harvest.iterListRecords) to use instead of harvesting the endpoint
+
+    :param group_by: aggregate per group (see pywmdr.metrics.GroupedMetricsAccumulator)
+
+    :returns: MetricsAccumulator (GroupedMetricsAccumulator if group_by is given) of the evaluation results, list of deleted identifiers
+    """
+    if records is None:
+        records = iterListRecords(endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,from_date=from_date,max_pages=max_pages)
+    if output_dir is not None and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    record_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    # the evaluation is CPU bound: the threads only feed a pool of as many processes
+    pool = ProcessPoolExecutor(max_workers=workers)
+    threads = [threading.Thread(target=harvestRecords,args=(records,record_queue,workers,errors),daemon=True)]
+    for i in range(workers):
+        threads.append(threading.Thread(target=evaluateQueue,args=(record_queue,result_queue,pool,selected_kpi,skip_schema_eval),daemon=True))
+    for thread in threads:
+        thread.start()
+    accumulator = newAccumulator(group_by)
+    deleted = []
+    failed = 0
+    running = workers
+    start = time.time()
+    while running:
+        item = result_queue.get()
+        if item is DONE:
+            running -= 1
+            continue
+        record, result = item
+        if record["deleted"]:
+            deleted.append(record["identifier"])
+            continue
+        if result is None:
+            failed += 1
+            continue
+        accumulator.add(result)
+        if output_dir is not None:
+            f = open("%s/%s.xml_eval.json" % (output_dir,record["identifier"]),"w")
+            json.dump(result,f,indent=2)
+            f.close()
+        if accumulator.count % 100 == 0:
+            print("%i records evaluated (%.1f records/s)" % (accumulator.count, accumulator.count / (time.time() - start)))
+    for thread in threads:
+        thread.join()
+    pool.shutdown()
+    print("pipeline evaluated %i records in %.1f s, %i failed, %i deleted." % (accumulator.count, time.time() - start, failed, len(deleted)))
+    if errors:
+        print("Warning: the harvest did not complete, results are partial")
+    return accumulator, deleted
+
+@click.command()
+@click.pass_context
+@click.option('--endpoint', '-e', type=str, default="https://oscar.wmo.int:443/oai/provider",
+              help='OAI web service endpoint')
+@click.option('--set_spec', '-s', type=str,
+              help='Retrieve only records with the specified setSpec attribute')
+@click.option('--metadata_prefix', '-p', default="wmdr", help='Metadata prefix. Defaults to wmdr')
+@click.option('--from_date', '-d', type=str, help='Retrieve only records created, modified or deleted since this date')
+@click.option('--output_dir', '-o', type=click.Path(), help='Save the evaluation results onto this location')
+@click.option('--compute_metrics', '-m', type=click.Path(), help='Save the metrics onto this file (printed otherwise)')
+@click.option('--kpi', '-k', type=int, help='Compute selected kpi only')
+@click.option('--skip_schema_eval', '-x', is_flag=True, show_default=True, default=False, help='skip evaluation of schema (kpi 1-01)')
+@click.option('--workers', '-w', type=int, default=4, show_default=True, help='Number of KPI worker processes')
+@click.option('--queue_size', '-q', type=int, default=100, show_default=True, help='Maximum number of records waiting between pipeline stages')
+@click.option('--group_by', '-g', type=click.Choice(GROUP_BY_FIELDS), help='Compute the metrics per region, country, organisation or WIGOS identifier issuer')
+@click.option('--interpolation', '-i', type=click.Choice(PERCENTILE_METHODS), default="legacy", show_default=True, help='Percentile method: legacy (value of rank int(p/100*count)) or a numpy.percentile method')
+def pipeline(self,endpoint,set_spec,metadata_prefix,from_date,output_dir,compute_metrics,kpi,skip_schema_eval,workers,queue_size,group_by,interpolation):
+    """harvest, evaluate and compute metrics in one pipelined pass"""
+    accumulator, deleted = runPipeline(endpoint=endpoint,metadata_prefix=metadata_prefix,set_spec=set_spec,from_date=from_date,output_dir=output_dir,selected_kpi=kpi,skip_schema_eval=skip_schema_eval,workers=workers,queue_size=queue_size,group_by=group_by)
+    metric_results = accumulator.getMetrics(method=interpolation)
+    if compute_metrics:
+        f = open(compute_metrics,"w")
+        json.dump(metric_results,f,indent=2)
+        f.close()
+    else:
+        print(json.dumps(metric_results,indent=2))
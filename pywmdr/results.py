@@ -0,0 +1,500 @@
+import gzip
+import json
+import math
+import os
+import re
+import sqlite3
+import tempfile
+import zipfile
+from urllib.request import pathname2url
+import numpy
+import numpy.lib.format
+from pywmdr.store import RecordStore
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# sinks for KPI evaluation results, as alternatives to one <name>_eval.json file per record
+
+SUMMARY_TEXT_COLUMNS = ["identifier","organisation","country","region","grade"]
+SUMMARY_NUMBER_COLUMNS = ["total","score","percentage"]
+KPI_NUMBER_FIELDS = ["total","score","percentage"]
+
+COLUMNAR_FORMATS = ["npz","parquet"]
+JSONL_FORMATS = ["jsonl","jsonl.gz"]
+RESULTS_FORMATS = COLUMNAR_FORMATS + JSONL_FORMATS + ["sqlite"]
+
+# columns of the results table of the SQLite sink that can be filtered (and are indexed)
+QUERY_FIELDS = SUMMARY_TEXT_COLUMNS
+# codelists of the href-valued fields, so that e.g. region=europe can be queried
+QUERY_CODELISTS = {
+    "country": "http://codes.wmo.int/wmdr/TerritoryName/",
+    "region": "http://codes.wmo.int/wmdr/WMORegion/"
+}
+
+def isColumnar(path):
+    """
+    Checks whether path is a columnar results table (see ColumnarWriter)
+    """
+    return os.path.isfile(path) and os.path.splitext(path)[1][1:] in COLUMNAR_FORMATS
+
+def flattenResult(name,result):
+    """
+    Flattens an evaluation result into a table row: the summary fields plus <kpi>_total, <kpi>_score and <kpi>_percentage for each KPI (comments are left out)
+
+    :returns: dict of column -> value, dict of kpi -> name
+    """
+    row = {"name": name}
+    summary = result.get("summary",{})
+    for column in SUMMARY_TEXT_COLUMNS + SUMMARY_NUMBER_COLUMNS:
+        row[column] = summary.get(column)
+    kpi_names = {}
+    for kpi in [key for key in result if re.search("^kpi_",key) is not None]:
+        kpi_names[kpi] = result[kpi]["name"]
+        for field in KPI_NUMBER_FIELDS:
+            row["%s_%s" % (kpi,field)] = result[kpi][field]
+    return row, kpi_names
+
+def toPython(value):
+    """Converts a table cell back to the value of the evaluation result"""
+    if isinstance(value,(float,numpy.floating)):
+        if math.isnan(value):
+            return None
+        if float(value).is_integer():
+            return int(value)
+        return float(value)
+    if isinstance(value,(str,numpy.str_)):
+        return str(value)
+    return value
+
+TEXT_COLUMNS = ["name"] + SUMMARY_TEXT_COLUMNS
+
+class ColumnarWriter:
+    """
+    Writes evaluation results as one table with one row per record, in NumPy (.npz) or Parquet (.parquet, requires pyarrow) format. Text columns are saved as strings ("" for missing values), number columns as float64 (NaN for missing values).
+    Neither format can be appended to, and the columns (KPIs) are only known once all the results are in, so every batch_size rows are spooled to one temporary file per column next to filename. close() then writes the table from these files batch_size rows at a time (.npz members are streamed, Parquet batches become row groups): the memory holds one batch, whatever the number of results
+    """
+
+    def __init__(self,filename,format="npz",batch_size=10000):
+        if format not in COLUMNAR_FORMATS:
+            raise ValueError("Bad format. choices: %s" % ", ".join(COLUMNAR_FORMATS))
+        if format == "parquet" and pyarrow is None:
+            raise RuntimeError("parquet output requires pyarrow")
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.filename = filename
+        self.format = format
+        self.batch_size = batch_size
+        self.rows = 0
+        self.batch = []
+        # column -> spool file, in order of first appearance
+        self.columns = {}
+        # text column -> length of the longest value (width of the NumPy string type)
+        self.widths = {}
+        self.kpi_names = {}
+        self.spool = tempfile.TemporaryDirectory(prefix=".%s." % os.path.basename(filename),dir=os.path.dirname(os.path.abspath(filename)))
+
+    def add(self,name,result):
+        if result is None:
+            return
+        row, kpi_names = flattenResult(name,result)
+        self.kpi_names.update(kpi_names)
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the pending rows to the spool files
+        """
+        for row in self.batch:
+            for column in row:
+                if column not in self.columns:
+                    self.addColumn(column)
+        for column, path in self.columns.items():
+            values = [row.get(column) for row in self.batch]
+            if column in TEXT_COLUMNS:
+                values = ["" if x is None else x for x in values]
+                self.widths[column] = max([self.widths[column]] + [len(x) for x in values])
+                with open(path,"a",encoding="utf-8") as f:
+                    # one JSON string per line, so that values may hold line breaks
+                    f.writelines(json.dumps(x) + "\n" for x in values)
+            else:
+                with open(path,"ab") as f:
+                    numpy.array(values,dtype=float).tofile(f)
+        self.rows += len(self.batch)
+        self.batch = []
+
+    def addColumn(self,column):
+        path = os.path.join(self.spool.name,"%i" % len(self.columns))
+        self.columns[column] = path
+        if column in TEXT_COLUMNS:
+            self.widths[column] = 1
+            with open(path,"w",encoding="utf-8") as f:
+                f.writelines('""\n' for i in range(self.rows))
+        else:
+            # column seen for the first time: earlier rows are missing it
+            with open(path,"wb") as f:
+                for start in range(0,self.rows,self.batch_size):
+                    numpy.full(min(self.batch_size,self.rows - start),numpy.nan).tofile(f)
+
+    def dtype(self,column):
+        if column in TEXT_COLUMNS:
+            return numpy.dtype("<U%i" % self.widths[column])
+        return numpy.dtype(float)
+
+    def iterColumn(self,column):
+        """
+        Generator of the values of a spooled column, as numpy arrays of batch_size values
+        """
+        dtype = self.dtype(column)
+        if column in TEXT_COLUMNS:
+            with open(self.columns[column],encoding="utf-8") as f:
+                values = []
+                for line in f:
+                    values.append(json.loads(line))
+                    if len(values) == self.batch_size:
+                        yield numpy.array(values,dtype=dtype)
+                        values = []
+                if values:
+                    yield numpy.array(values,dtype=dtype)
+        else:
+            with open(self.columns[column],"rb") as f:
+                while True:
+                    values = numpy.fromfile(f,dtype=dtype,count=self.batch_size)
+                    if not len(values):
+                        break
+                    yield values
+
+    def writeNpz(self):
+        # the layout of numpy.savez (uncompressed, so that loading a column does not inflate it), with each member written batch by batch
+        with zipfile.ZipFile(self.filename,"w",zipfile.ZIP_STORED,allowZip64=True) as archive:
+            with archive.open("__kpi_names__.npy","w",force_zip64=True) as f:
+                numpy.lib.format.write_array(f,numpy.array(json.dumps(self.kpi_names)))
+            for column in self.columns:
+                header = {"descr": numpy.lib.format.dtype_to_descr(self.dtype(column)),"fortran_order": False,"shape": (self.rows,)}
+                with archive.open("%s.npy" % column,"w",force_zip64=True) as f:
+                    numpy.lib.format.write_array_header_1_0(f,header)
+                    for values in self.iterColumn(column):
+                        f.write(values.tobytes())
+
+    def writeParquet(self):
+        schema = pyarrow.schema([(column,pyarrow.string() if column in TEXT_COLUMNS else pyarrow.float64()) for column in self.columns])
+        schema = schema.with_metadata({"kpi_names": json.dumps(self.kpi_names)})
+        with pyarrow.parquet.ParquetWriter(self.filename,schema) as writer:
+            columns = [self.iterColumn(column) for column in self.columns]
+            for values in zip(*columns):
+                writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(x,type=field.type) for x, field in zip(values,schema)],schema=schema))
+
+    def close(self):
+        self.flush()
+        try:
+            if self.format == "npz":
+                self.writeNpz()
+            else:
+                self.writeParquet()
+        finally:
+            self.spool.cleanup()
+        print("%i results written to %s" % (self.rows,self.filename))
+
+def readColumnar(filename):
+    """
+    Reads a columnar results table. The columns are loaded in full into memory (.npz members cannot be memory-mapped)
+
+    :returns: dict of column -> numpy array, dict of kpi -> name
+    """
+    if filename.endswith(".parquet"):
+        if pyarrow is None:
+            raise RuntimeError("parquet input requires pyarrow")
+        table = pyarrow.parquet.read_table(filename,memory_map=True)
+        metadata = table.schema.metadata or {}
+        kpi_names = json.loads(metadata.get(b"kpi_names",b"{}"))
+        return {column: table.column(column).to_numpy() for column in table.column_names}, kpi_names
+    content = numpy.load(filename)
+    try:
+        kpi_names = json.loads(str(content["__kpi_names__"]))
+        return {column: content[column] for column in content.files if column != "__kpi_names__"}, kpi_names
+    finally:
+        content.close()
+
+def iterColumnarResults(filename):
+    """
+    Generator of the evaluation results (without comments) of a columnar results table, e.g. for pywmdr.metrics.getMetrics
+    """
+    columns, kpi_names = readColumnar(filename)
+    count = len(columns["name"]) if "name" in columns else 0
+    for i in range(count):
+        result = {}
+        for kpi in sorted(kpi_names):
+            if math.isnan(columns["%s_total" % kpi][i]):
+                continue
+            result[kpi] = {"name": kpi_names[kpi], "comments": {}}
+            for field in KPI_NUMBER_FIELDS:
+                result[kpi][field] = toPython(columns["%s_%s" % (kpi,field)][i])
+        if "total" in columns and not math.isnan(columns["total"][i]):
+            result["summary"] = {"comments": {}}
+            for column in SUMMARY_TEXT_COLUMNS + SUMMARY_NUMBER_COLUMNS:
+                result["summary"][column] = toPython(columns[column][i])
+        yield result
+
+def isResultsDatabase(filename):
+    """
+    :returns: whether filename is an SQLite database with a results table (as written by SQLiteResultsWriter), and not e.g. a record store
+    """
+    if not os.path.isfile(filename) or not RecordStore.is_store(filename):
+        return False
+    connection = sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(filename)),uri=True)
+    try:
+        return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'results'").fetchone() is not None
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        connection.close()
+
+def isJsonLines(filename):
+    return re.search(r"\.jsonl(\.gz)?$",filename) is not None
+
+class JsonLinesWriter:
+    """
+    Writes evaluation results as JSON Lines, one compact {"name": ..., "result": ...} object per line, through a single buffered (and gzip-compressed if filename ends with .gz) file
+    """
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.rows = 0
+        if filename.endswith(".gz"):
+            self.file = gzip.open(filename,"wt",encoding="utf-8")
+        else:
+            self.file = open(filename,"w",encoding="utf-8",buffering=1024*1024)
+
+    def add(self,name,result):
+        if result is None:
+            return
+        self.file.write(json.dumps({"name": name, "result": result},separators=(",",":")))
+        self.file.write("\n")
+        self.rows += 1
+
+    def close(self):
+        self.file.close()
+        print("%i results written to %s" % (self.rows,self.filename))
+
+def iterJsonLines(filename):
+    """
+    Generator of the (name, result) tuples of a JSON Lines results file, read line by line
+    """
+    f = gzip.open(filename,"rt",encoding="utf-8") if filename.endswith(".gz") else open(filename,encoding="utf-8")
+    try:
+        for line in f:
+            if line.strip():
+                content = json.loads(line)
+                yield content["name"], content["result"]
+    finally:
+        f.close()
+
+def openResultsWriter(filename,format):
+    """
+    :returns: results sink (ColumnarWriter, JsonLinesWriter or SQLiteResultsWriter) for one of RESULTS_FORMATS
+    """
+    if format == "sqlite":
+        return SQLiteResultsWriter(filename)
+    if format in JSONL_FORMATS:
+        return JsonLinesWriter(filename)
+    return ColumnarWriter(filename,format)
+
+class SQLiteResultsWriter:
+    """
+    Writes evaluation results into an SQLite database: table results (summary fields, one row per record), kpi_scores (one row per record and KPI) and findings (one row per comment, serialised as JSON as in the JSON sinks; comments which are not a list are kept as a single JSON value, flagged by kpi_scores.single_comment), indexed for the queries of queryResults. A record evaluated again replaces its previous rows. The number columns have no declared type so that values read back are those of the evaluation result (int or float)
+    """
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.rows = 0
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE,
+                identifier TEXT,
+                organisation TEXT,
+                country TEXT,
+                region TEXT,
+                grade TEXT,
+                total,
+                score,
+                percentage);
+            CREATE TABLE IF NOT EXISTS kpi_scores (
+                result_id INTEGER NOT NULL REFERENCES results (id) ON DELETE CASCADE,
+                kpi TEXT NOT NULL,
+                name TEXT,
+                total,
+                score,
+                percentage,
+                number_of_instances INTEGER,
+                single_comment INTEGER,
+                PRIMARY KEY (result_id, kpi));
+            CREATE TABLE IF NOT EXISTS findings (
+                result_id INTEGER NOT NULL REFERENCES results (id) ON DELETE CASCADE,
+                kpi TEXT NOT NULL,
+                comment TEXT);
+        """)
+        # databases written before the comments kept their shape
+        if not hasColumn(self.connection,"kpi_scores","single_comment"):
+            self.connection.execute("ALTER TABLE kpi_scores ADD COLUMN single_comment INTEGER")
+
+    def add(self,name,result):
+        if result is None:
+            return
+        summary = result.get("summary",{})
+        self.connection.execute("DELETE FROM results WHERE name = ?",(name,))
+        cursor = self.connection.execute(
+            "INSERT INTO results (name, identifier, organisation, country, region, grade, total, score, percentage) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [name] + [summary.get(x) for x in SUMMARY_TEXT_COLUMNS + SUMMARY_NUMBER_COLUMNS])
+        result_id = cursor.lastrowid
+        kpi_rows = []
+        findings = []
+        for kpi in [key for key in result if re.search("^kpi_",key) is not None]:
+            kpi_result = result[kpi]
+            single_comment = not isinstance(kpi_result["comments"],list)
+            kpi_rows.append((result_id,kpi,kpi_result["name"],kpi_result["total"],kpi_result["score"],kpi_result["percentage"],kpi_result.get("number_of_instances"),1 if single_comment else None))
+            comments = [kpi_result["comments"]] if single_comment else kpi_result["comments"]
+            findings.extend([(result_id,kpi,json.dumps(comment)) for comment in comments])
+        self.connection.executemany("INSERT INTO kpi_scores (result_id, kpi, name, total, score, percentage, number_of_instances, single_comment) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",kpi_rows)
+        self.connection.executemany("INSERT INTO findings VALUES (?, ?, ?)",findings)
+        self.rows += 1
+        if self.rows % 1000 == 0:
+            self.connection.commit()
+
+    def get(self,name):
+        """
+        :returns: the result saved for the record name (e.g. by a previous run), None if unknown
+        """
+        row = self.connection.execute("SELECT id, name, identifier, organisation, country, region, grade, total, score, percentage FROM results WHERE name = ?",(name,)).fetchone()
+        if row is None:
+            return None
+        return readSQLiteResult(self.connection,row)
+
+    def close(self):
+        # indexes are created once the bulk of the rows is loaded
+        self.connection.executescript("""
+            CREATE INDEX IF NOT EXISTS results_identifier ON results (identifier);
+            CREATE INDEX IF NOT EXISTS results_organisation ON results (organisation);
+            CREATE INDEX IF NOT EXISTS results_country ON results (country);
+            CREATE INDEX IF NOT EXISTS results_region ON results (region);
+            CREATE INDEX IF NOT EXISTS results_grade ON results (grade);
+            CREATE INDEX IF NOT EXISTS kpi_scores_kpi ON kpi_scores (kpi, percentage);
+            CREATE INDEX IF NOT EXISTS findings_result ON findings (result_id, kpi);
+        """)
+        self.connection.commit()
+        self.connection.close()
+        print("%i results written to %s" % (self.rows,self.filename))
+
+def parseFilters(filters):
+    """
+    Parses field=value filters of queryResults. A country or region may be given by the last part of its codelist href (e.g. region=europe)
+
+    :param filters: list of "field=value" strings
+
+    :returns: dict of field -> list of accepted values
+    """
+    parsed = {}
+    for item in filters:
+        if "=" not in item:
+            raise ValueError("Invalid filter %s, expected field=value" % item)
+        field, value = item.split("=",1)
+        if field not in QUERY_FIELDS:
+            raise ValueError("Invalid filter field %s. choices: %s" % (field,", ".join(QUERY_FIELDS)))
+        if field in QUERY_CODELISTS and "/" not in value:
+            value = QUERY_CODELISTS[field] + value
+        parsed.setdefault(field,[]).append(value)
+    return parsed
+
+def selectResults(filters):
+    """
+    :returns: SQL query and parameters selecting the rows of the results table matching the filters (values of the same field are alternatives, fields are combined)
+    """
+    where = []
+    params = []
+    for field, values in filters.items():
+        where.append("%s IN (%s)" % (field,", ".join(["?"] * len(values))))
+        params.extend(values)
+    sql = "SELECT id, name, identifier, organisation, country, region, grade, total, score, percentage FROM results"
+    if len(where):
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY id", params
+
+def queryResults(filename,filters={},kpi=None):
+    """
+    Generator of the summary rows of the results matching the filters, as dicts. If kpi (e.g. kpi_31) is given, its total, score and percentage are added as <kpi>_total, <kpi>_score and <kpi>_percentage
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        sql, params = selectResults(filters)
+        if kpi is not None:
+            sql = "SELECT r.*, k.total, k.score, k.percentage FROM (%s) r LEFT JOIN kpi_scores k ON k.result_id = r.id AND k.kpi = ?" % sql
+            params = params + [kpi]
+        columns = ["id","name"] + SUMMARY_TEXT_COLUMNS + SUMMARY_NUMBER_COLUMNS
+        if kpi is not None:
+            columns = columns + ["%s_%s" % (kpi,x) for x in KPI_NUMBER_FIELDS]
+        for row in connection.execute(sql,params):
+            row = dict(zip(columns,row))
+            row.pop("id")
+            yield row
+    finally:
+        connection.close()
+
+def hasColumn(connection,table,column):
+    """
+    :returns: whether a table of the database has the column
+    """
+    return column in [x[1] for x in connection.execute("PRAGMA table_info(%s)" % table)]
+
+def readSQLiteResult(connection,row):
+    """
+    :param row: row of the results table, as selected by selectResults
+
+    :returns: the evaluation result (summary, KPIs and comments) of the row
+    """
+    result = {}
+    comments = {}
+    for kpi, comment in connection.execute("SELECT kpi, comment FROM findings WHERE result_id = ? ORDER BY rowid",(row[0],)):
+        comments.setdefault(kpi,[]).append(json.loads(comment))
+    single_comment = "single_comment" if hasColumn(connection,"kpi_scores","single_comment") else "NULL"
+    for kpi, name, total, score, percentage, number_of_instances, single in connection.execute("SELECT kpi, name, total, score, percentage, number_of_instances, %s FROM kpi_scores WHERE result_id = ? ORDER BY rowid" % single_comment,(row[0],)):
+        if single:
+            comments[kpi] = comments[kpi][0]
+        result[kpi] = {"name": name, "total": total, "score": score, "comments": comments.get(kpi,[]), "percentage": percentage}
+        if number_of_instances is not None:
+            result[kpi]["number_of_instances"] = number_of_instances
+    if row[7] is not None:
+        result["summary"] = {
+            "total": row[7],
+            "score": row[8],
+            # as generate_summary, the comments of the KPIs which have any
+            "comments": {kpi: x for kpi, x in comments.items() if x},
+            "percentage": row[9],
+            "identifier": row[2],
+            "organisation": row[3],
+            "country": row[4],
+            "region": row[5],
+            "grade": row[6]
+        }
+    return result
+
+def iterSQLiteResults(filename,filters={}):
+    """
+    Generator of the evaluation results (summary, KPIs and comments) matching the filters, e.g. for pywmdr.metrics.getMetrics
+    """
+    connection = sqlite3.connect(filename)
+    kpi_connection = sqlite3.connect(filename)
+    try:
+        sql, params = selectResults(filters)
+        for row in connection.execute(sql,params):
+            yield readSQLiteResult(kpi_connection,row)
+    finally:
+        connection.close()
+        kpi_connection.close()
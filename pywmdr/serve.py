@@ -0,0 +1,139 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+import json
+import os
+import threading
+import time
+import click
+from pywmdr.kpi import WMDRKeyPerformanceIndicators, group_kpi_results
+from pywmdr.util import (get_cli_common_options, get_codelists_from_rdf, get_regions,
+                         get_kpi_evaluation_validator, get_wmdr_schema, parse_wmdr, setup_logger)
+
+# long-running KPI evaluation service: the imports, codelists, regions map and schemas are loaded once, so that a request costs only the evaluation of its document
+
+def warmUp(*args):
+    """
+    Loads the caches used by the KPI evaluation (codelists, WMO regions, schemas) into this process
+    """
+    get_codelists_from_rdf()
+    get_regions()
+    get_kpi_evaluation_validator()
+    for version in ["1.0","1.0RC9"]:
+        try:
+            get_wmdr_schema(version)
+        except Exception as e:
+            # evaluated (and reported) by kpi_10 for each document
+            print("Warning: WMDR schema %s not available: %s" % (version,str(e)))
+    return os.getpid()
+
+def evaluateDocument(content,kpi=0,skip_schema_eval=False,summary=False,group=False):
+    """
+    Evaluates the KPIs of a WMDR document, as pywmdr kpi validate
+
+    :param content: bytes of the WMDR XML document
+
+    :returns: (status, dict) tuple: 200 and the KPI results, or 400 and the error if the document or the KPI is invalid
+    """
+    try:
+        exml = parse_wmdr(BytesIO(content))
+        kpis = WMDRKeyPerformanceIndicators(exml)
+    except Exception as e:
+        return 400, {"error": "invalid WMDR document: %s" % str(e)}
+    try:
+        kpis_results = kpis.evaluate(kpi,skip_schema_eval)
+    except ValueError as e:
+        return 400, {"error": "invalid KPI %s: %s" % (kpi,str(e))}
+    if group and kpi == 0:
+        kpis_results = group_kpi_results(kpis_results)
+    if summary and kpi == 0:
+        kpis_results = kpis_results['summary']
+    return 200, kpis_results
+
+class KPIRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST a WMDR document to / to get its KPI results as JSON. Query parameters: kpi (number of a single KPI), summary, group and skip_schema_eval (true/false). GET / reports the status of the service
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def respond(self,status,content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond(200,{"status": "ok", "workers": self.server.workers, "requests": self.server.requests})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        content = self.rfile.read(length)
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        try:
+            kpi = int(params.get("kpi",0))
+        except ValueError:
+            self.respond(400,{"error": "invalid KPI %s" % params["kpi"]})
+            return
+        flags = {key: params.get(key,"false").lower() in ["true","1","yes"] for key in ["skip_schema_eval","summary","group"]}
+        try:
+            status, result = self.server.evaluate(content,kpi=kpi,**flags)
+        except Exception as e:
+            status, result = 500, {"error": str(e)}
+        self.respond(status,result)
+
+class KPIServer(ThreadingHTTPServer):
+    """
+    HTTP server accepting concurrent requests, whose KPI evaluations run on a pool of worker processes forked after the caches are loaded
+    """
+    daemon_threads = True
+
+    def __init__(self,address=("127.0.0.1",0),workers=None,verbose=False):
+        self.workers = workers or os.cpu_count()
+        self.verbose = verbose
+        self.requests = 0
+        self.lock = threading.Lock()
+        start = time.time()
+        warmUp()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        # start the workers now rather than on the first requests
+        pids = set(self.pool.map(warmUp,range(self.workers)))
+        print("%i workers ready in %.1f s" % (len(pids),time.time() - start))
+        ThreadingHTTPServer.__init__(self,address,KPIRequestHandler)
+
+    @property
+    def endpoint(self):
+        return "http://%s:%i/" % self.server_address[:2]
+
+    def evaluate(self,content,**kwargs):
+        with self.lock:
+            self.requests += 1
+        return self.pool.submit(evaluateDocument,content,**kwargs).result()
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.pool.shutdown()
+
+@click.command()
+@click.pass_context
+@get_cli_common_options
+@click.option('--host', '-H', type=str, default="127.0.0.1", show_default=True, help='Address to listen on')
+@click.option('--port', '-P', type=int, default=8080, show_default=True, help='Port to listen on')
+@click.option('--workers', '-w', type=int, help='Number of worker processes evaluating documents. Defaults to the number of CPUs')
+def serve(ctx,host,port,workers,logfile,verbosity):
+    """local HTTP service evaluating the KPIs of POSTed WMDR documents"""
+    setup_logger(verbosity, logfile)
+    server = KPIServer((host,port),workers=workers,verbose=verbosity is not None)
+    print("serving KPI evaluations at %s" % server.endpoint)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
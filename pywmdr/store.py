@@ -0,0 +1,271 @@
+# packed store of harvested WMDR records
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+LOGGER = logging.getLogger(__name__)
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def content_hash(content: bytes) -> str:
+    """
+    Helper function to compute the hash stored along with each record
+
+    :param content: raw record bytes
+
+    :returns: `str` of hex sha256 digest
+    """
+
+    return hashlib.sha256(content).hexdigest()
+
+
+class RecordStore:
+    """
+    Append-only store of raw WMDR records in a single SQLite file
+
+    Every harvested version of a record (or its deletion) is appended as a
+    new row. The latest row of an identifier wins, so the store can be
+    read by identifier or streamed sequentially without touching one
+    file per station.
+    """
+
+    def __init__(self, filename: str, read_only: bool = False):
+        """
+        initializer
+
+        :param filename: path of the SQLite file (created if missing)
+        :param read_only: open an existing store without writing to it
+                          (no table creation, no journal mode change)
+
+        :returns: `pywmdr.store.RecordStore`
+        """
+
+        self.filename = filename
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.connection = self._connect(check_same_thread=False)
+        if read_only:
+            return
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'identifier TEXT NOT NULL, '
+            'datestamp TEXT, '
+            'hash TEXT, '
+            'deleted INTEGER NOT NULL DEFAULT 0, '
+            'content BLOB)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS records_identifier ON records (identifier, seq)')
+        self.connection.commit()
+
+    def _connect(self, **kwargs) -> sqlite3.Connection:
+        """
+        Helper function to open a connection to the store, read-only if so
+        configured
+
+        :returns: `sqlite3.Connection`
+        """
+
+        if self.read_only:
+            uri = f'file:{pathname2url(os.path.abspath(self.filename))}?mode=ro'
+            return sqlite3.connect(uri, uri=True, **kwargs)
+        return sqlite3.connect(self.filename, **kwargs)
+
+    @staticmethod
+    def is_store(filename: str) -> bool:
+        """
+        Helper function to tell a record store from an XML file
+
+        :param filename: path to check
+
+        :returns: `bool` of whether the file is an SQLite database
+        """
+
+        try:
+            with open(filename, 'rb') as fh:
+                return fh.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+        except OSError:
+            return False
+
+    def put(self, identifier: str, content: bytes, datestamp: str = None) -> int:
+        """
+        Append a record version
+
+        :param identifier: record identifier
+        :param content: raw record bytes
+        :param datestamp: OAI datestamp of the record
+
+        :returns: `int` sequence number of the new row
+        """
+
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO records (identifier, datestamp, hash, deleted, content) VALUES (?, ?, ?, 0, ?)',
+                (identifier, datestamp, content_hash(content), content))
+        return cursor.lastrowid
+
+    def delete(self, identifier: str, datestamp: str = None) -> int:
+        """
+        Append a tombstone for a record deleted at the provider
+
+        :param identifier: record identifier
+        :param datestamp: OAI datestamp of the deletion
+
+        :returns: `int` sequence number of the new row
+        """
+
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO records (identifier, datestamp, hash, deleted, content) VALUES (?, ?, NULL, 1, NULL)',
+                (identifier, datestamp))
+        return cursor.lastrowid
+
+    def put_if_newer(self, identifier: str, datestamp: str = None,
+                     content: bytes = None) -> bool:
+        """
+        Append a record version, or a tombstone if content is `None`,
+        unless it is already the latest version of the record or older
+        than it. The check and the insert hold the lock together, so
+        concurrent harvests of overlapping partitions cannot interleave.
+
+        :param identifier: record identifier
+        :param datestamp: OAI datestamp of the version or of the deletion
+        :param content: raw record bytes, `None` for a deletion
+
+        :returns: `bool` of whether a row was appended
+        """
+
+        deleted = content is None
+        hash_ = None if deleted else content_hash(content)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT datestamp, hash, deleted FROM records WHERE identifier = ? ORDER BY seq DESC LIMIT 1',
+                (identifier,)).fetchone()
+            if row is not None:
+                latest_datestamp, latest_hash, latest_deleted = row
+                if deleted and latest_deleted:
+                    return False
+                if not deleted and not latest_deleted and latest_hash == hash_:
+                    return False
+                if latest_datestamp is not None and datestamp is not None and latest_datestamp > datestamp:
+                    # a newer version was merged already
+                    return False
+            self.connection.execute(
+                'INSERT INTO records (identifier, datestamp, hash, deleted, content) VALUES (?, ?, ?, ?, ?)',
+                (identifier, datestamp, hash_, int(deleted), content))
+        return True
+
+    def commit(self):
+        """Commit appended rows to disk"""
+
+        with self.lock:
+            self.connection.commit()
+
+    def latest(self, identifier: str) -> dict:
+        """
+        Get the latest row (without content) of a record
+
+        :param identifier: record identifier
+
+        :returns: `dict` with identifier, datestamp, hash and deleted, or `None` if unknown
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT identifier, datestamp, hash, deleted FROM records WHERE identifier = ? ORDER BY seq DESC LIMIT 1',
+                (identifier,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'identifier': row[0],
+            'datestamp': row[1],
+            'hash': row[2],
+            'deleted': bool(row[3])
+        }
+
+    def get(self, identifier: str) -> bytes:
+        """
+        Random access to the latest version of a record
+
+        :param identifier: record identifier
+
+        :returns: `bytes` of the record or `None` if unknown or deleted
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT deleted, content FROM records WHERE identifier = ? ORDER BY seq DESC LIMIT 1',
+                (identifier,)).fetchone()
+        if row is None or row[0]:
+            return None
+        return row[1]
+
+    def iter_records(self, include_deleted: bool = False):
+        """
+        Stream the latest version of every record in harvest order
+
+        :param include_deleted: also yield tombstones (content is `None`)
+
+        :returns: generator of (identifier, datestamp, content) tuples
+        """
+
+        # a separate connection so that streaming does not hold the lock
+        connection = self._connect()
+        try:
+            cursor = connection.execute(
+                'SELECT r.identifier, r.datestamp, r.deleted, r.content FROM records r '
+                'JOIN (SELECT MAX(seq) AS seq FROM records GROUP BY identifier) l ON r.seq = l.seq '
+                'ORDER BY r.seq')
+            for identifier, datestamp, deleted, content in cursor:
+                if deleted and not include_deleted:
+                    continue
+                yield identifier, datestamp, content
+        finally:
+            connection.close()
+
+    def tombstones(self) -> dict:
+        """
+        Get the records whose latest version is a deletion
+
+        :returns: `dict` of identifier -> datestamp of deletion
+        """
+
+        return {identifier: datestamp for identifier, datestamp, content
+                in self.iter_records(include_deleted=True) if content is None}
+
+    def __len__(self) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT COUNT(*) FROM records r '
+                'JOIN (SELECT MAX(seq) AS seq FROM records GROUP BY identifier) l ON r.seq = l.seq '
+                'WHERE r.deleted = 0').fetchone()
+        return row[0]
+
+    def compact(self):
+        """Drop superseded record versions and reclaim space"""
+
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM records WHERE seq NOT IN (SELECT MAX(seq) FROM records GROUP BY identifier)')
+            self.connection.commit()
+            self.connection.execute('VACUUM')
+
+    def close(self):
+        """Commit and close the store"""
+
+        if not self.read_only:
+            self.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -9,10 +9,12 @@
 #
 # =================================================================
 
+from functools import lru_cache
 import logging
 import os
 import ssl
 import sys
+import threading
 from datetime import datetime, timezone, timedelta
 from dateutil.parser import parse
 from urllib.error import URLError
@@ -28,9 +30,9 @@ tzwhere = tzwhere.tzwhere()
 from pywmdr.timezone_codelist import makeCodelist, timezone_to_offset
 tz_codelist = makeCodelist()
 import isodate
+import copy
 import json
 import jsonschema
-from jsonschema import validate
 from lxml import etree
 import traceback
 
@@ -96,9 +98,12 @@ def get_cli_common_options(function):
 
 #     return codelists
 
+@lru_cache(maxsize=None)
 def get_codelists_from_rdf():
     """
-    Helper function to assemble dict of WMO codelists from RDF XML files
+    Helper function to assemble dict of WMO codelists from RDF XML files.
+    The files are parsed once per process and the same dict is returned
+    to every caller, which must not modify it
 
     :returns: `dict` of WMO codelists
 
@@ -149,6 +154,20 @@ def get_codelists_from_rdf():
 
     return codelists
 
+@lru_cache(maxsize=None)
+def get_codelist_index(name: str) -> frozenset:
+    """
+    Helper function to get the lowercased values of a WMO codelist as a
+    set, for constant time (case insensitive) lookups, e.g. in
+    `validate_text`
+
+    :param name: name of the codelist (see `get_codelists_from_rdf`)
+
+    :returns: `frozenset` of lowercased codelist values
+    """
+
+    return frozenset(item.lower() for item in get_codelists_from_rdf()[name])
+
 def get_string_or_anchor_value(parent) -> list:
     """
     Returns list of strings (texts) from CharacterString or Anchor child elements of the given element
@@ -367,6 +386,59 @@ def check_url(url: str, check_ssl: bool) -> dict:
     return result
 
 
+_local = threading.local()
+
+def get_wmdr_parser(huge_tree: bool = False, preserve: bool = False):
+    """
+    Helper function to get the XML parser of WMDR documents. A parser is
+    created once per thread and configuration (a parser must not be used
+    by two threads at once) and reused for every document. It does not
+    access the network, load DTDs or resolve entities. Unless preserve is
+    set, blank text and comments are dropped, which makes parsing faster
+    and trees smaller. xml:id attributes are not collected (WMDR uses
+    gml:id), which saves a hash table per document but leaves
+    `etree.getelementbyid` and the XPath id() function without results
+
+    :param huge_tree: lift the libxml2 limits on text size and tree depth,
+                      for very large documents (e.g. saved ListRecords
+                      pages)
+    :param preserve: keep blank text and comments, for documents that are
+                     serialised again (e.g. harvested records)
+
+    :returns: `etree.XMLParser`
+    """
+
+    if not hasattr(_local, 'wmdr_parsers'):
+        _local.wmdr_parsers = {}
+    key = (huge_tree, preserve)
+    if key not in _local.wmdr_parsers:
+        _local.wmdr_parsers[key] = etree.XMLParser(
+            remove_blank_text=not preserve, remove_comments=not preserve,
+            no_network=True, load_dtd=False, resolve_entities=False,
+            huge_tree=huge_tree, collect_ids=False)
+    return _local.wmdr_parsers[key]
+
+def get_wmdr_schema(version="1.0"):
+    """
+    Helper function to get the compiled WMDR XML Schema of a version.
+    The schema is compiled once per thread (an XMLSchema object keeps the
+    error log of its last validation, so it is not shared between threads)
+
+    :param version: WMDR version (1.0 or 1.0RC9)
+
+    :returns: `etree.XMLSchema`
+    """
+
+    if not hasattr(_local, 'wmdr_schemas'):
+        _local.wmdr_schemas = {}
+    if version not in _local.wmdr_schemas:
+        userdir = get_userdir()
+        if not os.path.exists(userdir):
+            raise IOError(f'{userdir} does not exist')
+        xsd = os.path.join(userdir, "schema","xsd", version, 'wmdr.xsd')
+        _local.wmdr_schemas[version] = etree.XMLSchema(etree.parse(xsd))
+    return _local.wmdr_schemas[version]
+
 def validate_wmdr_xml(xml,version="1.0"):
     """
     Perform XML Schema validation of WMDR Metadata
@@ -376,86 +448,453 @@ def validate_wmdr_xml(xml,version="1.0"):
     :returns: `bool` of whether XML validates WMDR schema
     """
 
-    userdir = get_userdir()
-    if not os.path.exists(userdir):
-        raise IOError(f'{userdir} does not exist')
     if isinstance(xml, str):
         xml = etree.fromstring(xml)
-    xsd = os.path.join(userdir, "schema","xsd", version, 'wmdr.xsd')
-    LOGGER.debug(f'Validating {xml} against schema {xsd}')
-    schema = etree.XMLSchema(etree.parse(xsd))
+    LOGGER.debug(f'Validating {xml} against schema {version}')
+    schema = get_wmdr_schema(version)
     schema.assertValid(xml)
 
-def validate_kpi_evaluation_result(json_data):
+@lru_cache(maxsize=None)
+def get_kpi_evaluation_validator():
     """
-    Peform JSON Schema validation of KPI evaluation result
-    
-    :param json_data: object or JSON string
-    
-    :returns: `bool` of whether JSON validates KPIEvaluation schema
+    Helper function to load the KPIEvaluation JSON Schema, check it and
+    compile its validator, once per process
+
+    :returns: `jsonschema` validator instance
     """
 
     userdir = get_userdir()
     if not os.path.exists(userdir):
         raise IOError(f'{userdir} does not exist')
-    if isinstance(json_data, str):
-        json_data = json.loads(json_data)
     schema_location = os.path.join(userdir, "schema","json", 'KPIEvaluation.json')
-    # LOGGER.debug(f'Validating {json_data} against schema {schema}')
     f = open(schema_location)
     schema = json.load(f)
     f.close()
-    try:
-        validate(instance=json_data, schema=schema)
-    except jsonschema.exceptions.ValidationError:
-        LOGGER.error("Given JSON data is invalid KPIEvaluation:")
-        traceback.print_exc()        
-        return False
-    return True
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
 
+def validate_kpi_evaluation_result(json_data):
+    """
+    Peform JSON Schema validation of KPI evaluation result
+    
+    :param json_data: object or JSON string
+    
+    :returns: `bool` of whether JSON validates KPIEvaluation schema
+    """
+
+    return next(validate_kpi_evaluation_results([json_data]))[1]
 
-def parse_wmdr(content):
+def validate_kpi_evaluation_results(results):
+    """
+    Peform JSON Schema validation of a stream of KPI evaluation results
+    with the cached validator
+
+    :param results: iterable of objects or JSON strings
+
+    :returns: generator of (object, `bool` of whether it validates
+              KPIEvaluation schema) tuples
+    """
+
+    validator = get_kpi_evaluation_validator()
+    for json_data in results:
+        if isinstance(json_data, str):
+            json_data = json.loads(json_data)
+        try:
+            validator.validate(json_data)
+        except jsonschema.exceptions.ValidationError:
+            LOGGER.error("Given JSON data is invalid KPIEvaluation:")
+            traceback.print_exc()
+            yield json_data, False
+            continue
+        yield json_data, True
+
+
+def parse_wmdr(content, huge_tree: bool = False):
     """
     Parse a buffer into an etree ElementTree
 
     :param content: str of xml content
+    :param huge_tree: parse very large documents (see `get_wmdr_parser`)
 
     :returns: `lxml.etree._ElementTree` object of WMDR
     """
 
     try:
-        exml = etree.parse(content)
+        exml = etree.parse(content, get_wmdr_parser(huge_tree))
     except etree.XMLSyntaxError as err:
         LOGGER.error(err)
         raise RuntimeError('Syntax error')
 
-    root_tag = exml.getroot().tag
-
-#    if root_tag != '{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord' and root_tag != '{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord':
-#        raise RuntimeError('Does not look like a WMDR document!')
-    if root_tag != "{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord":
-        LOGGER.debug("0.rtag: %s" % root_tag)
-        wigosmetadatarecord = exml.getroot().find('.//{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord')
-        if wigosmetadatarecord is None:
-            LOGGER.debug("http://def.wmo.int/wmdr/1.0 tag not found")
-            if root_tag != '{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord':
-                LOGGER.debug("root tag not http://def.wmo.int/wmdr/2017")
-                wigosmetadatarecord = exml.getroot().find('{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord')
-                if wigosmetadatarecord is None:
-                    LOGGER.debug("tag http://def.wmo.int/wmdr/2017 not found")
-                    raise RuntimeError('Does not look like a WMDR document!')
-                else:
-                    exml._setroot(wigosmetadatarecord)
-            LOGGER.debug("Warning: document is wmdr/2017 (1.0RC9)!")
-            #self.version = "1.0RC9"
-        else:
-            exml._setroot(wigosmetadatarecord)
-            #self.version = "1.0"
-    #else:
-        #self.version = "1.0"
-        
+    detect_wmdr_root(exml)
+
     return exml
 
+
+WMDR_RECORD_TAGS = ('{http://def.wmo.int/wmdr/1.0}WIGOSMetadataRecord',
+                    '{http://def.wmo.int/wmdr/2017}WIGOSMetadataRecord')
+OAI_NAMESPACE = 'http://www.openarchives.org/OAI/2.0/'
+
+WMDR_VERSIONS = {WMDR_RECORD_TAGS[0]: '1.0', WMDR_RECORD_TAGS[1]: '1.0RC9'}
+
+
+def detect_wmdr_root(exml) -> str:
+    """
+    Locates the WIGOSMetadataRecord of a parsed document (the root, a
+    descendant WMDR 1.0 record, e.g. in an OAI envelope, or a child
+    WMDR 2017 record) and makes it the root of the tree
+
+    :param exml: `lxml.etree._ElementTree` object
+
+    :returns: `str` of WMDR version (1.0 or 1.0RC9)
+    """
+
+    root = exml.getroot()
+    version = WMDR_VERSIONS.get(root.tag)
+    if version is not None:
+        if version == '1.0RC9':
+            LOGGER.debug('Warning: document is wmdr/2017 (1.0RC9)!')
+        return version
+
+    LOGGER.debug(f'0.rtag: {root.tag}')
+    record = root.find(f'.//{WMDR_RECORD_TAGS[0]}')
+    if record is not None:
+        exml._setroot(record)
+        return '1.0'
+
+    LOGGER.debug('http://def.wmo.int/wmdr/1.0 tag not found')
+    record = root.find(WMDR_RECORD_TAGS[1])
+    if record is None:
+        LOGGER.debug('tag http://def.wmo.int/wmdr/2017 not found')
+        raise RuntimeError('Does not look like a WMDR document!')
+    exml._setroot(record)
+    LOGGER.debug('Warning: document is wmdr/2017 (1.0RC9)!')
+    return '1.0RC9'
+
+
+def sniff_wmdr(source, max_events: int = 64) -> str:
+    """
+    Classifies a document from its first start tags, without building
+    the whole tree
+
+    :param source: filename or seekable binary file-like object (read
+                   from its current position)
+    :param max_events: number of start tags searched for a
+                       WIGOSMetadataRecord under another root element.
+                       Past them, the whole document is parsed and
+                       searched as by detect_wmdr_root
+
+    :returns: `str` of WMDR version (1.0 or 1.0RC9) of the record, `oai`
+              for an OAI-PMH response, or `None` if the document is not
+              a WMDR document
+    """
+
+    position = None if isinstance(source, str) else source.tell()
+    try:
+        for count, (event, element) in enumerate(
+                etree.iterparse(source, events=('start',), huge_tree=True)):
+            if count == 0 and element.tag == f'{{{OAI_NAMESPACE}}}OAI-PMH':
+                return 'oai'
+            version = WMDR_VERSIONS.get(element.tag)
+            if version is not None:
+                # as detect_wmdr_root, a WMDR 2017 record is only found
+                # as root or child of the root
+                if version == '1.0' or count == 0 or \
+                        element.getparent().getparent() is None:
+                    return version
+            if count >= max_events:
+                break
+        else:
+            return None
+    except etree.XMLSyntaxError as err:
+        LOGGER.debug(f'not a WMDR document: {err}')
+        return None
+
+    LOGGER.debug(f'no WIGOSMetadataRecord in the first {max_events} start tags, parsing the whole document')
+    if position is not None:
+        source.seek(position)
+    try:
+        return detect_wmdr_root(etree.parse(source, get_wmdr_parser(huge_tree=True)))
+    except (etree.XMLSyntaxError, RuntimeError) as err:
+        LOGGER.debug(f'not a WMDR document: {err}')
+        return None
+
+
+def read_wmdr_identifier(source) -> str:
+    """
+    Reads the WIGOS identifier of the facility of a WMDR record (the
+    gml:identifier of its ObservingFacility, as
+    `WMDRKeyPerformanceIndicators.identifier`) without parsing the whole
+    document: parsing stops at the identifier, which comes first in the
+    facility
+
+    :param source: filename, seekable binary file-like object (read from
+                   and rewound to its current position) or parsed
+                   WIGOSMetadataRecord element
+
+    :returns: `str` of the identifier, or an empty string if the record
+              has none or is not well-formed
+    """
+
+    if isinstance(source, etree._Element):
+        namespace = etree.QName(source).namespace
+        xpath = f'{{{namespace}}}facility/{{{namespace}}}ObservingFacility/{{{source.nsmap.get("gml")}}}identifier'
+        for element in source.iterfind(xpath):
+            if element.text is not None:
+                return element.text
+        return ''
+
+    position = None if isinstance(source, str) else source.tell()
+    try:
+        for event, element in etree.iterparse(
+                source, events=('end',), tag='{*}identifier', no_network=True,
+                resolve_entities=False, huge_tree=True):
+            facility = element.getparent()
+            if element.text is None or facility is None or \
+                    etree.QName(facility).localname != 'ObservingFacility':
+                continue
+            record = facility.getparent().getparent() if facility.getparent() is not None else None
+            if record is not None and record.tag in WMDR_RECORD_TAGS and \
+                    facility.tag == f'{{{etree.QName(record).namespace}}}ObservingFacility' and \
+                    element.tag == f'{{{record.nsmap.get("gml")}}}identifier':
+                return element.text
+    except etree.XMLSyntaxError as err:
+        LOGGER.debug(f'not a WMDR document: {err}')
+    finally:
+        if position is not None:
+            source.seek(position)
+    return ''
+
+
+# XML declaration (and not e.g. an <?xml-stylesheet ...?> instruction)
+XML_DECLARATION = re.compile(rb'<\?xml\s')
+# start tag, whose attribute values may hold '>'; group 2 is '/' if empty
+START_TAG = re.compile(
+    rb'<([^\s/>!?][^\s/>]*)'
+    rb'(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+DOCTYPE = re.compile(rb'<!(?:[^\[>]|\[[^\]]*\])*>')
+# markup whose content is not scanned for the end of a document (it may
+# hold a root end tag or an XML declaration), and its terminator
+MARKUP_TERMINATORS = {b'<!--': b'-->', b'<![CDATA[': b']]>', b'<?': b'?>'}
+
+
+def find_root_start_tag(data: bytes):
+    """
+    Helper function to find the start tag of the root element of an XML
+    document, skipping the XML declaration, processing instructions,
+    comments and the document type declaration
+
+    :param data: start of the document
+
+    :returns: (name, end) tuple of the root element name and, if the root
+              element is empty (<root/>), the offset just after it (else
+              `None`), or `None` if data does not hold the start tag yet
+    """
+
+    i = 0
+    while True:
+        i = data.find(b'<', i)
+        if i < 0:
+            return None
+        if data.startswith(b'<?', i):
+            i = data.find(b'?>', i)
+            if i < 0:
+                return None
+            i += 2
+        elif data.startswith(b'<!--', i):
+            i = data.find(b'-->', i + 4)
+            if i < 0:
+                return None
+            i += 3
+        elif data.startswith(b'<!', i):
+            match = DOCTYPE.match(data, i)
+            if match is None:
+                return None
+            i = match.end()
+        else:
+            match = START_TAG.match(data, i)
+            if match is None:
+                return None
+            return match.group(1), match.end() if match.group(2) else None
+
+
+def find_document_end(data: bytes, i: int, terminator: bytes, root_end: bytes,
+                      declaration_from: int = 1, eof: bool = False) -> tuple:
+    """
+    Helper function to scan a document of iter_document_chunks for its
+    end: the end tag of its root element or the XML declaration of the
+    next document, outside of comments, CDATA sections and processing
+    instructions
+
+    :param data: data of the document
+    :param i: offset to scan from (as returned by the previous scan)
+    :param terminator: terminator of the comment, CDATA section or
+                       processing instruction open at i, or `None`
+    :param root_end: start of the end tag of the root element (e.g.
+                     b'</root'), or `None` if it is not known yet
+    :param declaration_from: offset from which an XML declaration starts
+                             the next document
+    :param eof: data holds the end of the stream
+
+    :returns: (end, i, terminator) tuple of the offset just after the
+              document (`None` if data does not hold it yet) and the offset
+              and terminator to scan more data from
+    """
+
+    patterns = [re.escape(start) for start in MARKUP_TERMINATORS]
+    if root_end is not None:
+        patterns.append(re.escape(root_end) + rb'[\s>]')
+    markup = re.compile(b'|'.join(patterns))
+    # markup may be cut at the end of data
+    longest = max(len(start) for start in MARKUP_TERMINATORS)
+    if root_end is not None:
+        longest = max(longest, len(root_end) + 1)
+
+    while True:
+        if terminator is not None:
+            k = data.find(terminator, i)
+            if k < 0:
+                return None, max(i, len(data) - len(terminator) + 1), terminator
+            i = k + len(terminator)
+            terminator = None
+        match = markup.search(data, i)
+        if match is None:
+            return None, len(data) if eof else max(i, len(data) - longest + 1), None
+        j = match.start()
+        start = match.group()
+        if start not in MARKUP_TERMINATORS:
+            k = data.find(b'>', j)
+            if k < 0:
+                return None, j, None
+            return k + 1, k + 1, None
+        if start == b'<?':
+            if not eof and len(data) - j < len(b'<?xml '):
+                return None, j, None
+            if j >= declaration_from and XML_DECLARATION.match(data, j):
+                return j, j, None
+        i, terminator = match.end(), MARKUP_TERMINATORS[start]
+
+
+def iter_document_chunks(stream, chunk_size: int = 65536):
+    """
+    Split a byte stream of concatenated XML documents (optionally
+    separated by NUL bytes) as it is read. A document ends with the end tag
+    of its root element (or its start tag if it is empty), at a NUL byte or
+    before the XML declaration of the next document. End tags and
+    declarations in comments, CDATA sections and processing instructions
+    are skipped (see find_document_end)
+
+    :param stream: binary file-like object (e.g. sys.stdin.buffer)
+    :param chunk_size: number of bytes to read at a time
+
+    :returns: generator of `bytes` chunks of the current document,
+              and `None` at the end of each document
+    """
+
+    data = b''
+    started = False
+    root_end = None
+    empty_end = None
+    # offset and open terminator to scan the document from
+    scan = (0, None)
+    eof = False
+    while not eof:
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        data += chunk
+        while True:
+            if not started:
+                stripped = data.lstrip(b' \t\r\n\0')
+                scan = (max(0, scan[0] - len(data) + len(stripped)), scan[1])
+                data = stripped
+            if root_end is None:
+                root = find_root_start_tag(data)
+                if root is not None:
+                    root_end = b'</' + root[0]
+                    empty_end = root[1]
+            # a declaration at the start of a document belongs to it
+            end, i, terminator = find_document_end(data, scan[0], scan[1], root_end,
+                                                   0 if started else 1, eof)
+            scan = (i, terminator)
+            boundaries = [i + 1 for i in [data.find(b'\0')] if i >= 0]
+            if end is not None:
+                boundaries.append(end)
+            if empty_end is not None:
+                boundaries.append(empty_end)
+            if not boundaries:
+                break
+            i = min(boundaries)
+            if data[:i].strip(b' \t\r\n\0'):
+                yield data[:i].rstrip(b'\0')
+                started = True
+            if started:
+                yield None
+            started = False
+            root_end = None
+            empty_end = None
+            scan = (0, None)
+            data = data[i:]
+        if eof:
+            if data.strip(b' \t\r\n\0'):
+                yield data
+                started = True
+            if started:
+                yield None
+        elif root_end is not None and scan[0] > 0:
+            # the data scanned already is part of the document
+            yield data[:scan[0]]
+            started = True
+            data = data[scan[0]:]
+            scan = (0, scan[1])
+
+
+def iter_wmdr_records(stream, chunk_size: int = 65536):
+    """
+    Incrementally parse the WIGOSMetadataRecord elements of a byte stream
+    of WMDR documents or OAI-PMH responses (see iter_document_chunks).
+    Each record is yielded as soon as its end tag is read, then dropped
+    from the document being parsed
+
+    :param stream: binary file-like object
+    :param chunk_size: number of bytes to read at a time
+
+    :returns: generator of (identifier, record, error) tuples: the OAI
+              identifier of the record (`None` outside of OAI-PMH
+              responses), a detached copy of the WIGOSMetadataRecord element
+              and `None`, or `None`, `None` and the error message of a
+              document that is not well-formed (its remaining records are
+              skipped)
+    """
+
+    parser = None
+    for chunk in iter_document_chunks(stream, chunk_size):
+        if parser is None:
+            parser = etree.XMLPullParser(events=('end',), tag=WMDR_RECORD_TAGS,
+                                         remove_blank_text=False, huge_tree=True)
+            failed = False
+        try:
+            if chunk is None:
+                parser.close()
+            elif not failed:
+                parser.feed(chunk)
+        except etree.XMLSyntaxError as err:
+            if not failed:
+                failed = True
+                yield None, None, str(err)
+        if not failed:
+            for event, element in parser.read_events():
+                identifier = None
+                record = element
+                if element.getparent() is not None and element.getparent().tag == f'{{{OAI_NAMESPACE}}}metadata':
+                    record = element.getparent().getparent()
+                    identifier = record.findtext(f'{{{OAI_NAMESPACE}}}header/{{{OAI_NAMESPACE}}}identifier')
+                yield identifier, copy.deepcopy(element), None
+                element.clear()
+                while record.getparent() is not None and record.getprevious() is not None:
+                    del record.getparent()[0]
+        if chunk is None:
+            parser = None
+
 def get_coordinates(self):
     xpath = './wmdr:facility/wmdr:ObservingFacility/wmdr:geospatialLocation/wmdr:GeospatialLocation/wmdr:geoLocation/gml:Point/gml:pos'
     match = self.exml.xpath(xpath,namespaces=self.namespaces)
@@ -479,11 +918,21 @@ def get_coordinates(self):
     return lon, lat
 
 
-def get_region(lon,lat,getNotation=False):
+@lru_cache(maxsize=None)
+def get_regions():
+    """
+    Helper function to read the WMO regions map, once per process
+
+    :returns: `GeoDataFrame` of WMO regions
+    """
 
     userdir = get_userdir()
     regions_geojson_file = f'{userdir}/schema/resources/maps/WMO_regions.json'
-    regions = gpd_read_file(regions_geojson_file)
+    return gpd_read_file(regions_geojson_file)
+
+def get_region(lon,lat,getNotation=False):
+
+    regions = get_regions()
 
     st0 = Point(lon,lat)
 
@@ -571,6 +1020,12 @@ def is_within_timezone(lon,lat,tzid):
 def validate_url(url):
     return validators.url(url)
 
+@lru_cache(maxsize=4096)
+def is_valid_url(url) -> bool:
+    # validators.url is slow and the same URLs recur across the instances
+    # of a record (e.g. documentation URLs of log entries)
+    return bool(validators.url(url))
+
 def get_href_and_validate(exml,xpath,namespaces,codelist,element_name,attr_name=None,case_sensitive=False):
     # finds reference and validates against codelist
     # returns score, comments, value
@@ -701,8 +1156,8 @@ def validate_text(text,type="integer",element_name="element",min_length=1,codeli
             LOGGER.debug("%s is not a valid string" % element_name)
             comments.append("%s is not a valid string" % element_name)
         else:
-            if not validators.url(value):
-                if not validators.url('https://%s' % value):
+            if not is_valid_url(value):
+                if not is_valid_url('https://%s' % value):
                     LOGGER.debug("%s is not a valid URL" % element_name)
                     comments.append("%s is not a valid URL" % element_name)
                 else:
@@ -727,7 +1182,9 @@ def validate_text(text,type="integer",element_name="element",min_length=1,codeli
     elif type == "href":
         value = str(text)
         if(not caseSensitive):
-            codelist = [item.lower() for item in codelist]
+            # an index (see get_codelist_index) is lowercased already
+            if not isinstance(codelist,frozenset):
+                codelist = [item.lower() for item in codelist]
             value = value.lower()
         if value not in codelist:
             LOGGER.debug('%s not present in codelist' % element_name)
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from pywmdr.oai import startServer
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+
+@pytest.fixture
+def example_files():
+    """Record files of the examples directory"""
+    return [os.path.join(EXAMPLES, name) for name in ("northolt.xml", "wmdr_example_facility_0-2008-0-JFJ.xml")]
+
+
+@pytest.fixture
+def record_dir(tmp_path, example_files):
+    """Directory holding the example record files, as served by pywmdr oai"""
+    directory = tmp_path / "records"
+    directory.mkdir()
+    for file in example_files:
+        os.symlink(file, directory / os.path.basename(file))
+    return str(directory)
+
+
+@pytest.fixture
+def server(record_dir):
+    """OAI-PMH stand-in server of 6 records (3 copies of each example) in pages of 2 and 2 sets"""
+    server = startServer(record_dir, page_size=2, copies=3, sets=2)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def all_example_files():
+    """All WMDR record files of the examples directory"""
+    return sorted(os.path.join(EXAMPLES, name) for name in os.listdir(EXAMPLES) if name.endswith(".xml"))
+
+
+@pytest.fixture(scope="session")
+def results(all_example_files):
+    """Evaluation results of the example records (without schema evaluation)"""
+    from pywmdr.metrics import parseAndEvaluate
+    return [parseAndEvaluate(file, skip_schema_eval=True) for file in all_example_files]
@@ -0,0 +1,129 @@
+import json
+import os
+
+import pytest
+from lxml import etree
+
+from pywmdr.harvest import addTombstones, clearTombstones, parseListRecords, parseRecordsFiles, readTombstones, writeRecordContent
+from pywmdr.store import RecordStore
+
+OAI = "http://www.openarchives.org/OAI/2.0/"
+WMDR = "http://def.wmo.int/wmdr/2017"
+
+
+def list_records(*records):
+    """Build a ListRecords element from (identifier, datestamp, deleted) tuples"""
+    xml = ['<OAI-PMH xmlns="%s"><ListRecords>' % OAI]
+    for identifier, datestamp, deleted in records:
+        status = ' status="deleted"' if deleted else ''
+        xml.append('<record><header%s><identifier>%s</identifier><datestamp>%s</datestamp></header>' % (status, identifier, datestamp))
+        if not deleted:
+            xml.append('<metadata><wmdr:WIGOSMetadataRecord xmlns:wmdr="%s" gml:id="%s" xmlns:gml="http://www.opengis.net/gml/3.2" version="%s"/></metadata>' % (WMDR, identifier, datestamp))
+        xml.append('</record>')
+    xml.append('</ListRecords></OAI-PMH>')
+    return etree.fromstring("".join(xml).encode()).find("{%s}ListRecords" % OAI)
+
+
+def header(identifier, datestamp):
+    return {"identifier": identifier, "datestamp": datestamp, "deleted": True}
+
+
+def test_add_tombstones_counts_only_new(tmp_path):
+    assert addTombstones([header("a", "2024-01-01")], str(tmp_path)) == 1
+    assert addTombstones([header("a", "2024-01-01"), header("b", "2024-01-02")], str(tmp_path)) == 1
+    assert readTombstones(str(tmp_path / "tombstones.json")) == {"a": "2024-01-01", "b": "2024-01-02"}
+
+
+def test_add_tombstones_keeps_latest_deletion(tmp_path):
+    addTombstones([header("a", "2024-01-02")], str(tmp_path))
+    assert addTombstones([header("a", "2024-01-01")], str(tmp_path)) == 0
+    assert readTombstones(str(tmp_path / "tombstones.json")) == {"a": "2024-01-02"}
+    addTombstones([header("a", "2024-01-03")], str(tmp_path))
+    assert readTombstones(str(tmp_path / "tombstones.json")) == {"a": "2024-01-03"}
+
+
+def test_reharvested_record_clears_tombstone(tmp_path):
+    output_dir = str(tmp_path)
+    parseListRecords(list_records(("a", "2024-01-01", False), ("b", "2024-01-01", False)), output_dir)
+    parseListRecords(list_records(("a", "2024-01-02", True)), output_dir)
+    assert not os.path.exists(os.path.join(output_dir, "a.xml"))
+    assert readTombstones(os.path.join(output_dir, "tombstones.json")) == {"a": "2024-01-02"}
+    parseListRecords(list_records(("a", "2024-01-03", False)), output_dir)
+    assert os.path.exists(os.path.join(output_dir, "a.xml"))
+    assert readTombstones(os.path.join(output_dir, "tombstones.json")) == {}
+
+
+def test_clear_tombstones_keeps_newer_deletion(tmp_path):
+    addTombstones([header("a", "2024-01-02")], str(tmp_path))
+    assert clearTombstones([{"identifier": "a", "datestamp": "2024-01-01"}], str(tmp_path)) == 0
+    assert clearTombstones([{"identifier": "a", "datestamp": "2024-01-02"}], str(tmp_path)) == 1
+    with open(tmp_path / "tombstones.json") as f:
+        assert json.load(f) == {}
+
+
+def test_unchanged_record_not_rewritten(tmp_path):
+    output_dir = str(tmp_path)
+    assert writeRecordContent(b"<record/>", "a", output_dir)
+    os.utime(tmp_path / "a.xml", (0, 0))
+    assert not writeRecordContent(b"<record/>", "a", output_dir)
+    assert os.path.getmtime(tmp_path / "a.xml") == 0
+    assert writeRecordContent(b"<record2/>", "a", output_dir)
+    with open(tmp_path / "a.xml", "rb") as f:
+        assert f.read() == b"<record2/>"
+
+
+def test_compact_serialisation_keeps_record_as_parsed(tmp_path):
+    page = list_records(("a", "2024-01-01", False))
+    metadata = page.find("{%s}record/{%s}metadata/{%s}WIGOSMetadataRecord" % (OAI, OAI, WMDR))
+    expected = etree.tostring(metadata)
+    parseListRecords(page, str(tmp_path), pretty_print=False)
+    with open(tmp_path / "a.xml", "rb") as f:
+        assert f.read() == expected
+
+
+def test_parallel_page_split_equals_sequential(tmp_path):
+    pages = [
+        list_records(("a", "2024-01-01", False), ("b", "2024-01-01", False)),
+        list_records(("c", "2024-01-02", False), ("d", "2024-01-02", True))
+    ]
+    for i, page in enumerate(pages):
+        with open(tmp_path / ("records_%i.xml" % i), "wb") as f:
+            f.write(etree.tostring(page.getroottree()))
+    outputs = {}
+    for processes in [None, 2]:
+        output_dir = tmp_path / ("out_%s" % processes)
+        output_dir.mkdir()
+        parseRecordsFiles(str(tmp_path / "records_*.xml"), str(output_dir), processes=processes)
+        outputs[processes] = {name: (output_dir / name).read_bytes() for name in sorted(os.listdir(output_dir))}
+    assert sorted(outputs[None]) == ["a.xml", "b.xml", "c.xml", "tombstones.json"]
+    assert outputs[2] == outputs[None]
+
+
+@pytest.mark.parametrize("use_store", [False, True])
+def test_parallel_split_keeps_the_latest_version_of_a_record_in_several_pages(tmp_path, use_store):
+    # a is deleted after its version in the other page, b is older in the second page
+    pages = [
+        [("a", "2024-01-01", False), ("b", "2024-01-02", False)],
+        [("a", "2024-01-03", True), ("b", "2024-01-01", False)]
+    ]
+    # more records in one page or the other, so that either completes last
+    padding = [("p%i" % i, "2024-01-01", False) for i in range(2000)]
+    for order in [(0, 1), (1, 0)]:
+        for padded in [0, 1]:
+            directory = tmp_path / ("%i%i_%i" % (order + (padded,)))
+            output_dir = directory / "out"
+            output_dir.mkdir(parents=True)
+            for i, page in enumerate(order):
+                with open(directory / ("records_%i.xml" % i), "wb") as f:
+                    f.write(etree.tostring(list_records(*(pages[page] + (padding if page == padded else []))).getroottree()))
+            if use_store:
+                with RecordStore(str(directory / "records.sqlite")) as store:
+                    parseRecordsFiles(str(directory / "records_*.xml"), None, store=store, processes=2)
+                    assert store.get("a") is None
+                    assert store.tombstones() == {"a": "2024-01-03"}
+                    assert b'version="2024-01-02"' in store.get("b")
+                continue
+            parseRecordsFiles(str(directory / "records_*.xml"), str(output_dir), processes=2)
+            assert not os.path.exists(output_dir / "a.xml")
+            assert readTombstones(str(output_dir / "tombstones.json")) == {"a": "2024-01-03"}
+            assert b'version="2024-01-02"' in (output_dir / "b.xml").read_bytes()
@@ -0,0 +1,281 @@
+import copy
+import io
+import math
+
+import numpy
+import pytest
+
+from pywmdr.kpi import GRADES, GRADE_THRESHOLDS, STREAMING_KPIS, calculate_grade, calculate_grades, evaluate_streaming
+
+
+def test_grade_cut_offs():
+    percentages = [0, 19.99, 20, 34.99, 35, 49.99, 50, 64.99, 65, 79.99, 80, 100]
+    expected = ['F', 'F', 'E', 'E', 'D', 'D', 'C', 'C', 'B', 'B', 'A', 'A']
+    assert [calculate_grade(x) for x in percentages] == expected
+    assert [GRADES[i] for i in calculate_grades(percentages)] == expected
+    assert len(GRADE_THRESHOLDS) == len(GRADES) - 1
+
+
+def test_vectorised_grades_equal_scalar_grades():
+    percentages = numpy.round(numpy.linspace(0, 100, 10001), 2)
+    assert [GRADES[i] for i in calculate_grades(percentages)] == [calculate_grade(x) for x in percentages]
+
+
+@pytest.mark.parametrize("percentages", [[50, math.nan], [None], [101], [-1]])
+def test_vectorised_grades_reject_missing_and_invalid(percentages):
+    with pytest.raises(ValueError):
+        calculate_grades(percentages)
+
+
+def evaluate_tree(source, kpi):
+    from lxml import etree
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    from pywmdr.util import get_wmdr_parser
+    return WMDRKeyPerformanceIndicators(etree.parse(source, get_wmdr_parser())).evaluate(kpi)
+
+
+@pytest.mark.parametrize("kpi", sorted(STREAMING_KPIS))
+def test_streaming_evaluation_equals_tree_evaluation(all_example_files, kpi):
+    for file in all_example_files:
+        assert evaluate_streaming(file, kpi) == evaluate_tree(file, kpi)
+
+
+def repeated_observations(file, copies):
+    """Record of a file whose observations are repeated, and its number of OM_Observation instances"""
+    from lxml import etree
+    from pywmdr.util import get_wmdr_parser
+    exml = etree.parse(file, get_wmdr_parser())
+    observations = exml.getroot().findall(".//{*}ObservingFacility/{*}observation")
+    for observation in observations:
+        for i in range(copies - 1):
+            observation.addnext(copy.deepcopy(observation))
+    return etree.tostring(exml), len(exml.getroot().findall(".//{*}OM_Observation"))
+
+
+@pytest.mark.parametrize("kpi", sorted(STREAMING_KPIS))
+def test_streaming_evaluation_of_large_record(example_files, kpi):
+    content, count = repeated_observations(example_files[0], 20)
+    assert evaluate_streaming(io.BytesIO(content), kpi) == evaluate_tree(io.BytesIO(content), kpi)
+
+
+def test_streamed_instances_are_released(example_files, monkeypatch):
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    content, count = repeated_observations(example_files[0], 5)
+    scored = []
+    score_deployment = WMDRKeyPerformanceIndicators.score_deployment
+
+    def score(self, instance, deployment_number):
+        # every instance scored before is already released
+        assert [len(element) for element in scored] == [0] * len(scored)
+        scored.append(instance)
+        return score_deployment(self, instance, deployment_number)
+
+    monkeypatch.setattr(WMDRKeyPerformanceIndicators, "score_deployment", score)
+    evaluate_streaming(io.BytesIO(content), 31)
+    assert len(scored) == count
+
+
+def test_streaming_evaluation_rejects_other_kpis_and_documents(example_files):
+    with pytest.raises(ValueError):
+        evaluate_streaming(example_files[0], 10)
+    with pytest.raises(RuntimeError):
+        evaluate_streaming(io.BytesIO(b"<a><b/></a>"), 31)
+
+
+def score_log_entry_with_queries(kpis, logEntry):
+    """Rules 2-0-12 as scored before the single pass: one query and validation per rule"""
+    from pywmdr.util import validate_text
+    rules = [
+        ('./wmdr:EventReport/wmdr:validPeriod/gml:TimePeriod/gml:beginPosition', "valid period of reported event", "datetime", {}),
+        ('./wmdr:EventReport/wmdr:typeOfEvent', "type of event", "href", {"codelist": kpis.codelists["EventAtFacility"]}),
+        ('./wmdr:EventReport/wmdr:description', "event description", "string", {"min_length": 100}),
+        ('./wmdr:EventReport/wmdr:author', "author of log entry", "string", {}),
+        ('./wmdr:EventReport/wmdr:documentationURL', "documentation URL of log entry", "url", {})
+    ]
+    sum = 0
+    comments = []
+    for xpath, element_name, type_, kwargs in rules:
+        matches = logEntry.xpath(xpath, namespaces=kpis.namespaces)
+        if not len(matches):
+            comments.append("%s not found" % element_name)
+            continue
+        text = matches[0].get('{http://www.w3.org/1999/xlink}href') if type_ == "href" else matches[0].text
+        sscore, scomments, svalue = validate_text(text, type_, element_name, **kwargs)
+        sum += sscore
+        comments = comments + scomments
+    return 5, sum, comments
+
+
+def remove(name):
+    def change(report):
+        report.remove(report.find("{*}%s" % name))
+    return change
+
+
+def set_text(name, text):
+    def change(report):
+        report.find("{*}%s" % name).text = text
+    return change
+
+
+def set_type_of_event(href):
+    def change(report):
+        report.find("{*}typeOfEvent").set('{http://www.w3.org/1999/xlink}href', href)
+    return change
+
+
+def add_empty_valid_period(report):
+    valid_period = report.find("{*}validPeriod")
+    valid_period.addprevious(copy.deepcopy(valid_period))
+    valid_period.getprevious().clear()
+
+
+def add_event_report(report):
+    second = copy.deepcopy(report)
+    second.find("{*}author").text = "Second author"
+    second.find("{*}documentationURL").text = "not a url"
+    report.remove(report.find("{*}author"))
+    report.addnext(second)
+
+
+LOG_ENTRY_CHANGES = [
+    lambda report: None,
+    remove("validPeriod"), remove("typeOfEvent"), remove("description"), remove("author"), remove("documentationURL"),
+    set_type_of_event("http://codes.wmo.int/wmdr/EventAtFacility/SOLARFLARES"),
+    set_type_of_event("http://codes.wmo.int/wmdr/EventAtFacility/unknownEvent"),
+    set_text("description", "Too short"),
+    set_text("documentationURL", "www.lipsum.com"),
+    set_text("documentationURL", "not a url"),
+    set_text("author", None),
+    add_empty_valid_period,
+    add_event_report
+]
+
+
+@pytest.mark.parametrize("change", range(len(LOG_ENTRY_CHANGES)))
+def test_log_entry_scores_equal_scores_of_queries(all_example_files, change):
+    from lxml import etree
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    from pywmdr.util import get_wmdr_parser
+    file = [file for file in all_example_files if file.endswith("JFJ_kpi_2-0_100.xml")][0]
+    kpis = WMDRKeyPerformanceIndicators(etree.parse(file, get_wmdr_parser()))
+    log_entries = kpis.exml.getroot().findall(".//{*}logEntry")
+    assert log_entries
+    for number, log_entry in enumerate(log_entries, 1):
+        LOG_ENTRY_CHANGES[change](log_entry.find("{*}EventReport"))
+        assert kpis.score_log_entry(log_entry, number) == score_log_entry_with_queries(kpis, log_entry)
+
+
+def test_anchored_instance_lists_equal_document_scans(all_example_files):
+    from lxml import etree
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    from pywmdr.util import get_wmdr_parser
+    for file in all_example_files:
+        kpis = WMDRKeyPerformanceIndicators(etree.parse(file, get_wmdr_parser()))
+        scan = lambda xpath: kpis.exml.xpath(xpath, namespaces=kpis.namespaces)
+        assert kpis.observations == scan('//wmdr:observation/wmdr:ObservingCapability/wmdr:observation')
+        assert kpis.om_observations == scan('//wmdr:observation/wmdr:ObservingCapability/wmdr:observation/om:OM_Observation')
+        assert kpis.deployments == scan('//wmdr:deployment/wmdr:Deployment')
+
+
+def test_instance_lists_are_found_once(example_files):
+    from lxml import etree
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    from pywmdr.util import get_wmdr_parser
+    kpis = WMDRKeyPerformanceIndicators(etree.parse(example_files[0], get_wmdr_parser()))
+    lists = [kpis.observations, kpis.om_observations, kpis.deployments]
+    for kpi in [30, 31, 33, 60]:
+        kpis.evaluate(kpi)
+    assert [kpis.observations, kpis.om_observations, kpis.deployments] == lists
+    assert all(a is b for a, b in zip([kpis.observations, kpis.om_observations, kpis.deployments], lists))
+
+
+def test_anchored_kpi_60_ignores_deployments_outside_the_facility_observations(example_files):
+    from lxml import etree
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    from pywmdr.util import get_wmdr_parser
+    exml = etree.parse(example_files[0], get_wmdr_parser())
+    expected = WMDRKeyPerformanceIndicators(exml).evaluate(60)
+    # a copy of an observation out of the facility, e.g. in an extension
+    observation = exml.getroot().find(".//{*}ObservingCapability/{*}observation")
+    exml.getroot().append(etree.Element("{http://def.wmo.int/wmdr/1.0}extension"))
+    exml.getroot()[-1].append(copy.deepcopy(observation.getparent().getparent()))
+    kpis = WMDRKeyPerformanceIndicators(exml)
+    assert len(exml.xpath('//wmdr:deployment/wmdr:Deployment', namespaces=kpis.namespaces)) > len(kpis.deployments)
+    assert kpis.evaluate(60) == expected
+
+
+def test_memoised_evaluation_equals_evaluation_of_each_kpi_alone(all_example_files, results):
+    from lxml import etree
+    from pywmdr.kpi import WMDRKeyPerformanceIndicators
+    from pywmdr.util import get_wmdr_parser
+    for file, result in zip(all_example_files, results):
+        kpis = [key for key in result if key != "summary"]
+        alone = {}
+        for key in kpis:
+            alone.update(WMDRKeyPerformanceIndicators(etree.parse(file, get_wmdr_parser())).evaluate(int(key[4:])))
+        assert alone == {key: result[key] for key in kpis}
+
+
+def test_shared_values_are_validated_once(example_files, monkeypatch):
+    import sys
+    from collections import Counter
+    from lxml import etree
+    from pywmdr.util import get_wmdr_parser
+    module = sys.modules["pywmdr.kpi"]  # the package exports the kpi command under the module name
+    calls = Counter()
+
+    def counted(function, name=None):
+        def wrapper(*args, **kwargs):
+            element_name = kwargs.get("element_name", args[4] if len(args) > 4 else None)
+            calls[name or element_name] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(module, "get_href_and_validate", counted(module.get_href_and_validate))
+    monkeypatch.setattr(module, "get_text_and_validate", counted(module.get_text_and_validate))
+    monkeypatch.setattr(module, "get_coordinates", counted(module.get_coordinates, "coordinates"))
+    for file in example_files:
+        calls.clear()
+        kpis = module.WMDRKeyPerformanceIndicators(etree.parse(file, get_wmdr_parser()))
+        kpis.evaluate(0, skip_schema_eval=True)
+        for name in ["wmo region", "territory name", "supervising organization", "coordinates"]:
+            assert calls[name] == 1, name
+        purposes = [name for name in calls if name.endswith("purpose of frequency use")]
+        assert len(purposes) == len(kpis.om_observations)
+        assert [calls[name] for name in purposes] == [1] * len(purposes)
+
+
+def test_stream_reports_failed_records_and_continues(example_files, monkeypatch):
+    import json
+    import sys
+    from click.testing import CliRunner
+    module = sys.modules["pywmdr.kpi"]
+    evaluate = module.WMDRKeyPerformanceIndicators.evaluate
+    calls = []
+
+    def failing_evaluate(self, kpi=0, skip_schema_eval=False):
+        calls.append(kpi)
+        if len(calls) == 2:
+            raise ValueError("invalid value in record")
+        return evaluate(self, kpi, skip_schema_eval)
+
+    monkeypatch.setattr(module.WMDRKeyPerformanceIndicators, "evaluate", failing_evaluate)
+    contents = []
+    for file in example_files + example_files[:1]:
+        with open(file, "rb") as f:
+            contents.append(f.read())
+    result = CliRunner().invoke(module.stream, ["--kpi", "21"], input=b"\n".join(contents))
+    assert result.exit_code == 0
+    assert len([json.loads(line) for line in result.stdout.splitlines()]) == 2
+    assert "failed: invalid value in record" in result.stderr
+    assert len(calls) == 3
+
+
+def test_stream_rejects_unknown_kpi_before_reading(example_files):
+    import sys
+    from click.testing import CliRunner
+    module = sys.modules["pywmdr.kpi"]
+    result = CliRunner().invoke(module.stream, ["--kpi", "99"], input=b"<not-read/>")
+    assert result.exit_code == 2
+    assert "Invalid KPI 99" in result.stderr
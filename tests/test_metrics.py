@@ -0,0 +1,219 @@
+import json
+import os
+import shutil
+import sqlite3
+
+import pytest
+import requests
+
+from pywmdr.harvest import parseRecordsFiles
+from pywmdr.metrics import (GROUP_BY_FIELDS, PERCENTILE_METHODS, EvaluationManifest, GroupedMetricsAccumulator,
+                            MetricsAccumulator, evaluateRecords, getGroup, getKPIStats, getMetrics, getMetricsStreaming,
+                            getPercentiles, iterFileRecords, iterResults, iterStoreRecords, mergePartialMetrics,
+                            newAccumulator, parseAndEvaluate, parseAndEvaluateFiles, parseAndEvaluatePath,
+                            resultIdentifier, writePartialMetrics)
+from pywmdr.results import openResultsWriter
+from pywmdr.store import RecordStore
+
+
+@pytest.fixture
+def record_store(tmp_path, example_files):
+    filename = str(tmp_path / "records.sqlite")
+    with RecordStore(filename) as store:
+        for file in example_files:
+            with open(file, "rb") as f:
+                store.put(os.path.basename(file)[:-4], f.read(), "2024-01-01")
+    return filename
+
+
+def test_store_is_read_only_for_evaluation(record_store):
+    with open(record_store, "rb") as f:
+        before = f.read()
+    names = [name for name, source in iterStoreRecords(record_store)]
+    assert names == ["northolt.xml", "wmdr_example_facility_0-2008-0-JFJ.xml"]
+    with open(record_store, "rb") as f:
+        assert f.read() == before
+    store = RecordStore(record_store, read_only=True)
+    with pytest.raises(sqlite3.OperationalError):
+        store.put("a", b"<a/>")
+    store.close()
+
+
+def test_store_evaluation_equals_file_evaluation(tmp_path, record_store, example_files):
+    for file in example_files:
+        os.symlink(file, tmp_path / os.path.basename(file))
+    from_files = parseAndEvaluatePath(str(tmp_path / "*.xml"), skip_schema_eval=True, return_results=True)
+    from_store = parseAndEvaluatePath(record_store, skip_schema_eval=True, return_results=True)
+    key = lambda result: result["summary"]["identifier"]
+    assert sorted(from_store, key=key) == sorted(from_files, key=key)
+
+
+def common_items(metrics, streaming):
+    """The metrics of getMetrics without the per-station lists, which the accumulator does not keep"""
+    if not isinstance(metrics, dict):
+        return metrics
+    return {key: common_items(value, streaming[key]) for key, value in metrics.items() if key in streaming}
+
+
+@pytest.mark.parametrize("method", PERCENTILE_METHODS)
+def test_streaming_metrics_equal_metrics(results, method):
+    streaming = getMetricsStreaming(iter(results), method=method)
+    assert common_items(getMetrics(results, method=method), streaming) == streaming
+
+
+def test_accumulator_round_trip(results):
+    accumulator = newAccumulator()
+    for result in results:
+        accumulator.add(result)
+    restored = MetricsAccumulator.fromDict(json.loads(json.dumps(accumulator.toDict())))
+    assert restored.getMetrics() == accumulator.getMetrics()
+
+
+def evaluate_shards(files, shards, **kwargs):
+    """Identifiers of the records evaluated in each shard"""
+    return [set(resultIdentifier(result) for result in evaluateRecords(((os.path.basename(file), file) for file in files), shard=(i, shards), skip_schema_eval=True, return_results=True, **kwargs)) for i in range(1, shards + 1)]
+
+
+def test_shards_partition_the_records(all_example_files, results):
+    shards = evaluate_shards(all_example_files, 2)
+    assert not shards[0] & shards[1]
+    assert shards[0] | shards[1] == set(resultIdentifier(result) for result in results)
+
+
+def test_each_shard_parses_only_its_records(all_example_files, monkeypatch):
+    import pywmdr.util
+    parsed = []
+    get_wmdr_parser = pywmdr.util.get_wmdr_parser
+    monkeypatch.setattr(pywmdr.util, "get_wmdr_parser", lambda *args, **kwargs: parsed.append(1) or get_wmdr_parser(*args, **kwargs))
+    evaluated = 0
+    for i in [1, 2, 3]:
+        evaluated += len(evaluateRecords(((os.path.basename(file), file) for file in all_example_files), shard=(i, 3), skip_schema_eval=True, return_results=True))
+    assert len(parsed) == evaluated == len(all_example_files)
+
+
+@pytest.mark.parametrize("format_", ["json", "jsonl", "npz", "sqlite"])
+def test_saved_results_are_sharded_as_records(tmp_path, all_example_files, format_):
+    writer = None if format_ == "json" else openResultsWriter(str(tmp_path / ("evaluations.%s" % format_)), format_)
+    evaluateRecords(((os.path.basename(file), file) for file in all_example_files), output_dir=str(tmp_path), skip_schema_eval=True, writer=writer)
+    if writer is not None:
+        writer.close()
+    pattern = str(tmp_path / ("*_eval.json" if format_ == "json" else "evaluations.%s" % format_))
+    for i, identifiers in enumerate(evaluate_shards(all_example_files, 2), 1):
+        assert set(resultIdentifier(result) for result in iterResults(pattern, shard=(i, 2))) == identifiers
+
+
+def test_merged_shards_equal_streaming_metrics(tmp_path, all_example_files, results):
+    for i in [1, 2, 3]:
+        accumulator = newAccumulator()
+        evaluateRecords(((os.path.basename(file), file) for file in all_example_files), shard=(i, 3), skip_schema_eval=True, accumulator=accumulator)
+        writePartialMetrics(accumulator, str(tmp_path / ("partial_%i.json" % i)), (i, 3))
+    merged = mergePartialMetrics(str(tmp_path / "partial_*.json"))
+    assert json.dumps(merged) == json.dumps(getMetricsStreaming(iter(results)))
+    # getMetrics of the same records, but for the per-station lists
+    metrics = getMetrics(results)
+    assert json.dumps(common_items(metrics, merged)) == json.dumps(merged)
+    station_lists = ["country", "grades", "identifier", "organisation", "percentages", "region", "scores", "totals"]
+    assert sorted(set(metrics) - set(merged)) == station_lists
+    for kpi in metrics["kpi"]:
+        assert sorted(set(metrics["kpi"][kpi]) - set(merged["kpi"][kpi])) == ["percentages", "scores", "totals"]
+
+
+def test_percentiles_keep_the_values_as_given():
+    percentiles = getPercentiles([50, 12.5, None, 100, 75], perc=[0, 50, 95])
+    assert percentiles == {0: {"count": 0, "value": 0}, 50: {"count": 2, "value": 50}, 95: {"count": 4, "value": 100}}
+    assert type(percentiles[50]["value"]) is int
+    assert getPercentiles([0, 10], perc=[50], method="linear") == {50: {"count": 1, "value": 5.0}}
+
+
+def test_kpi_stats_keep_the_types_of_the_results(results):
+    stats = getKPIStats([result["kpi_20"] for result in results])
+    percentages = [0 if result["kpi_20"]["percentage"] is None else result["kpi_20"]["percentage"] for result in results]
+    assert [(x, type(x)) for x in stats["percentages"]] == [(x, type(x)) for x in percentages]
+    assert sum(x["count"] for x in stats["grade_counts"].values()) == len(results)
+
+
+@pytest.mark.parametrize("method", PERCENTILE_METHODS)
+def test_streaming_percentiles_have_the_same_types(results, method):
+    streaming = getMetricsStreaming(iter(results), method=method)["kpi"]
+    metrics = getMetrics(results, method=method)["kpi"]
+    assert json.dumps(common_items(metrics, streaming), sort_keys=True) == json.dumps(streaming, sort_keys=True)
+
+
+def test_get_group():
+    result = {"summary": {"identifier": "0-20000-0-03672", "region": "europe", "country": None}}
+    assert getGroup(result, "issuer") == "20000"
+    assert getGroup({"summary": {"identifier": "http://wigos.wmo.int/0-20008-0-JFJ"}}, "issuer") == "20008"
+    assert getGroup(result, "region") == "europe"
+    assert getGroup(result, "country") == ""
+    assert getGroup({}, "region") == ""
+
+
+@pytest.mark.parametrize("group_by", GROUP_BY_FIELDS)
+def test_grouped_metrics_equal_metrics_of_each_group(results, group_by):
+    grouped = getMetrics(results, group_by=group_by)
+    assert grouped["count"] == len(results)
+    groups = set(getGroup(result, group_by) for result in results)
+    assert set(grouped["groups"]) == groups
+    for group in groups:
+        assert grouped["groups"][group] == getMetricsStreaming([result for result in results if getGroup(result, group_by) == group])
+
+
+def test_grouped_partials_merge(results):
+    partials = [newAccumulator("issuer"), newAccumulator("issuer")]
+    for i, result in enumerate(results):
+        partials[i % 2].add(result)
+    merged = GroupedMetricsAccumulator.fromDict(json.loads(json.dumps(partials[0].toDict())))
+    merged.merge(GroupedMetricsAccumulator.fromDict(json.loads(json.dumps(partials[1].toDict()))))
+    assert json.dumps(merged.getMetrics()) == json.dumps(getMetricsStreaming(iter(results), group_by="issuer"))
+    with pytest.raises(ValueError):
+        merged.merge(newAccumulator("region"))
+
+
+def evaluate_incrementally(directory, output_dir, use_hash=False):
+    manifest = EvaluationManifest(os.path.join(output_dir, "manifest.json"), {"kpi": None, "skip_schema_eval": True, "format": "json"}, use_hash=use_hash)
+    results = parseAndEvaluateFiles(os.path.join(directory, "*.xml"), output_dir=output_dir, skip_schema_eval=True, return_results=True, manifest=manifest)
+    manifest.save()
+    return manifest, results
+
+
+def test_incremental_evaluation_skips_unchanged_records(tmp_path, example_files):
+    directory = tmp_path / "records"
+    output_dir = tmp_path / "evaluations"
+    directory.mkdir()
+    output_dir.mkdir()
+    for file in example_files:
+        shutil.copy(file, directory)
+    manifest, results = evaluate_incrementally(str(directory), str(output_dir), use_hash=True)
+    assert (manifest.evaluated, manifest.skipped) == (2, 0)
+    manifest, again = evaluate_incrementally(str(directory), str(output_dir), use_hash=True)
+    assert (manifest.evaluated, manifest.skipped) == (0, 2)
+    assert again == results
+    # touched, but not modified
+    os.utime(directory / "northolt.xml", (0, 0))
+    manifest, again = evaluate_incrementally(str(directory), str(output_dir), use_hash=True)
+    assert (manifest.evaluated, manifest.skipped) == (0, 2)
+    # modified
+    with open(directory / "northolt.xml", "a") as f:
+        f.write("\n")
+    manifest, again = evaluate_incrementally(str(directory), str(output_dir), use_hash=True)
+    assert (manifest.evaluated, manifest.skipped) == (1, 1)
+    assert again == results
+
+
+def test_pages_are_evaluated_as_their_split_records(tmp_path, server):
+    response = requests.get(server.endpoint, params={"verb": "ListRecords", "metadataPrefix": "wmdr"})
+    (tmp_path / "pages").mkdir()
+    (tmp_path / "split").mkdir()
+    page = tmp_path / "pages" / "records_1.xml"
+    page.write_bytes(response.content)
+    parseRecordsFiles(str(page), str(tmp_path / "split"))
+    names = [name for name, source in iterFileRecords([str(page)])]
+    assert names == ["%s.xml" % record["identifier"] for record in server.records[:2]]
+    in_place = parseAndEvaluateFiles(str(page), skip_schema_eval=True, return_results=True)
+    split = [parseAndEvaluate(str(tmp_path / "split" / name), skip_schema_eval=True) for name in names]
+    assert in_place == split
+
+
+def test_files_that_are_not_wmdr_are_rejected(tmp_path, example_files):
+    (tmp_path / "other.xml").write_bytes(b"<other/>")
+    assert [name for name, source in iterFileRecords([str(tmp_path / "other.xml"), example_files[0]])] == [os.path.basename(example_files[0])]
@@ -0,0 +1,47 @@
+import os
+
+from lxml import etree
+
+from pywmdr.harvest import getRecord, iterListRecords
+from pywmdr.oai import loadRecords
+from pywmdr.util import WMDR_RECORD_TAGS
+
+
+def test_list_records_follows_resumption_tokens(server):
+    identifiers = [record["identifier"] for record in iterListRecords(endpoint=server.endpoint)]
+    assert identifiers == [record["identifier"] for record in server.records]
+    assert len(identifiers) == 6
+
+
+def test_list_records_of_set(server):
+    identifiers = [record["identifier"] for record in iterListRecords(endpoint=server.endpoint, set_spec="set1")]
+    assert identifiers == [record["identifier"] for record in server.records if "set1" in record["sets"]]
+
+
+def test_get_record_round_trip(server, tmp_path):
+    record = server.records[0]
+    getRecord(record["identifier"], str(tmp_path / "out"), endpoint=server.endpoint, pretty_print=False)
+    with open(tmp_path / "out" / ("%s.xml" % record["identifier"]), "rb") as f:
+        content = f.read()
+    # the record inherits the namespace declarations of the OAI envelope
+    assert etree.tostring(etree.fromstring(content), method="c14n", exclusive=True) == etree.tostring(etree.fromstring(record["content"]), method="c14n", exclusive=True)
+
+
+def test_records_of_both_schemas_are_loaded(tmp_path, example_files):
+    roots = {}
+    for file in example_files:
+        root = etree.parse(file).getroot()
+        roots[root.tag] = root
+        # the same record, nested in another document
+        wrapper = etree.Element("wrapper")
+        etree.SubElement(wrapper, "content").append(root)
+        etree.ElementTree(wrapper).write(str(tmp_path / ("nested_" + os.path.basename(file))))
+        etree.ElementTree(root).write(str(tmp_path / os.path.basename(file)))
+    (tmp_path / "other.xml").write_bytes(b"<other/>")
+    assert sorted(roots) == sorted(WMDR_RECORD_TAGS)
+    records = loadRecords(str(tmp_path))
+    assert len(records) == 2 * len(example_files)
+    for record in records:
+        name = record["identifier"].replace("nested_", "") + ".xml"
+        expected = etree.parse(os.path.join(os.path.dirname(example_files[0]), name)).getroot()
+        assert etree.tostring(etree.fromstring(record["content"]), method="c14n", exclusive=True) == etree.tostring(expected, method="c14n", exclusive=True)
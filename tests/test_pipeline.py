@@ -0,0 +1,22 @@
+import os
+
+from lxml import etree
+
+from pywmdr.metrics import newAccumulator, parseAndEvaluate
+from pywmdr.pipeline import runPipeline
+
+
+def test_pipeline_equals_evaluation_of_files(example_files):
+    records = [{
+        "identifier": os.path.basename(file)[:-4],
+        "datestamp": "2024-01-01",
+        "metadata": etree.parse(file).getroot(),
+        "deleted": False
+    } for file in example_files]
+    records.append({"identifier": "gone", "datestamp": "2024-01-02", "metadata": None, "deleted": True})
+    accumulator, deleted = runPipeline(records=iter(records), skip_schema_eval=True, workers=2)
+    assert deleted == ["gone"]
+    expected = newAccumulator()
+    for file in example_files:
+        expected.add(parseAndEvaluate(file, skip_schema_eval=True))
+    assert accumulator.getMetrics(method="linear") == expected.getMetrics(method="linear")
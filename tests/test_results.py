@@ -0,0 +1,151 @@
+import json
+import os
+
+import numpy
+import pytest
+
+from pywmdr.metrics import evaluateRecords, getMetrics, iterResults
+from pywmdr.results import (KPI_NUMBER_FIELDS, SUMMARY_NUMBER_COLUMNS, SUMMARY_TEXT_COLUMNS, ColumnarWriter,
+                            SQLiteResultsWriter, isResultsDatabase, iterColumnarResults, iterJsonLines,
+                            iterSQLiteResults, openResultsWriter, readColumnar)
+from pywmdr.store import RecordStore
+
+
+def table_fields(result):
+    """The fields of a result kept by the columnar table"""
+    fields = {"summary": SUMMARY_TEXT_COLUMNS + SUMMARY_NUMBER_COLUMNS}
+    return {key: {field: section[field] for field in fields.get(key, ["name"] + KPI_NUMBER_FIELDS)} for key, section in result.items()}
+
+
+def test_columnar_round_trip(tmp_path, all_example_files, results):
+    filename = str(tmp_path / "evaluations.npz")
+    writer = ColumnarWriter(filename, "npz")
+    for file, result in zip(all_example_files, results):
+        writer.add(os.path.basename(file), result)
+    writer.close()
+    columns, kpi_names = readColumnar(filename)
+    assert [str(x) for x in columns["name"]] == [os.path.basename(file) for file in all_example_files]
+    assert kpi_names["kpi_20"] == results[0]["kpi_20"]["name"]
+    restored = list(iterColumnarResults(filename))
+    assert [table_fields(x) for x in restored] == [table_fields(x) for x in results]
+    assert getMetrics(restored) == getMetrics(results)
+
+
+def write_columnar(filename, format_, batch_size, names, results):
+    writer = ColumnarWriter(filename, format_, batch_size=batch_size)
+    for name, result in zip(names, results):
+        writer.add(name, result)
+    writer.close()
+    return readColumnar(filename)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3])
+def test_columnar_batches(tmp_path, all_example_files, results, batch_size):
+    # a KPI first seen in a later batch, a KPI missing from a later row and a value holding a line break
+    varied = [{key: value for key, value in result.items() if key != "kpi_20"} for result in results]
+    varied[-1] = dict(results[-1])
+    del varied[-1]["kpi_60"]
+    varied[0] = dict(varied[0], summary=dict(varied[0]["summary"], organisation="line\nbreak"))
+    names = [os.path.basename(file) for file in all_example_files]
+    expected, expected_names = write_columnar(str(tmp_path / "whole.npz"), "npz", len(varied), names, varied)
+    os.mkdir(tmp_path / "batches")
+    columns, kpi_names = write_columnar(str(tmp_path / "batches" / "evaluations.npz"), "npz", batch_size, names, varied)
+    assert kpi_names == expected_names
+    assert list(columns) == list(expected)
+    for column in expected:
+        assert columns[column].dtype == expected[column].dtype
+        assert numpy.array_equal(columns[column], expected[column], equal_nan=columns[column].dtype == float)
+    assert numpy.isnan(columns["kpi_20_total"][:-1]).all() and not numpy.isnan(columns["kpi_20_total"][-1])
+    assert str(columns["organisation"][0]) == "line\nbreak"
+    # the spool is removed
+    assert os.listdir(tmp_path / "batches") == ["evaluations.npz"]
+
+
+def test_columnar_parquet_batches(tmp_path, all_example_files, results):
+    pytest.importorskip("pyarrow")
+    names = [os.path.basename(file) for file in all_example_files]
+    expected, expected_names = write_columnar(str(tmp_path / "whole.npz"), "npz", len(results), names, results)
+    columns, kpi_names = write_columnar(str(tmp_path / "evaluations.parquet"), "parquet", 2, names, results)
+    assert kpi_names == expected_names
+    assert list(columns) == list(expected)
+    for column in expected:
+        if expected[column].dtype == float:
+            assert numpy.array_equal(columns[column], expected[column], equal_nan=True)
+        else:
+            assert list(columns[column]) == [str(x) for x in expected[column]]
+
+
+def write_results(writer, files, results):
+    for file, result in zip(files, results):
+        writer.add(os.path.basename(file), result)
+    writer.close()
+
+
+@pytest.mark.parametrize("format_", ["jsonl", "jsonl.gz", "sqlite"])
+def test_results_sink_round_trip(tmp_path, all_example_files, results, format_):
+    filename = str(tmp_path / ("evaluations.%s" % format_))
+    write_results(openResultsWriter(filename, format_), all_example_files, results)
+    if format_ == "sqlite":
+        restored = list(iterSQLiteResults(filename))
+    else:
+        restored = [result for name, result in iterJsonLines(filename)]
+    assert restored == results
+
+
+def test_sqlite_findings_are_json(tmp_path):
+    filename = str(tmp_path / "evaluations.sqlite")
+    result = {"kpi_20": {"name": "KPI-2-0", "total": 2, "score": 1, "percentage": 50.0, "comments": ["a", {"rule": "b"}, 3]}}
+    write_results(SQLiteResultsWriter(filename), ["a.xml"], [result])
+    assert list(iterSQLiteResults(filename)) == [result]
+
+
+def with_comments(result, kpi, comments):
+    result = json.loads(json.dumps(result))
+    result[kpi]["comments"] = comments
+    if "summary" in result:
+        result["summary"]["comments"] = {key: value["comments"] for key, value in result.items() if key != "summary" and value["comments"]}
+    return result
+
+
+def test_sqlite_round_trip_keeps_the_shape_of_the_comments(tmp_path, all_example_files, results):
+    variants = [with_comments(results[0], "kpi_20", comments) for comments in [{"rule": "b"}, {}, "a", [{"rule": "b"}], [[]]]]
+    filename = str(tmp_path / "evaluations.sqlite")
+    files = all_example_files + ["variant_%i.xml" % i for i in range(len(variants))]
+    write_results(SQLiteResultsWriter(filename), files, results + variants)
+    assert list(iterSQLiteResults(filename)) == results + variants
+    writer = SQLiteResultsWriter(filename)
+    assert [writer.get(os.path.basename(file)) for file in files] == results + variants
+    writer.close()
+
+
+def test_sqlite_results_written_before_the_comments_shape_are_read(tmp_path, results):
+    import sqlite3
+    filename = str(tmp_path / "evaluations.sqlite")
+    write_results(SQLiteResultsWriter(filename), ["a.xml"], results[:1])
+    connection = sqlite3.connect(filename)
+    connection.execute("ALTER TABLE kpi_scores DROP COLUMN single_comment")
+    connection.commit()
+    connection.close()
+    assert list(iterSQLiteResults(filename)) == results[:1]
+    write_results(SQLiteResultsWriter(filename), ["b.xml"], [with_comments(results[0], "kpi_20", {"rule": "b"})])
+    assert list(iterSQLiteResults(filename)) == [results[0], with_comments(results[0], "kpi_20", {"rule": "b"})]
+
+
+def test_record_store_is_not_a_results_database(tmp_path, results):
+    store_file = str(tmp_path / "records.sqlite")
+    RecordStore(store_file).close()
+    assert not isResultsDatabase(store_file)
+    assert list(iterResults(store_file)) == []
+    results_file = str(tmp_path / "evaluations.sqlite")
+    write_results(SQLiteResultsWriter(results_file), ["a.xml"], results[:1])
+    assert isResultsDatabase(results_file)
+    assert list(iterResults(results_file)) == results[:1]
+
+
+def test_json_lines_files_of_shards_read_as_one(tmp_path, all_example_files, results):
+    for i in [1, 2]:
+        writer = openResultsWriter(str(tmp_path / ("evaluations_%i.jsonl.gz" % i)), "jsonl.gz")
+        evaluateRecords(((os.path.basename(file), file) for file in all_example_files), shard=(i, 2), skip_schema_eval=True, writer=writer)
+        writer.close()
+    key = lambda result: json.dumps(result, sort_keys=True)
+    assert sorted(iterResults(str(tmp_path / "evaluations_*.jsonl.gz")), key=key) == sorted(results, key=key)
@@ -0,0 +1,30 @@
+import json
+import threading
+
+import pytest
+import requests
+
+from pywmdr.metrics import parseAndEvaluate
+from pywmdr.serve import KPIServer
+
+
+@pytest.fixture(scope="module")
+def kpi_server():
+    server = KPIServer(workers=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_service_equals_evaluation(kpi_server, example_files):
+    with open(example_files[0], "rb") as f:
+        response = requests.post(kpi_server.endpoint, params={"skip_schema_eval": "true"}, data=f.read())
+    assert response.status_code == 200
+    assert response.json() == json.loads(json.dumps(parseAndEvaluate(example_files[0], skip_schema_eval=True)))
+
+
+def test_service_rejects_invalid_documents(kpi_server):
+    assert requests.post(kpi_server.endpoint, data=b"<not-wmdr/>").status_code == 400
+    assert requests.post(kpi_server.endpoint, params={"kpi": "x"}, data=b"").status_code == 400
+    assert requests.get(kpi_server.endpoint).json()["status"] == "ok"
@@ -0,0 +1,127 @@
+import os
+import threading
+
+import pytest
+
+from pywmdr.harvest import addTombstones, datePartitions, getRecordsPartitioned, harvestPartition, writeRecordContent
+from pywmdr.store import RecordStore
+
+
+def test_put_if_newer_skips_unchanged_and_older(tmp_path):
+    with RecordStore(str(tmp_path / "records.sqlite")) as store:
+        assert store.put_if_newer("a", "2024-01-02", b"<v2/>")
+        assert not store.put_if_newer("a", "2024-01-02", b"<v2/>")
+        assert not store.put_if_newer("a", "2024-01-01", b"<v1/>")
+        assert store.get("a") == b"<v2/>"
+        assert store.put_if_newer("a", "2024-01-03")
+        assert not store.put_if_newer("a", "2024-01-04")
+        assert store.get("a") is None
+        store.commit()
+        assert store.tombstones() == {"a": "2024-01-03"}
+
+
+def test_concurrent_put_if_newer_appends_once(tmp_path):
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+    barrier = threading.Barrier(8)
+    results = []
+
+    def put():
+        barrier.wait()
+        results.append(writeRecordContent(b"<record/>", "a", None, store, "2024-01-01"))
+
+    threads = [threading.Thread(target=put) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.commit()
+    assert results.count(True) == 1
+    assert store.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0] == 1
+    store.close()
+
+
+def test_store_tombstones_count_only_new(tmp_path):
+    with RecordStore(str(tmp_path / "records.sqlite")) as store:
+        store.put("a", b"<a/>", "2024-01-01")
+        deleted = [{"identifier": "a", "datestamp": "2024-01-02", "deleted": True}]
+        assert addTombstones(deleted, None, store) == 1
+        assert addTombstones(deleted, None, store) == 0
+        assert len(store) == 0
+
+
+def row_count(store):
+    return store.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+
+def test_date_partitions_are_disjoint_and_cover_the_range():
+    windows = datePartitions("2024-01-01T00:00:00Z", "2024-01-01T00:00:09Z", 3)
+    assert windows == [
+        {"from_date": "2024-01-01T00:00:00Z", "until_date": "2024-01-01T00:00:02Z"},
+        {"from_date": "2024-01-01T00:00:03Z", "until_date": "2024-01-01T00:00:05Z"},
+        {"from_date": "2024-01-01T00:00:06Z", "until_date": "2024-01-01T00:00:09Z"}
+    ]
+    assert datePartitions("2024-01-01", "2024-01-02", 4, "YYYY-MM-DD") == [
+        {"from_date": "2024-01-01", "until_date": "2024-01-01"},
+        {"from_date": "2024-01-02", "until_date": "2024-01-02"}
+    ]
+
+
+@pytest.mark.parametrize("partition_by", ["date", "set"])
+def test_partitioned_harvest_merges_into_store(server, tmp_path, partition_by):
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+    getRecordsPartitioned(str(tmp_path), store, endpoint=server.endpoint, partitions=3, partition_by=partition_by)
+    assert len(store) == len(server.records)
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("checkpoint_")]
+    assert sorted(identifier for identifier, datestamp, content in store.iter_records()) == [record["identifier"] for record in server.records]
+    # harvesting again appends nothing
+    getRecordsPartitioned(str(tmp_path), store, endpoint=server.endpoint, partitions=3, partition_by=partition_by)
+    assert row_count(store) == len(server.records)
+    store.close()
+
+
+def test_interrupted_partition_resumes_from_checkpoint(server, tmp_path):
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+    checkpoint_file = str(tmp_path / "checkpoint_0.json")
+    partition = {"set_spec": None}
+    checkpoint = harvestPartition(partition, checkpoint_file, store, endpoint=server.endpoint, max_pages=1)
+    assert not checkpoint["done"] and checkpoint["resumption_token"] is not None
+    assert checkpoint["records"] == 2
+    checkpoint = harvestPartition(partition, checkpoint_file, store, endpoint=server.endpoint)
+    assert checkpoint["done"] and checkpoint["pages"] == 3
+    assert checkpoint["records"] == row_count(store) == len(server.records)
+    store.close()
+
+
+def test_interrupted_partitioned_harvest_resumes_its_partitions(server, tmp_path, monkeypatch):
+    import sys
+    from datetime import datetime, timedelta
+    harvest = sys.modules["pywmdr.harvest"]
+    runs = []
+
+    class LaterDatetime(datetime):
+        # each run resolves the default until date a day later
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(days=len(runs))
+
+    monkeypatch.setattr(harvest, "datetime", LaterDatetime)
+    requests = []
+    respond = server.respond
+    monkeypatch.setattr(server, "respond", lambda params: requests.append(params) or respond(params))
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+
+    runs.append(1)
+    getRecordsPartitioned(str(tmp_path), store, endpoint=server.endpoint, partitions=3, max_pages=1)
+    assert os.path.exists(tmp_path / "partitions.json")
+    first = [params for params in requests if params.get("verb") == "ListRecords"]
+    assert len(first) == 3 and len(store) == 2
+
+    runs.append(2)
+    requests.clear()
+    getRecordsPartitioned(str(tmp_path), store, endpoint=server.endpoint, partitions=3)
+    second = [params for params in requests if params.get("verb") == "ListRecords"]
+    # only the incomplete partition is harvested, from its resumption token
+    assert len(second) == 2 and all("resumptionToken" in params for params in second)
+    assert len(store) == row_count(store) == len(server.records)
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("checkpoint_") or name == "partitions.json"]
+    store.close()
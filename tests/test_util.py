@@ -0,0 +1,183 @@
+import io
+
+import pytest
+from lxml import etree
+
+from pywmdr.util import (find_root_start_tag, get_kpi_evaluation_validator, get_wmdr_parser, iter_document_chunks,
+                         iter_wmdr_records, read_wmdr_identifier, sniff_wmdr, validate_kpi_evaluation_result,
+                         validate_kpi_evaluation_results)
+
+
+def test_kpi_evaluation_validator_is_compiled_once():
+    assert get_kpi_evaluation_validator() is get_kpi_evaluation_validator()
+
+
+def test_stream_validation_equals_single_validation(results):
+    invalid = {"summary": {"total": "many"}}
+    validated = list(validate_kpi_evaluation_results(results + [invalid]))
+    assert [content for content, is_valid in validated] == results + [invalid]
+    assert [is_valid for content, is_valid in validated] == [validate_kpi_evaluation_result(x) for x in results + [invalid]]
+    assert not validated[-1][1]
+
+
+def split_documents(data, chunk_size):
+    documents = []
+    current = []
+    for chunk in iter_document_chunks(io.BytesIO(data), chunk_size):
+        if chunk is None:
+            documents.append(b"".join(current))
+            current = []
+        else:
+            current.append(chunk)
+    assert not current
+    return documents
+
+
+DOCUMENTS = [
+    b'<?xml version="1.0"?>\n<a:root xmlns:a="urn:a"><a:child>1</a:child></a:root>',
+    b'<?xml version="1.0"?>\n<?xml-stylesheet type="text/xsl" href="style.xsl"?>\n<root><x/></root>',
+    b'<?xml version="1.0"?>\n<!-- <not-the-root> -->\n<!DOCTYPE root [<!ELEMENT root ANY>]>\n<root attr="a > b"><root/></root>',
+    b'<?xml version="1.0"?>\n<wmdr:WIGOSMetadataRecord xmlns:wmdr="http://def.wmo.int/wmdr/1.0" id="a/>b"/>',
+    b'<root-without-declaration>text</root-without-declaration >',
+    b'<?xml version="1.0"?>\n<root><!-- </root> <?xml version="1.0"?> --><x/></root>',
+    b'<?xml version="1.0"?>\n<root><![CDATA[</root><?xml version="1.0"?>]]><?pi </root>?></root>'
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 65536])
+def test_concatenated_documents_are_split(chunk_size):
+    assert split_documents(b"\n".join(DOCUMENTS), chunk_size) == DOCUMENTS
+    assert split_documents(b"\0".join(DOCUMENTS), chunk_size) == DOCUMENTS
+
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_split_documents_parse(document):
+    for chunk_size in [1, 7, 65536]:
+        for split in split_documents(document + document, chunk_size):
+            etree.fromstring(split)
+
+
+def test_stylesheet_instruction_does_not_start_a_document():
+    assert split_documents(DOCUMENTS[1], 65536) == [DOCUMENTS[1]]
+
+
+def test_tag_in_comment_is_not_the_root():
+    data = b'<?xml version="1.0"?><!-- <a> --><?pi <b>?><c x=">"/>'
+    assert find_root_start_tag(data) == (b"c", len(data))
+    assert find_root_start_tag(b"<!-- <a> ") is None
+    assert find_root_start_tag(b"<root") is None
+    assert find_root_start_tag(b"<root>") == (b"root", None)
+
+
+def test_empty_root_closes_its_document():
+    documents = [DOCUMENTS[3], DOCUMENTS[0]]
+    assert split_documents(b"".join(documents), 65536) == documents
+
+
+def test_end_tag_and_declaration_in_comment_do_not_split_a_record(example_files):
+    with open(example_files[0], "rb") as f:
+        content = f.read()
+    i = content.index(b"<", content.index(b"WIGOSMetadataRecord"))
+    commented = content[:i] + b"<!-- </wmdr:WIGOSMetadataRecord> <?xml version='1.0'?> -->" + content[i:]
+    for chunk_size in [16, 4096]:
+        records = list(iter_wmdr_records(io.BytesIO(commented + b"\n" + content), chunk_size))
+        assert [error for identifier, record, error in records] == [None, None]
+
+
+def test_records_of_concatenated_documents(example_files):
+    contents = []
+    for file in example_files:
+        with open(file, "rb") as f:
+            contents.append(f.read())
+    records = list(iter_wmdr_records(io.BytesIO(b"\n".join(contents)), 4096))
+    assert [error for identifier, record, error in records] == [None] * len(contents)
+    assert [etree.tostring(record, method="c14n") for identifier, record, error in records] == [etree.tostring(etree.fromstring(content), method="c14n") for content in contents]
+
+
+def wrapped(content, padding):
+    return b'<wrapper>' + b'<item/>' * padding + content + b'</wrapper>'
+
+
+@pytest.mark.parametrize("padding", [0, 10, 200])
+def test_record_after_many_tags_is_sniffed(example_files, padding):
+    for file in example_files:
+        with open(file, "rb") as f:
+            content = f.read().split(b"?>", 1)[1]
+        assert sniff_wmdr(io.BytesIO(wrapped(content, padding))) == sniff_wmdr(file)
+
+
+def test_sniffing_falls_back_from_the_stream_position(example_files):
+    for file in example_files:
+        with open(file, "rb") as f:
+            content = f.read().split(b"?>", 1)[1]
+        source = io.BytesIO(b"prefix" + wrapped(content, 200))
+        source.seek(len(b"prefix"))
+        assert sniff_wmdr(source, max_events=8) == sniff_wmdr(file)
+
+
+def test_examples_are_sniffed(example_files):
+    assert sorted(sniff_wmdr(file) for file in example_files) == ["1.0", "1.0RC9"]
+
+
+@pytest.mark.parametrize("document", [wrapped(b"", 200), b"<wrapper><item>", b"not xml"])
+def test_non_wmdr_documents_are_not_sniffed(document):
+    assert sniff_wmdr(io.BytesIO(document)) is None
+
+
+def test_oai_response_is_sniffed(server):
+    from urllib.request import urlopen
+    with urlopen(f"{server.endpoint}?verb=ListRecords&metadataPrefix=wmdr") as response:
+        assert sniff_wmdr(io.BytesIO(response.read())) == "oai"
+
+
+def test_wmdr_parser_is_reused_per_thread_and_configuration():
+    import threading
+    parser = get_wmdr_parser()
+    assert get_wmdr_parser() is parser
+    assert get_wmdr_parser(huge_tree=True) is not parser
+    assert get_wmdr_parser(preserve=True) is not parser
+    parsers = []
+    thread = threading.Thread(target=lambda: parsers.append(get_wmdr_parser()))
+    thread.start()
+    thread.join()
+    assert parsers[0] is not parser
+
+
+def test_wmdr_parser_drops_blank_text_and_comments():
+    exml = etree.parse(io.BytesIO(b"<a>\n  <!-- comment -->\n  <b> text </b>\n</a>"), get_wmdr_parser())
+    assert etree.tostring(exml) == b"<a><b> text </b></a>"
+    exml = etree.parse(io.BytesIO(b"<a>\n  <!-- comment -->\n</a>"), get_wmdr_parser(preserve=True))
+    assert etree.tostring(exml) == b"<a>\n  <!-- comment -->\n</a>"
+
+
+def test_wmdr_parser_does_not_resolve_entities(tmp_path):
+    secret = tmp_path / "secret.txt"
+    secret.write_text("secret")
+    document = b'<!DOCTYPE a [<!ENTITY e SYSTEM "%s">]><a>&e;</a>' % secret.as_uri().encode()
+    exml = etree.parse(io.BytesIO(document), get_wmdr_parser())
+    assert "secret" not in "".join(exml.getroot().itertext())
+
+
+def test_wmdr_parser_evaluation_equals_default_parser(all_example_files, results):
+    from pywmdr.metrics import evaluateTree
+    assert [evaluateTree(etree.parse(file), skip_schema_eval=True) for file in all_example_files] == results
+
+
+def test_identifier_is_read_as_evaluated(all_example_files, results):
+    for file, result in zip(all_example_files, results):
+        with open(file, "rb") as f:
+            content = f.read()
+        source = io.BytesIO(b"prefix" + content)
+        source.seek(len(b"prefix"))
+        identifiers = [read_wmdr_identifier(file), read_wmdr_identifier(source),
+                       read_wmdr_identifier(etree.fromstring(content))]
+        assert identifiers == [result["summary"]["identifier"]] * 3
+        assert source.tell() == len(b"prefix")
+
+
+def test_identifier_of_record_in_envelope_and_of_invalid_documents(example_files):
+    with open(example_files[1], "rb") as f:
+        content = f.read().split(b"?>", 1)[1]
+    assert read_wmdr_identifier(io.BytesIO(b"<envelope><metadata>" + content + b"</metadata></envelope>")) == read_wmdr_identifier(example_files[1])
+    assert read_wmdr_identifier(io.BytesIO(b"<a><identifier>x</identifier></a>")) == ""
+    assert read_wmdr_identifier(io.BytesIO(b"not xml")) == ""